@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+from datetime import datetime
+from urllib.request import urlopen
+from pyspark.sql.functions import col, hour, dayofmonth, weekofyear, month, year, date_format, udf
+from pyspark.sql.types import TimestampType
+
+from datagen import generate_log_data, generate_song_data
+from etl import RAW_DATA, SONG_FILE_RECORDS, SONG_LAYOUTS, create_spark_session, process_log_data, \
+    process_song_data, read_json, release_tables, with_date_time
+
+# benchmarks that can be run, and the generated data each needs
+BENCHMARKS = {
+    "pipeline": ["song", "log"],
+    "timestamps": ["log"],
+    "layouts": ["song"]
+}
+
+def count_files(spark, path):
+    """Counts the parquet files under a path, in every partition directory
+
+    Args:
+        spark - object for the spark session
+        path - location of a table
+
+    Returns:
+        number of parquet files
+    """
+    jvm = spark.sparkContext._jvm
+    root = jvm.org.apache.hadoop.fs.Path(path)
+    files = root.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()).listFiles(root, True)
+
+    count = 0
+    while files.hasNext():
+        if files.next().getPath().getName().endswith(".parquet"):
+            count += 1
+    return count
+
+
+def layout_benchmark(spark, input_data, output_data, layouts, song_file_records=SONG_FILE_RECORDS):
+    """Writes the songs table in each layout and compares the number of files
+    and the time of a full scan and of a scan filtered on one artist
+
+    Args:
+        spark - object for the spark session
+        input_data - location of the song-data folder
+        output_data - location each layout is written under
+        layouts - keys of SONG_LAYOUTS compared
+        song_file_records - largest number of rows in a songs parquet file
+
+    Returns:
+        None
+    """
+    print("{:<22}{:>10}{:>12}{:>12}{:>12}".format("layout", "files", "write s", "scan s", "filter s"))
+    for layout in layouts:
+        songs = os.path.join(output_data, layout)
+
+        start = time.perf_counter()
+        process_song_data(spark, input_data, songs, songs_layout=layout, song_file_records=song_file_records)
+        write_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        df = spark.read.parquet(os.path.join(songs, "songs"))
+        df.write.format("noop").mode("overwrite").save()
+        scan_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        df.filter(col("artist_id") == "AR{:016d}".format(1)).write.format("noop").mode("overwrite").save()
+        filter_seconds = time.perf_counter() - start
+
+        print("{:<22}{:>10}{:>12.2f}{:>12.2f}{:>12.2f}".format(
+            layout, count_files(spark, os.path.join(songs, "songs")), write_seconds, scan_seconds, filter_seconds))
+
+
+def python_date_time(df):
+    """Adds the date_time column with the row at a time Python UDF the log
+    transform used before, kept as the baseline of the benchmark
+
+    Args:
+        df - log events dataframe with a ts column
+
+    Returns:
+        df - the log events with the date_time column
+    """
+    get_datetime = udf(lambda x: datetime.fromtimestamp(x/1000), TimestampType())
+    return df.withColumn("date_time", get_datetime("ts"))
+
+
+def time_columns(df):
+    """Runs the time table transform of process_log_data without writing it
+
+    Args:
+        df - log events dataframe with a date_time column
+
+    Returns:
+        seconds taken
+    """
+    start = time.perf_counter()
+    df.select(
+        hour(col("date_time")).alias("hour"),
+        dayofmonth(col("date_time")).alias("day"),
+        weekofyear(col("date_time")).alias("week"),
+        month(col("date_time")).alias("month"),
+        year(col("date_time")).alias("year"),
+        date_format(col("date_time"), "E").alias("weekday")
+    ).write.format("noop").mode("overwrite").save()
+    return time.perf_counter() - start
+
+
+def timestamp_benchmark(spark, log_data, methods, runs=3):
+    """Compares the rows/sec of the ts to date_time conversions
+
+    Args:
+        spark - object for the spark session
+        log_data - path of the log files
+        methods - date_time methods compared, "python" for the former UDF or
+                  one of the methods of with_date_time
+        runs - timed runs of each method, the fastest is reported
+
+    Returns:
+        None
+    """
+    df = read_json(spark, log_data, "log").filter(col("page") == "NextSong").cache()
+    rows = df.count()
+
+    print("{:<10}{:>12}{:>12}{:>14}".format("method", "rows", "seconds", "rows/sec"))
+    for method in methods:
+        dated = python_date_time(df) if method == "python" else with_date_time(df, method)
+        seconds = min(time_columns(dated) for _ in range(runs))
+        print("{:<10}{:>12}{:>12.2f}{:>14.0f}".format(method, rows, seconds, rows / seconds))
+
+    df.unpersist()
+
+
+def spark_api(spark, endpoint):
+    """Reads an endpoint of the monitoring REST API of the spark UI
+
+    Args:
+        spark - object for the spark session
+        endpoint - path of the endpoint under the application, such as "stages"
+
+    Returns:
+        the decoded json response
+    """
+    context = spark.sparkContext
+    url = "{}/api/v1/applications/{}/{}".format(context.uiWebUrl, context.applicationId, endpoint)
+    with urlopen(url) as response:
+        return json.load(response)
+
+
+def shuffle_bytes(spark):
+    """Totals the shuffle bytes written by the completed stages of the session
+
+    Args:
+        spark - object for the spark session
+
+    Returns:
+        bytes written to shuffle files so far
+    """
+    return sum(stage.get("shuffleWriteBytes", 0) for stage in spark_api(spark, "stages?status=complete"))
+
+
+def peak_memory(spark):
+    """Looks up the peak JVM heap of the executors, in local mode the driver
+
+    Args:
+        spark - object for the spark session
+
+    Returns:
+        peak heap bytes, None when the spark version does not report it
+    """
+    peaks = [
+        executor["peakMemoryMetrics"]["JVMHeapMemory"]
+        for executor in spark_api(spark, "allexecutors")
+        if "JVMHeapMemory" in executor.get("peakMemoryMetrics", {})
+    ]
+    return max(peaks) if peaks else None
+
+
+def pipeline_benchmark(spark, input_data, output_data):
+    """Runs process_song_data and process_log_data against local paths, in
+    one session with the song tables kept in memory as main does, and
+    reports the seconds and shuffle bytes of each stage and the peak memory
+
+    Args:
+        spark - object for the spark session
+        input_data - location of the generated song-data and log_data folders
+        output_data - location the tables are written to
+
+    Returns:
+        stages - list of (stage name, seconds, shuffle bytes)
+    """
+    stages = []
+    song_tables = None
+    for name in ["songs", "logs"]:
+        shuffled = shuffle_bytes(spark)
+        start = time.perf_counter()
+        if name == "songs":
+            song_tables = process_song_data(spark, input_data, output_data, keep_tables=True)
+        else:
+            process_log_data(spark, input_data, output_data, song_tables=song_tables)
+        stages.append((name, time.perf_counter() - start, shuffle_bytes(spark) - shuffled))
+    release_tables(song_tables)
+
+    print("{:<10}{:>12}{:>16}".format("stage", "seconds", "shuffle MB"))
+    for name, seconds, shuffled in stages:
+        print("{:<10}{:>12.2f}{:>16.1f}".format(name, seconds, shuffled / 1024 ** 2))
+
+    heap = peak_memory(spark)
+    print("peak JVM heap: {}".format("{:.0f} MB".format(heap / 1024 ** 2) if heap is not None else "not reported"))
+    print("peak python RSS: {:.0f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    return stages
+
+
+def main(benchmarks, events, songs, path=None, reuse=False, methods=(), layouts=()):
+    """Generates Sparkify song and log data on local disk and runs the chosen
+    benchmarks against it with Spark in local mode
+
+    Args:
+        benchmarks - keys of BENCHMARKS run
+        events - number of log events generated
+        songs - number of songs generated
+        path - local directory the data is generated in and the tables are
+               written under, a temporary directory when None
+        reuse - use the data already generated in path rather than
+                generating it again
+        methods - date_time methods compared by the timestamps benchmark
+        layouts - keys of SONG_LAYOUTS compared by the layouts benchmark
+
+    Returns:
+        None
+    """
+    spark = create_spark_session(master="local[*]", s3=False)
+
+    with tempfile.TemporaryDirectory() as temporary:
+        path = os.path.abspath(path or temporary)
+        input_data = "file://" + path
+
+        records = {record for benchmark in benchmarks for record in BENCHMARKS[benchmark]}
+        if not reuse:
+            start = time.perf_counter()
+            if "song" in records:
+                generate_song_data(spark, path, songs)
+            if "log" in records:
+                generate_log_data(spark, path, events, songs)
+            print("generated {} songs and {} events in {:.2f} seconds".format(
+                songs, events if "log" in records else 0, time.perf_counter() - start))
+
+        if "pipeline" in benchmarks:
+            pipeline_benchmark(spark, input_data, "file://" + os.path.join(path, "output"))
+
+        if "timestamps" in benchmarks:
+            timestamp_benchmark(spark, os.path.join(input_data, RAW_DATA["log"]), methods)
+
+        if "layouts" in benchmarks:
+            layout_benchmark(spark, input_data, "file://" + os.path.join(path, "layouts"), layouts)
+
+    spark.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the data lake ETL in Spark local mode on generated data")
+    parser.add_argument("benchmarks", nargs="*", default=["pipeline"], choices=sorted(BENCHMARKS),
+                        help="benchmarks run, the ETL pipeline by default")
+    parser.add_argument("--events", type=int, default=1000000, help="number of log events generated, 10K to 100M")
+    parser.add_argument("--songs", type=int, default=100000, help="number of songs generated")
+    parser.add_argument("--path", help="local directory for the generated data and tables, temporary by default")
+    parser.add_argument("--reuse", action="store_true", help="use the data already generated in --path")
+    parser.add_argument("--methods", nargs="+", default=["python", "native", "pandas"],
+                        choices=["python", "native", "pandas"], help="date_time conversions compared")
+    parser.add_argument("--layouts", nargs="+", default=sorted(SONG_LAYOUTS), choices=sorted(SONG_LAYOUTS),
+                        help="songs table layouts compared")
+    args = parser.parse_args()
+
+    if args.reuse and not args.path:
+        parser.error("--reuse needs the --path of the generated data")
+
+    main(args.benchmarks, args.events, args.songs, args.path, args.reuse, args.methods, args.layouts)
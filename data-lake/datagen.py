@@ -0,0 +1,120 @@
+import os
+from pyspark.sql.functions import col, floor, format_string, lit, pmod, rand, when
+from pyspark.sql.functions import hash as hash_of, pow as power_of
+
+# epoch milliseconds of the first generated event, 2018-11-01
+FIRST_TS = 1541030400000
+
+# events of a session and users the sessions are spread over
+SESSION_EVENTS = 100
+USERS = 1000
+
+
+def song_columns(number, artists):
+    """Builds the song-data columns of a song from its number, so the log
+    events can refer to the same title, artist and duration
+
+    Args:
+        number - column of song numbers
+        artists - number of artists the songs are spread over
+
+    Returns:
+        dict of column name to column
+    """
+    artist = pmod(number, lit(artists))
+    located = pmod(artist, lit(3)) != 0
+    return {
+        "artist_id": format_string("AR%016d", artist),
+        "artist_latitude": when(located, 40.0 + pmod(artist, lit(10))),
+        "artist_location": when(located, format_string("City %d", pmod(artist, lit(50)))).otherwise(""),
+        "artist_longitude": when(located, -74.0 - pmod(artist, lit(10))),
+        "artist_name": format_string("Artist %d", artist),
+        "duration": (60 + pmod(hash_of(number), lit(54000000)) / 100000.0),
+        "num_songs": lit(1),
+        "song_id": format_string("SO%016d", number),
+        "title": format_string("Song %d", number),
+        "year": when(pmod(hash_of(number, lit(1)), lit(10)) == 0, 0)
+        .otherwise(1960 + pmod(hash_of(number, lit(2)), lit(59)))
+    }
+
+
+def generate_song_data(spark, path, songs, files=None):
+    """Writes generated Sparkify song records as JSON lines files in the layout
+    of song-data, with about four songs per artist. The records are built
+    with Spark so tens of millions of songs can be generated in local mode
+
+    Args:
+        spark - object for the spark session
+        path - local directory the song-data folder is written under
+        songs - number of songs generated
+        files - number of files written, about 100,000 songs per file when None
+
+    Returns:
+        path - the input_data of process_song_data
+    """
+    columns = song_columns(col("id"), max(1, songs // 4))
+    spark.range(songs)\
+    .select([column.alias(name) for name, column in columns.items()])\
+    .repartition(files or max(1, songs // 100000))\
+    .write\
+    .mode('overwrite')\
+    .json(os.path.join(path, "song-data", "A", "A", "A"))
+
+    return path
+
+
+def generate_log_data(spark, path, events, songs, days=30, files=None, seed=42):
+    """Writes generated Sparkify log events as JSON lines files in the layout
+    of log_data. About nine events in ten are NextSong events of one of the
+    generated songs, chosen with a skew towards the lowest numbered songs so
+    a few tracks are played far more than the rest
+
+    Args:
+        spark - object for the spark session
+        path - local directory the log_data folder is written under
+        events - number of events generated
+        songs - number of songs generated by generate_song_data
+        days - days the events are spread over from FIRST_TS
+        files - number of files written, about 1,000,000 events per file when None
+        seed - random seed of the song choice and page
+
+    Returns:
+        path - the input_data of process_log_data
+    """
+    event = col("id")
+    session = floor(event / SESSION_EVENTS)
+    user = pmod(hash_of(session), lit(USERS)) + 1
+    played = col("played")
+    song = song_columns(col("song_number"), max(1, songs // 4))
+    step = max(1, days * 86400000 // max(1, events))
+
+    # the random values are drawn once per event and shared by its columns
+    spark.range(events)\
+    .withColumn("played", rand(seed) < 0.9)\
+    .withColumn("song_number", floor(power_of(rand(seed + 1), 3) * songs))\
+    .select(
+        when(played, song["artist_name"]).alias("artist"),
+        lit("Logged In").alias("auth"),
+        format_string("First%d", user).alias("firstName"),
+        when(pmod(user, lit(2)) == 0, "F").otherwise("M").alias("gender"),
+        pmod(event, lit(SESSION_EVENTS)).alias("itemInSession"),
+        format_string("Last%d", user).alias("lastName"),
+        when(played, song["duration"]).alias("length"),
+        when(pmod(hash_of(user, session), lit(4)) == 0, "paid").otherwise("free").alias("level"),
+        format_string("City %d", pmod(user, lit(20))).alias("location"),
+        lit("PUT").alias("method"),
+        when(played, "NextSong").otherwise("Home").alias("page"),
+        lit(1540000000000.0).alias("registration"),
+        session.alias("sessionId"),
+        when(played, song["title"]).alias("song"),
+        lit(200).alias("status"),
+        (FIRST_TS + event * step).alias("ts"),
+        lit("Mozilla/5.0").alias("userAgent"),
+        user.cast("string").alias("userId")
+    )\
+    .repartition(files or max(1, events // 1000000))\
+    .write\
+    .mode('overwrite')\
+    .json(os.path.join(path, "log_data", "2018", "11"))
+
+    return path
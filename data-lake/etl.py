@@ -1,51 +1,570 @@
+import argparse
+import calendar
 import configparser
-from datetime import datetime
+import json
+import math
 import os
+import time
+from datetime import datetime, timedelta
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, expr
+from pyspark.sql.functions import array, broadcast, col, explode, expr, floor, input_file_name, lit, rand, struct, when
+from pyspark.sql.functions import approx_count_distinct, count, date_trunc, to_date
+from pyspark.sql.functions import max as max_value
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
 from pyspark.sql.types import IntegerType, TimestampType
+from schemas import CORRUPT_RECORD, get_schema
 
 
-config = configparser.ConfigParser()
-config.read('dl.cfg')
+# location of the raw json files of each type of record under the input data
+RAW_DATA = {
+    "song": "song-data/*/*/*/*.json",
+    "log": "log_data/*/*/*.json"
+}
 
-os.environ['AWS_ACCESS_KEY_ID']=config['secretkey']['AWS_ACCESS_KEY_ID']
-os.environ['AWS_SECRET_ACCESS_KEY']=config['secretkey']['AWS_SECRET_ACCESS_KEY']
+# log files named after the day of their events, listed a day at a time by incremental runs
+LOG_DAY_FILES = "log_data/{0:%Y}/{0:%m}/{0:%Y-%m-%d}-*.json"
+LOG_ANY_DAY_FILES = "log_data/*/*/[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]-*.json"
 
+# json bytes read into each file of the compacted layer
+TARGET_FILE_SIZE = 128 * 1024 * 1024
 
-def create_spark_session():
-    """Creates a spark session
+# layouts the songs table can be written in, see write_table
+SONG_LAYOUTS = {
+    # a directory per artist per year, written by every task that has the artist's songs
+    "year_artist": {"partitions": ["year", "artist_id"]},
+    # a directory per artist per year with a single file in each
+    "year_artist_compact": {"partitions": ["year", "artist_id"], "repartition": ["year", "artist_id"]},
+    # a directory per year, files sorted by artist so the parquet row group
+    # statistics let a filter on artist_id skip most of them
+    "year": {"partitions": ["year"], "repartition": ["year"], "sort": ["year", "artist_id", "title"]},
+    # a directory per year, the files of each year bucketed and sorted by artist
+    "bucketed": {"partitions": ["year"], "buckets": 32, "bucket_by": ["artist_id"], "sort": ["artist_id", "title"]}
+}
+
+# parquet bytes targeted for each file of the songs table, spark can only cap the
+# rows of a file, so the rows per file are worked out from the average row size of
+# the songs table already written, see records_per_file
+SONG_FILE_SIZE = 128 * 1024 * 1024
+
+# rows per parquet file of the songs table before there is a table to measure
+SONG_FILE_RECORDS = 500000
+
+# columns song plays are joined to the song dimension on: the title, artist name and duration
+JOIN_KEYS = ["song_title", "artist_name", "song_length"]
+
+# most played join keys reported on each run, and buckets the song plays of
+# a hot key are spread over by the salted join
+SKEW_REPORT_KEYS = 10
+SALT_BUCKETS = 16
+
+# rollup tables of the song plays that can be built with them, by the columns
+# the plays are counted by within each year and month partition, day and hour
+# are the day and the hour the song plays started in
+ROLLUPS = {
+    # daily plays by user, level and location
+    "daily_user_plays": ["day", "user_id", "level", "location"],
+    # hourly plays of each song
+    "hourly_song_plays": ["hour", "song_id", "artist_id"],
+    # monthly plays of each song by level, for the top songs per level per month
+    "monthly_level_song_plays": ["level", "song_id", "artist_id"]
+}
+
+# columns of the run manifest, tables is a json object of the partitions each
+# table had replaced and skewed_keys a json list of the most played join keys
+RUN_SCHEMA = "started_at double, finished_at double, incremental boolean, songs_since double, " \
+             "since string, until string, tables string, skewed_keys string"
+
+# timezone of the session, used to render the timestamps and extract the hour, day and weekday
+SESSION_TIMEZONE = "UTC"
+
+
+def set_aws_credentials(path='dl.cfg'):
+    """Exports the AWS keys in the config file to the environment, for the
+    s3a filesystem
 
     Args:
+        path - location of the config file
+
+    Returns:
         None
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+
+    os.environ['AWS_ACCESS_KEY_ID']=config['secretkey']['AWS_ACCESS_KEY_ID']
+    os.environ['AWS_SECRET_ACCESS_KEY']=config['secretkey']['AWS_SECRET_ACCESS_KEY']
+
+
+def uses_s3(*paths):
+    """Checks whether any of the locations is on S3, read with the s3a filesystem
+
+    Args:
+        paths - locations, None for the ones not given
+
+    Returns:
+        True when a location starts with s3a://
+    """
+    return any(path is not None and path.startswith("s3a://") for path in paths)
+
+
+def create_spark_session(timezone=SESSION_TIMEZONE, partition_overwrite="static", master=None, s3=True):
+    """Creates a spark session
+
+    Args:
+        timezone - session timezone, set explicitly so the time table does not
+                   depend on the timezone of the driver and executors
+        partition_overwrite - "static" to replace every partition of a table
+                              written with overwrite, "dynamic" to replace
+                              only the partitions that are written
+        master - spark master, such as "local[*]" to run on this machine,
+                 the one given by spark-submit when None
+        s3 - add the hadoop-aws package for the s3a filesystem, not needed
+             for local paths
 
     Returns:
         spark - object for the spark session
     """
-    spark = SparkSession \
-        .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+    builder = SparkSession.builder
+    if master is not None:
+        builder = builder.master(master)
+    if s3:
+        builder = builder.config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0")
+
+    spark = builder \
+        .config("spark.sql.session.timeZone", timezone) \
+        .config("spark.sql.sources.partitionOverwriteMode", partition_overwrite) \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.cleaner.referenceTracking.cleanCheckpoints", "true") \
         .getOrCreate()
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def with_date_time(df, method="native"):
+    """Adds a date_time timestamp column converted from the ts epoch milliseconds
+
+    Args:
+        df - log events dataframe with a ts column
+        method - "native" to convert with a Spark expression that stays in the JVM,
+                 "pandas" to convert with a vectorized pandas UDF over Arrow batches,
+                 which needs pyarrow on the executors
+
+    Returns:
+        df - the log events with the date_time column
+    """
+    if method == "native":
+        return df.withColumn("date_time", (col("ts") / 1000).cast(TimestampType()))
+
+    if method == "pandas":
+        return df.withColumn("date_time", pandas_date_time()(col("ts")))
+
+    raise ValueError("unknown date_time method: {}".format(method))
+
+
+def pandas_date_time():
+    """Builds the pandas UDF converting epoch milliseconds to timestamps, only
+    imported when used so pandas and pyarrow stay optional
+
+    Args:
+        None
+
+    Returns:
+        pandas UDF of a ts column
+    """
+    import pandas as pd
+    from pyspark.sql.functions import pandas_udf
+
+    @pandas_udf(TimestampType())
+    def to_date_time(ts):
+        # timezone aware so Spark does not read the values as session local times
+        return pd.to_datetime(ts, unit="ms", utc=True)
+
+    return to_date_time
+
+
+def read_json(spark, path, record, quarantine=None, schema_version=None):
+    """Reads json files with the registered schema of their records, so Spark
+    does not scan every file to infer the schema first
+
+    Args:
+        spark - object for the spark session
+        path - location of the json files
+        record - "song" or "log", the schema of the records, see schemas.py
+        quarantine - when given, strict mode: records that do not match the
+                     schema are written as json, with the file they came
+                     from, under quarantine/record rather than read as nulls
+        schema_version - version of the record schema, the latest when None
+
+    Returns:
+        df - dataframe of the records matching the schema, in strict mode a
+             local checkpoint of them
+    """
+    if quarantine is None:
+        return spark.read.json(path, schema=get_schema(record, schema_version), encoding='UTF-8')
+
+    df = spark.read.json(
+        path,
+        schema=get_schema(record, schema_version, corrupt_record=True),
+        mode="PERMISSIVE",
+        columnNameOfCorruptRecord=CORRUPT_RECORD,
+        encoding='UTF-8'
+    ).withColumn("source_file", input_file_name())
+
+    # spark only allows filtering on the corrupt record column of a cached read
+    df = df.cache()
+
+    df.filter(col(CORRUPT_RECORD).isNotNull())\
+    .select(col("source_file"), col(CORRUPT_RECORD).alias("record"))\
+    .write\
+    .mode('append')\
+    .json(os.path.join(quarantine, record))
+
+    # the valid records are checkpointed so the cached read can be released, once uncached a
+    # count of them would read the files for the corrupt record column only, which spark refuses
+    good = df.filter(col(CORRUPT_RECORD).isNull()).drop(CORRUPT_RECORD, "source_file").localCheckpoint()
+    df.unpersist()
+
+    return good
+
+
+def list_files(spark, pattern, modified_since=None):
+    """Lists the files matching a glob pattern with the hadoop filesystem of
+    the path, so the same code lists S3 and the local filesystem
+
+    Args:
+        spark - object for the spark session
+        pattern - glob pattern of the files
+        modified_since - when given, only the files modified at or after this
+                         epoch time in seconds are listed
+
+    Returns:
+        files - list of (path, size in bytes)
+    """
+    statuses = glob_status(spark, pattern)
+    if modified_since is not None:
+        statuses = [status for status in statuses if status.getModificationTime() >= modified_since * 1000]
+    return [(status.getPath().toString(), status.getLen()) for status in statuses if status.isFile()]
+
+
+def glob_status(spark, pattern):
+    """Looks up the hadoop file statuses matching a glob pattern
+
+    Args:
+        spark - object for the spark session
+        pattern - glob pattern of the paths
+
+    Returns:
+        statuses - list of hadoop FileStatus, empty when nothing matches
+    """
+    jvm = spark.sparkContext._jvm
+    path = jvm.org.apache.hadoop.fs.Path(pattern)
+    fs = path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    return list(fs.globStatus(path) or [])
+
+
+def records_per_file(spark, path, target_size, default=SONG_FILE_RECORDS):
+    """Works out how many rows make a parquet file of about target_size bytes,
+    from the bytes and the row count, read from the parquet footers, of the
+    table already at path
+
+    Args:
+        spark - object for the spark session
+        path - location of the table
+        target_size - parquet bytes targeted for each file
+        default - rows per file when there is no table to measure yet
+
+    Returns:
+        records - number of rows per file
+    """
+    if not glob_status(spark, path):
+        return default
+
+    jvm = spark.sparkContext._jvm
+    table = jvm.org.apache.hadoop.fs.Path(path)
+    size = table.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()).getContentSummary(table).getLength()
+    rows = spark.read.parquet(path).count()
+    if not rows or not size:
+        return default
+    return max(1, int(target_size * rows / size))
+
+
+def compact_data(spark, input_data, compacted_data, record, target_file_size=TARGET_FILE_SIZE, quarantine=None):
+    """Merges the raw json files of a type of record into a few right-sized
+    parquet files, so later reads open a handful of files rather than
+    millions of one record files. Only the files not already in the manifest
+    are compacted, each run appends its files to the compacted layer
+
+    Args:
+        spark - object for the spark session
+        input_data - location of the raw input data, S3 or a local path
+        compacted_data - location of the compacted layer
+        record - "song" or "log", the type of record compacted
+        target_file_size - json bytes read into each parquet file
+        quarantine - location malformed records are written to, see read_json
+
+    Returns:
+        files - number of raw files compacted by this run
+    """
+    output = os.path.join(compacted_data, record)
+    manifest = os.path.join(output, "_manifest")
+
+    # raw files already compacted, the manifest is ignored by reads of the layer
+    files = list_files(spark, os.path.join(input_data, RAW_DATA[record]))
+    if files and list_files(spark, os.path.join(manifest, "*.json")):
+        compacted = {row.path for row in spark.read.json(manifest).select("path").collect()}
+        files = [(path, size) for path, size in files if path not in compacted]
+
+    if not files:
+        return 0
+
+    # number of output files from the size of the input
+    partitions = max(1, math.ceil(sum(size for _, size in files) / target_file_size))
+
+    read_json(spark, [path for path, _ in files], record, quarantine)\
+    .repartition(partitions)\
+    .write\
+    .mode('append')\
+    .parquet(output)
+
+    # manifest of the compacted files, written once their records are
+    spark.createDataFrame(files, ["path", "size"])\
+    .withColumn("compacted_at", lit(time.time()))\
+    .coalesce(1)\
+    .write\
+    .mode('append')\
+    .json(manifest)
+
+    return len(files)
+
+
+def read_input(spark, input_data, record, quarantine=None, compacted_data=None):
+    """Reads the records of a type from the compacted layer when one is given,
+    otherwise from the raw json files
+
+    Args:
+        spark - object for the spark session
+        input_data - location of the raw input data
+        record - "song" or "log"
+        quarantine - location malformed records are written to, see read_json
+        compacted_data - location of the compacted layer written by compact_data
+
+    Returns:
+        df - dataframe of the records
+    """
+    if compacted_data is not None:
+        return spark.read.parquet(os.path.join(compacted_data, record))
+
+    return read_json(spark, os.path.join(input_data, RAW_DATA[record]), record, quarantine)
+
+
+def read_log_window(spark, input_data, since, until, quarantine=None, compacted_data=None):
+    """Reads the log events of a window of days, listing only the log files of
+    those days rather than every log file. When the log files are not named
+    after their day, such as the part files written by datagen.py, every log
+    file is read and filtered on ts instead
+
+    Args:
+        spark - object for the spark session
+        input_data - location of the raw input data
+        since - first date of the window
+        until - date after the last date of the window
+        quarantine - location malformed records are written to, see read_json
+        compacted_data - location of the compacted layer, read and filtered on
+                         ts instead of listing the raw files when given
+
+    Returns:
+        df - dataframe of the log events with a ts in the window
+    """
+    if compacted_data is not None:
+        df = read_input(spark, input_data, "log", quarantine, compacted_data)
+    else:
+        days = (until - since).days
+        paths = [
+            path
+            for day in range(days)
+            for path, _ in list_files(spark, os.path.join(input_data, LOG_DAY_FILES.format(since + timedelta(days=day))))
+        ]
+        if paths:
+            df = read_json(spark, paths, "log", quarantine)
+        elif days > 0 and not list_files(spark, os.path.join(input_data, LOG_ANY_DAY_FILES)):
+            df = read_input(spark, input_data, "log", quarantine)
+        else:
+            return spark.createDataFrame([], get_schema("log"))
+
+    return df.filter((col("ts") >= epoch_ms(since)) & (col("ts") < epoch_ms(until)))
+
+
+def epoch_ms(day):
+    """Converts a date to the epoch milliseconds of its start in UTC
+
+    Args:
+        day - date
+
+    Returns:
+        epoch milliseconds
+    """
+    return calendar.timegm(day.timetuple()) * 1000
+
+
+def write_table(spark, df, path, partitions=None, keys=None, incremental=False, layout=None):
+    """Writes a table as parquet files, replacing the table
+
+    In incremental mode, with the session in dynamic partition overwrite mode,
+    only the partitions df has rows in are replaced. The rows already in
+    those partitions are kept unless df has a row with the same keys, so a
+    run only rewrites what it touched and running it again is idempotent.
+    The merge needs the session's checkpoint directory, see main. A table
+    without partitions, such as users and artists, is rewritten whole
+
+    Args:
+        spark - object for the spark session
+        df - dataframe of the rows to write
+        path - location of the table
+        partitions - columns the table is partitioned by, if any
+        keys - columns identifying a row, used to merge in incremental mode
+        incremental - merge df into the partitions it touches
+        layout - optional dict of how the files are laid out, the values of
+                 SONG_LAYOUTS:
+                   repartition - columns the rows are shuffled by before
+                                 writing, so each partition directory is
+                                 written by one task
+                   sort - columns the rows of each file are sorted by
+                   buckets, bucket_by - number of buckets and the columns the
+                                        files are bucketed by, the table is
+                                        then saved in the session catalog
+                   max_records - largest number of rows in a file
+
+    Returns:
+        written - list of dicts of the partition values written in incremental
+                  mode, None otherwise
+    """
+    layout = layout or {}
+    if incremental and layout.get("buckets"):
+        raise ValueError("bucketed tables can not be written incrementally")
+
+    written = None
+    if incremental:
+        if partitions:
+            written = [row.asDict() for row in df.select(partitions).distinct().collect()]
+
+        if keys and glob_status(spark, path):
+            existing = spark.read.parquet(path)
+            if partitions:
+                existing = existing.join(broadcast(df.select(partitions).distinct()), on=partitions, how="left_semi")
+
+            # the merged rows are checkpointed to the checkpoint directory, not
+            # to executor storage, so the files they were read from can be
+            # replaced without losing the rows if an executor is lost meanwhile
+            df = existing\
+                .join(df.select(keys).distinct(), on=keys, how="left_anti")\
+                .unionByName(df)\
+                .checkpoint()
+
+    if layout.get("repartition"):
+        df = df.repartition(*layout["repartition"])
+    if layout.get("sort") and not layout.get("buckets"):
+        df = df.sortWithinPartitions(*layout["sort"])
+
+    writer = df.write.mode('overwrite')
+    if layout.get("max_records"):
+        writer = writer.option("maxRecordsPerFile", layout["max_records"])
+    if partitions:
+        writer = writer.partitionBy(partitions)
+
+    if layout.get("buckets"):
+        # bucketing needs the table in a catalog, it is kept at the same path
+        writer = writer.bucketBy(layout["buckets"], *layout["bucket_by"])
+        if layout.get("sort"):
+            writer = writer.sortBy(*layout["sort"])
+        writer.option("path", path).saveAsTable(os.path.basename(path.rstrip("/")), format="parquet")
+    else:
+        writer.parquet(path)
+
+    return written
+
+
+def last_run(spark, output_data):
+    """Looks up the latest run in the run manifest
+
+    Args:
+        spark - object for the spark session
+        output_data - location of the tables and their _runs manifest
+
+    Returns:
+        run - Row of the latest run, None before the first run
+    """
+    runs = os.path.join(output_data, "_runs")
+    if not list_files(spark, os.path.join(runs, "*.json")):
+        return None
+    return spark.read.json(runs, schema=RUN_SCHEMA).orderBy(col("started_at").desc()).first()
+
+
+def record_run(spark, output_data, run):
+    """Appends a run to the run manifest, a json lines folder next to the
+    tables that is ignored by reads of the tables
+
+    Args:
+        spark - object for the spark session
+        output_data - location of the tables
+        run - dict of the run, the tables entry is stored as a json string
+
+    Returns:
+        None
+    """
+    run = dict(run, tables=json.dumps(run["tables"]), skewed_keys=json.dumps(run.get("skewed_keys")))
+    columns = [column.split()[0] for column in RUN_SCHEMA.split(", ")]
+    spark.createDataFrame([tuple(run[column] for column in columns)], RUN_SCHEMA)\
+    .coalesce(1)\
+    .write\
+    .mode('append')\
+    .json(os.path.join(output_data, "_runs"))
+
+
+def process_song_data(spark, input_data, output_data, quarantine=None, compacted_data=None, modified_since=None,
+                      run_manifest=None, songs_layout="year_artist", song_file_records=None,
+                      song_file_size=SONG_FILE_SIZE, keep_tables=False):
     """Reads the songs json files and creates parquet files of songs and artists
 
     Args:
         spark - object for the spark session
         input_data - S3 bucket endpoint for the input data
         output_data - S3 bucket endpoint for the output data
+        quarantine - location malformed records are written to, see read_json
+        compacted_data - location of the compacted layer read instead of the
+                         raw json when given
+        modified_since - incremental mode, only the song files modified at or
+                         after this epoch time in seconds are read and merged
+                         into the songs and artists tables
+        run_manifest - optional dict the partitions written are recorded in
+        songs_layout - how the songs table files are laid out, a key of SONG_LAYOUTS
+        song_file_records - largest number of rows in a songs parquet file,
+                            worked out from song_file_size when None
+        song_file_size - parquet bytes targeted for each songs file
+        keep_tables - keep the songs and artists tables cached and return
+                      them for process_log_data, the caller unpersists them
+                      once it is done with them, see release_tables
 
     Returns:
-        None
+        tables - (songs_table, artists_table) cached when keep_tables is set,
+                 None otherwise or in incremental mode, where the tables only
+                 hold the changed songs
     """
-    # get filepath to song data file
-    song_data = os.path.join(input_data, "song-data/*/*/*/*.json")
-    
-    # read song data file
-    df = spark.read.json(song_data, encoding='UTF-8')
+    incremental = modified_since is not None
+    keep_tables = keep_tables and not incremental
+    if incremental and compacted_data is None:
+        # read the song files changed since the last run
+        paths = [path for path, _ in list_files(spark, os.path.join(input_data, RAW_DATA["song"]), modified_since)]
+        if not paths:
+            return None
+        df = read_json(spark, paths, "song", quarantine)
+    else:
+        # read song data file
+        df = read_input(spark, input_data, "song", quarantine, compacted_data)
+
+    # both tables are built from the song records, read them once
+    if keep_tables:
+        df = df.persist(StorageLevel.MEMORY_AND_DISK)
 
     print(df.count())
 
@@ -57,13 +576,19 @@ def process_song_data(spark, input_data, output_data):
         col("year").cast("int").alias("year"),
         col("duration").cast("float").alias("duration")
     )
+    if keep_tables:
+        songs_table = songs_table.persist(StorageLevel.MEMORY_AND_DISK)
     
-    # write songs table to parquet files partitioned by year and artist
-    songs_table\
-    .write\
-    .partitionBy(["year", "artist_id"])\
-    .mode('overwrite')\
-    .parquet(os.path.join(output_data, "songs"))
+    # write songs table to parquet files in the chosen layout, by default
+    # partitioned by year and artist
+    songs_path = os.path.join(output_data, "songs")
+    if song_file_records is None:
+        song_file_records = records_per_file(spark, songs_path, song_file_size)
+    layout = dict(SONG_LAYOUTS[songs_layout], max_records=song_file_records)
+    written = write_table(spark, songs_table, songs_path, layout["partitions"],
+                          ["song_id"], incremental, layout)
+    if run_manifest is not None:
+        run_manifest["songs"] = written
     
     # extract columns to create artists table
     artists_table = df.select(
@@ -72,15 +597,38 @@ def process_song_data(spark, input_data, output_data):
         col("artist_location").alias("location"),
         col("artist_latitude").cast("float").alias("latitude"),
         col("artist_longitude").cast("float").alias("longitude")
-    ).drop_duplicates()
+    ).drop_duplicates(["artist_id"])
+    if keep_tables:
+        artists_table = artists_table.persist(StorageLevel.MEMORY_AND_DISK)
     
     # write artists table to parquet files
-    artists_table\
-    .write\
-    .mode('overwrite')\
-    .parquet(os.path.join(output_data, "artists"))
+    write_table(spark, artists_table, os.path.join(output_data, "artists"), keys=["artist_id"],
+                incremental=incremental)
+
+    if not keep_tables:
+        return None
 
-def process_log_data(spark, input_data, output_data):
+    # the tables were cached by their writes, the song records are no longer needed
+    df.unpersist()
+    return songs_table, artists_table
+
+
+def release_tables(tables):
+    """Unpersists the tables kept by process_song_data
+
+    Args:
+        tables - tables returned by process_song_data, or None
+
+    Returns:
+        None
+    """
+    for table in tables or []:
+        table.unpersist()
+
+
+def process_log_data(spark, input_data, output_data, date_time_method="native", quarantine=None,
+                     compacted_data=None, since=None, until=None, run_manifest=None, song_tables=None,
+                     songplays_join="broadcast", rollups=()):
     """Reads the songs json files and creates parquet files for time, users
     and the fact table songplays
 
@@ -88,37 +636,62 @@ def process_log_data(spark, input_data, output_data):
         spark - object for the spark session
         input_data - S3 bucket endpoint for the input data
         output_data - S3 bucket endpoint for the output data
+        date_time_method - how ts is converted to a timestamp, see with_date_time
+        quarantine - location malformed records are written to, see read_json
+        compacted_data - location of the compacted layer read instead of the
+                         raw json when given
+        since - incremental mode, first date of the log events read, they are
+                merged into the partitions of the tables they fall in
+        until - date after the last date of the log events read in incremental mode
+        run_manifest - optional dict the partitions written are recorded in
+        song_tables - (songs_table, artists_table) kept by process_song_data
+                      in the same session, the tables are read back from
+                      output_data when None, for example when the stages
+                      run separately
+        songplays_join - how song plays are joined to the song dimension,
+                         "broadcast" to send the dimension to every executor,
+                         "shuffle" to shuffle both sides and leave the skewed
+                         partitions to adaptive query execution, or "salted"
+                         to spread the plays of the hot keys over SALT_BUCKETS
+        rollups - keys of ROLLUPS built from the song plays in the same run,
+                  in incremental mode the rollup partitions of the months the
+                  new song plays fall in are rebuilt from the song_plays table
 
     Returns:
-        None
+        skewed - list of dicts of the most played join keys and their plays
     """
-    # get filepath to log data file
-    log_data = os.path.join(input_data, "log_data/*/*/*.json")
-
-    # read log data file
-    df = spark.read.json(log_data, encoding='UTF-8')
+    incremental = since is not None
+    if incremental:
+        df = read_log_window(spark, input_data, since, until, quarantine, compacted_data)
+    else:
+        # read log data file
+        df = read_input(spark, input_data, "log", quarantine, compacted_data)
     
     # filter by actions for song plays
     df = df.filter(df["page"] == "NextSong")
 
-    # extract columns for users table    
-    users_table = df.select(
-        col("userId").cast("int").alias("user_id"),
-        col("firstName").alias("first_name"),
-        col("lastName").alias("last_name"),
-        col("gender"),
-        col("level")
-    ).drop_duplicates() 
+    # create date_time column from original timestamp column
+    df = with_date_time(df, date_time_method)
+
+    # the users, time and songplays tables are all built from the song plays,
+    # keep them rather than reading and filtering the log files three times
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
+
+    # extract columns for users table, one row per user as of the user's last
+    # song play, aggregated on user_id alone so the level is the latest one
+    users_table = df\
+        .groupBy(col("userId").cast("int").alias("user_id"))\
+        .agg(max_value(struct("ts", "firstName", "lastName", "gender", "level")).alias("latest"))\
+        .select(
+            col("user_id"),
+            col("latest.firstName").alias("first_name"),
+            col("latest.lastName").alias("last_name"),
+            col("latest.gender").alias("gender"),
+            col("latest.level").alias("level")
+        )
     
     # write users table to parquet files
-    users_table\
-    .write\
-    .mode('overwrite')\
-    .parquet(os.path.join(output_data, "users"))
-
-    # create date_time column from original timestamp column
-    get_datetime = udf(lambda x: datetime.fromtimestamp(x/1000), TimestampType())
-    df = df.withColumn("date_time", get_datetime("ts"))
+    write_table(spark, users_table, os.path.join(output_data, "users"), keys=["user_id"], incremental=incremental)
   
     # extract columns to create time table
     time_table = df\
@@ -130,76 +703,340 @@ def process_log_data(spark, input_data, output_data):
     .withColumn("month", month(col("date_time")).cast("int"))\
     .withColumn("year", year(col("date_time")).cast("int"))\
     .withColumn("weekday", date_format(col("date_time"), "E"))\
-    .drop_duplicates()
+    .drop_duplicates(["start_time"])
 
     # Remove date_time from the dataframe
     time_table = time_table.drop(time_table.date_time)
    
     # write time table to parquet files partitioned by year and month
-    time_table\
-    .write\
-    .partitionBy(["year", "month"])\
-    .mode('overwrite')\
-    .parquet(os.path.join(output_data, "time"))
-
-    # read in song data to use for songplays table
-    song_df = spark.read.parquet(os.path.join(output_data, "songs"))
-
-    # Add a unique id
-    df = df.withColumn("songplay_id", expr("uuid()"))
-
-    # extract columns from joined song and log datasets to create songplays table 
-    songplays_table = df\
-        .join(
-           song_df,
-            on=((df.length == song_df.duration) & (df.song == song_df.title) & (df.artist == song_df.artist_id)),
-            how='left_outer'
-        )\
-        .join(
-            time_table,
-            on=(df.ts == time_table.start_time),
-            how='left_outer'
-        )\
+    written = write_table(spark, time_table, os.path.join(output_data, "time"), ["year", "month"],
+                          ["start_time"], incremental)
+    if run_manifest is not None:
+        run_manifest["time"] = written
+
+    # songs with their artist name, one row per title, artist name and duration
+    # so a song play matches at most one song
+    if song_tables is None:
+        song_tables = (
+            spark.read.parquet(os.path.join(output_data, "songs")),
+            spark.read.parquet(os.path.join(output_data, "artists"))
+        )
+    song_df = song_dimension(*song_tables)
+
+    # Add a unique id and the join keys
+    df = df\
+        .withColumn("songplay_id", expr("uuid()"))\
+        .withColumn("song_title", col("song"))\
+        .withColumn("artist_name", col("artist"))\
+        .withColumn("song_length", col("length").cast("float"))
+
+    # the most played songs, the keys the join is skewed on
+    skewed = skewed_keys(df)
+    for key in skewed:
+        print("skewed key: {song_title} by {artist_name} ({song_length}) played {count} times".format(**key))
+
+    # extract columns from joined song and log datasets to create songplays table,
+    # by default the song dimension is small enough to broadcast to every executor
+    # rather than shuffling the song plays, the year and month come from the song
+    # play's own timestamp rather than a join to the time table
+    if songplays_join == "broadcast":
+        joined = df.join(broadcast(song_df), on=JOIN_KEYS, how='left_outer')
+    elif songplays_join == "shuffle":
+        joined = df.join(song_df, on=JOIN_KEYS, how='left_outer')
+    else:
+        # a key is hot when it has more plays than a shuffle partition's share
+        share = df.count() / int(spark.conf.get("spark.sql.shuffle.partitions"))
+        joined = salted_join(spark, df, song_df, [key for key in skewed if key["count"] > share])
+
+    songplays_table = joined\
         .select(
-            df["songplay_id"],
-            df["ts"].alias('start_time'),
-            df["userId"].alias('user_id'),
-            df["level"],
-            song_df["song_id"],
-            song_df["artist_id"],
-            df["sessionId"].alias("session_id"),
-            df["location"],
-            df["useragent"].alias("user_agent"),
-            time_table["year"],
-            time_table["month"]
-        ).drop_duplicates()
+            col("songplay_id"),
+            col("ts").alias('start_time'),
+            col("userId").alias('user_id'),
+            col("level"),
+            col("song_id"),
+            col("artist_id"),
+            col("sessionId").alias("session_id"),
+            col("location"),
+            col("useragent").alias("user_agent"),
+            year(col("date_time")).cast("int").alias("year"),
+            month(col("date_time")).cast("int").alias("month")
+        )
+
+    # the rollups of a full run are built from the same song plays
+    if rollups and not incremental:
+        songplays_table = songplays_table.persist(StorageLevel.MEMORY_AND_DISK)
     
-    # write songplays table to parquet files partitioned by year and month
-    songplays_table\
-    .write\
-    .partitionBy(["year", "month"])\
-    .mode('overwrite')\
-    .parquet(os.path.join(output_data, "song_plays"))
+    # write songplays table to parquet files partitioned by year and month, a
+    # song play is identified by its user, session and time as songplay_id is
+    # generated on each run
+    written = write_table(spark, songplays_table, os.path.join(output_data, "song_plays"), ["year", "month"],
+                          ["start_time", "user_id", "session_id"], incremental)
+    if run_manifest is not None:
+        run_manifest["song_plays"] = written
+
+    if rollups:
+        plays = songplays_table
+        if incremental:
+            # every song play of the months this run wrote to
+            months = spark.createDataFrame([(month["year"], month["month"]) for month in written], "year int, month int")
+            plays = spark.read.parquet(os.path.join(output_data, "song_plays"))\
+                .join(broadcast(months), on=["year", "month"], how='left_semi')
+
+        for name in rollups:
+            rollup_written = write_table(spark, build_rollup(plays, ROLLUPS[name]), os.path.join(output_data, name),
+                                         ["year", "month"], incremental=incremental)
+            if run_manifest is not None:
+                run_manifest[name] = rollup_written
+
+        songplays_table.unpersist()
+
+    df.unpersist()
+    return skewed
+
+
+def build_rollup(plays, dimensions):
+    """Counts the song plays and their sessions by the dimensions of a rollup
+
+    Args:
+        plays - dataframe of the songplays table
+        dimensions - columns of the songplays table the plays are counted by,
+                     or "day" and "hour" for the day and hour they started in
+
+    Returns:
+        rollup - dataframe of the year, month, dimensions, plays and sessions,
+                 sessions is approximate
+    """
+    date_time = (col("start_time") / 1000).cast(TimestampType())
+    derived = {
+        "day": to_date(date_time),
+        "hour": date_trunc("hour", date_time)
+    }
+
+    return plays\
+        .groupBy(["year", "month"] + [derived[name].alias(name) if name in derived else col(name) for name in dimensions])\
+        .agg(
+            count(lit(1)).alias("plays"),
+            approx_count_distinct("session_id").alias("sessions")
+        )
+
+
+def skewed_keys(df, top=SKEW_REPORT_KEYS):
+    """Counts the song plays of each join key and reports the most played
+
+    Args:
+        df - song plays dataframe with the JOIN_KEYS columns
+        top - number of keys reported
+
+    Returns:
+        keys - list of dicts of the join key columns and the count of plays,
+               most played first
+    """
+    return [
+        row.asDict()
+        for row in df
+        .filter(col("song_title").isNotNull())
+        .groupBy(JOIN_KEYS)
+        .count()
+        .orderBy(col("count").desc())
+        .limit(top)
+        .collect()
+    ]
+
+
+def salted_join(spark, df, song_df, hot_keys, buckets=SALT_BUCKETS):
+    """Left joins the song plays to the song dimension on JOIN_KEYS, with the
+    plays of the hot keys spread over buckets random salts and the songs of
+    the hot keys copied into every bucket, so no one task joins every play of
+    a popular song
+
+    Args:
+        spark - object for the spark session
+        df - song plays dataframe with the JOIN_KEYS columns
+        song_df - song dimension, see song_dimension
+        hot_keys - list of dicts of the join keys to salt, see skewed_keys
+        buckets - number of salts of a hot key
+
+    Returns:
+        joined - the song plays with the song dimension columns
+    """
+    hot = spark.createDataFrame(
+        [tuple(key[column] for column in JOIN_KEYS) for key in hot_keys],
+        song_df.select(JOIN_KEYS).schema
+    ).withColumn("hot", lit(True))
+
+    plays = df\
+        .join(broadcast(hot), on=JOIN_KEYS, how='left_outer')\
+        .withColumn("salt", when(col("hot"), floor(rand() * buckets)).otherwise(0))\
+        .drop("hot")
+
+    songs = song_df\
+        .join(broadcast(hot), on=JOIN_KEYS, how='left_outer')\
+        .withColumn("salt", explode(
+            when(col("hot"), array([lit(salt) for salt in range(buckets)])).otherwise(array(lit(0)))
+        ))\
+        .drop("hot")
+
+    return plays.join(songs, on=JOIN_KEYS + ["salt"], how='left_outer').drop("salt")
+
+
+def song_dimension(songs_table, artists_table):
+    """Joins the songs to their artist's name, the keys song plays are
+    matched to songs on
+
+    Args:
+        songs_table - dataframe of the songs table
+        artists_table - dataframe of the artists table
+
+    Returns:
+        song_df - dataframe of song_id, artist_id and the JOIN_KEYS columns,
+                  unique on JOIN_KEYS
+    """
+    return songs_table\
+        .join(artists_table.select("artist_id", "name"), on="artist_id")\
+        .select(
+            col("song_id"),
+            col("artist_id"),
+            col("title").alias("song_title"),
+            col("name").alias("artist_name"),
+            col("duration").alias("song_length")
+        )\
+        .drop_duplicates(JOIN_KEYS)
+
+
+def parse_date(value):
+    """Parses a YYYY-MM-DD date
 
-def main():
+    Args:
+        value - date text
+
+    Returns:
+        date
+    """
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def main(input_data="s3a://udacity-dend/", output_data="s3a://ud-daeng-output/", date_time_method="native",
+         quarantine=None, compacted_data=None, compact=False, target_file_size=TARGET_FILE_SIZE, incremental=False,
+         since=None, until=None, songs_layout="year_artist", song_file_records=None, song_file_size=SONG_FILE_SIZE,
+         stages=("songs", "logs"), songplays_join="broadcast", rollups=()):
     """Sets up the input and output data paths
     Calls process_song_data and process_log_data to read
     the song and log files, clean the data, transform to requirements
     and write as parquet files to the output S3 bucket
+    Records the run in the run manifest
 
     Args:
-        None
+        input_data - location of the song and log json files, S3 or a local path
+        output_data - location the tables are written to, S3 or a local path
+        date_time_method - how ts is converted to a timestamp, see with_date_time
+        quarantine - location malformed records are written to, see read_json
+        compacted_data - location of the compacted layer, read instead of the
+                         raw json when given
+        compact - compact the raw files not yet compacted into compacted_data
+                  before processing
+        target_file_size - json bytes read into each compacted file
+        incremental - only read the song files changed and the log events of
+                      the days since the last run, and replace only the
+                      partitions they fall in
+        since - first date of the log events read in incremental mode, the
+                until date of the last run when None
+        until - date after the last date read in incremental mode, today
+                (UTC) when None so only complete days are read
+        songs_layout - how the songs table files are laid out, a key of SONG_LAYOUTS
+        song_file_records - largest number of rows in a songs parquet file,
+                            worked out from song_file_size when None
+        song_file_size - parquet bytes targeted for each songs file
+        stages - stages run, when both run the log stage joins the songs and
+                 artists tables kept in memory by the song stage, the log
+                 stage on its own reads them from output_data
+        songplays_join - how song plays are joined to the songs, see process_log_data
+        rollups - keys of ROLLUPS built with the song plays
 
     Returns:
         None
     """
-    spark = create_spark_session()
-    input_data = "s3a://udacity-dend/"
-    output_data = "s3a://ud-daeng-output/"
-    
-    songs_table = process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    # a local run, such as one over the datagen.py output, needs neither dl.cfg nor hadoop-aws
+    s3 = uses_s3(input_data, output_data, quarantine, compacted_data)
+    if s3:
+        set_aws_credentials()
+    spark = create_spark_session(partition_overwrite="dynamic" if incremental else "static", s3=s3)
+    run = {"started_at": time.time(), "incremental": incremental, "songs_since": None, "since": None,
+           "until": None, "tables": {}}
+
+    if compact:
+        for record in ["song", "log"]:
+            files = compact_data(spark, input_data, compacted_data, record, target_file_size, quarantine)
+            print("{} {} files compacted".format(files, record))
+
+    if incremental:
+        # the tables merged by write_table are checkpointed next to them
+        spark.sparkContext.setCheckpointDir(os.path.join(output_data, "_checkpoints"))
+
+        # the watermark of the log events and song files is where the last run stopped
+        previous = last_run(spark, output_data)
+        if previous is not None:
+            run["songs_since"] = previous.started_at
+            if since is None and previous.until:
+                since = parse_date(previous.until)
+        # today's events are still arriving, the window stops at the last complete day
+        until = until or datetime.utcnow().date()
+        run["since"] = since and since.isoformat()
+        run["until"] = until.isoformat()
+
+    song_tables = None
+    if "songs" in stages:
+        song_tables = process_song_data(spark, input_data, output_data, quarantine, compacted_data,
+                                        run["songs_since"], run["tables"], songs_layout, song_file_records,
+                                        song_file_size, keep_tables="logs" in stages)
+    if "logs" in stages:
+        run["skewed_keys"] = process_log_data(spark, input_data, output_data, date_time_method, quarantine,
+                                              compacted_data, since if incremental else None, until, run["tables"],
+                                              song_tables, songplays_join, rollups)
+    release_tables(song_tables)
+
+    run["finished_at"] = time.time()
+    record_run(spark, output_data, run)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Load the Sparkify song and log data into the data lake")
+    parser.add_argument("--input", default="s3a://udacity-dend/", help="location of the song and log json files")
+    parser.add_argument("--output", default="s3a://ud-daeng-output/", help="location the tables are written to")
+    parser.add_argument("--date-time", choices=["native", "pandas"], default="native",
+                        help="convert ts with a native Spark expression or a pandas UDF")
+    parser.add_argument("--quarantine", metavar="PATH",
+                        help="strict mode, write records that do not match their schema to this location")
+    parser.add_argument("--compacted", metavar="PATH",
+                        help="read the song and log records from the compacted layer at this location")
+    parser.add_argument("--compact", action="store_true",
+                        help="compact the new raw files into the compacted layer before processing")
+    parser.add_argument("--target-file-mb", type=int, default=TARGET_FILE_SIZE // (1024 * 1024),
+                        help="megabytes of json read into each compacted file")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process the data since the last run and replace the partitions it falls in")
+    parser.add_argument("--since", type=parse_date, help="first date of the log events read in incremental mode")
+    parser.add_argument("--until", type=parse_date, help="date after the last date read in incremental mode")
+    parser.add_argument("--songs-layout", choices=sorted(SONG_LAYOUTS), default="year_artist",
+                        help="how the songs table files are laid out")
+    parser.add_argument("--song-file-mb", type=int, default=SONG_FILE_SIZE // (1024 * 1024),
+                        help="megabytes of parquet targeted for each songs file")
+    parser.add_argument("--song-file-records", type=int,
+                        help="largest number of rows in a songs parquet file, instead of --song-file-mb")
+    parser.add_argument("--stages", nargs="+", choices=["songs", "logs"], default=["songs", "logs"],
+                        help="stages run, the log stage on its own reads the songs and artists tables back")
+    parser.add_argument("--songplays-join", choices=["broadcast", "shuffle", "salted"], default="broadcast",
+                        help="join the song plays to a broadcast song dimension, with a shuffle or a salted shuffle")
+    parser.add_argument("--rollups", nargs="*", choices=sorted(ROLLUPS), default=[],
+                        help="rollup tables built with the song plays")
+    args = parser.parse_args()
+
+    if args.compact and not args.compacted:
+        parser.error("--compact needs the --compacted location")
+
+    main(input_data=args.input, output_data=args.output, date_time_method=args.date_time,
+         quarantine=args.quarantine, compacted_data=args.compacted, compact=args.compact,
+         target_file_size=args.target_file_mb * 1024 * 1024, incremental=args.incremental,
+         since=args.since, until=args.until, songs_layout=args.songs_layout,
+         song_file_records=args.song_file_records, song_file_size=args.song_file_mb * 1024 * 1024, stages=args.stages, songplays_join=args.songplays_join,
+         rollups=args.rollups)
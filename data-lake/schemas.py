@@ -0,0 +1,71 @@
+from pyspark.sql.types import StructType, StructField, StringType, DoubleType, LongType
+
+# column the JSON reader puts the text of a malformed record in
+CORRUPT_RECORD = "_corrupt_record"
+
+# versions of the song-data records, one record per file
+SONG_SCHEMAS = {
+    1: StructType([
+        StructField("artist_id", StringType()),
+        StructField("artist_latitude", DoubleType()),
+        StructField("artist_location", StringType()),
+        StructField("artist_longitude", DoubleType()),
+        StructField("artist_name", StringType()),
+        StructField("duration", DoubleType()),
+        StructField("num_songs", LongType()),
+        StructField("song_id", StringType()),
+        StructField("title", StringType()),
+        StructField("year", LongType())
+    ])
+}
+
+# versions of the log_data records, one event per line, userId is a string as
+# it is empty for logged out events
+LOG_SCHEMAS = {
+    1: StructType([
+        StructField("artist", StringType()),
+        StructField("auth", StringType()),
+        StructField("firstName", StringType()),
+        StructField("gender", StringType()),
+        StructField("itemInSession", LongType()),
+        StructField("lastName", StringType()),
+        StructField("length", DoubleType()),
+        StructField("level", StringType()),
+        StructField("location", StringType()),
+        StructField("method", StringType()),
+        StructField("page", StringType()),
+        StructField("registration", DoubleType()),
+        StructField("sessionId", LongType()),
+        StructField("song", StringType()),
+        StructField("status", LongType()),
+        StructField("ts", LongType()),
+        StructField("userAgent", StringType()),
+        StructField("userId", StringType())
+    ])
+}
+
+SCHEMAS = {
+    "song": SONG_SCHEMAS,
+    "log": LOG_SCHEMAS
+}
+
+
+def get_schema(record, version=None, corrupt_record=False):
+    """Looks up the schema of a type of input record
+
+    Args:
+        record - "song" or "log"
+        version - schema version, the latest when None
+        corrupt_record - add the CORRUPT_RECORD column the reader fills for
+                         records that do not match the schema
+
+    Returns:
+        schema - StructType of the record
+    """
+    versions = SCHEMAS[record]
+    schema = versions[max(versions) if version is None else version]
+
+    if corrupt_record:
+        schema = StructType(schema.fields + [StructField(CORRUPT_RECORD, StringType())])
+
+    return schema
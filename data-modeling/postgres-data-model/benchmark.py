@@ -0,0 +1,290 @@
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import pandas as pd
+from datetime import timedelta
+from create_tables import create_database, drop_tables, create_schema
+from sql_queries import plays_per_user_per_month, plays_for_user_in_month, songs_for_user_in_month, \
+    busiest_user_month_select
+from song_index import SongIndex
+from reader import CHUNKSIZE, read_json_chunks
+from time_dimension import build_time_df
+from user_cache import latest_users
+from etl import transform_log_events, get_files, process_data, process_song_file, process_log_file, process_song_file_bulk, process_log_file_bulk
+
+
+def count_rows(cur):
+    """
+    - Arguments :
+        cur - Database Cursor
+
+    - Counts the rows loaded into each table of the star schema
+
+    - Return :
+        total number of rows across songplays, users, songs, artists and time
+    """
+    total = 0
+    for table in ['songplays', 'users', 'songs', 'artists', 'time']:
+        cur.execute("SELECT count(*) FROM {};".format(table))
+        total += cur.fetchone()[0]
+    return total
+
+
+def recreate_schema(profile='default'):
+    """
+    - Arguments :
+        profile - schema profile of create_tables, 'default' or 'performance'
+
+    - Recreates sparkifydb and the schema so every run starts from empty tables
+
+    - Return :
+        the cursor and connection to sparkifydb
+    """
+    cur, conn = create_database()
+    drop_tables(cur, conn)
+    create_schema(cur, conn, profile)
+    return cur, conn
+
+
+def run_load(song_func, log_func, batch_size=None, use_index=False):
+    """
+    - Arguments :
+        song_func  - function loading the song files
+        log_func   - function loading the log files
+        batch_size - files per batch for the bulk functions, None for the per row functions
+        use_index  - look songs up in a SongIndex rather than with one song_select per event
+
+    - Times the song and log loads, into a recreated schema, and counts the rows they produced
+
+    - Return :
+        tuple of rows loaded and seconds taken
+    """
+    cur, conn = recreate_schema()
+
+    kwargs = {'song_index': SongIndex()} if use_index else {}
+
+    start = time.perf_counter()
+    process_data(cur, conn, filepath='data/song_data', func=song_func, batch_size=batch_size, **kwargs)
+    process_data(cur, conn, filepath='data/log_data', func=log_func, batch_size=batch_size, **kwargs)
+    seconds = time.perf_counter() - start
+
+    rows = count_rows(cur)
+    conn.close()
+    return rows, seconds
+
+
+def make_log_file(size_mb):
+    """
+    - Arguments :
+        size_mb - size of the file to generate in megabytes
+
+    - Generates a large log file by repeating the lines of the log files in data/log_data
+
+    - Return :
+        path of the generated file, removed by the caller
+    """
+    lines = []
+    for filepath in get_files('data/log_data'):
+        with open(filepath) as f:
+            lines.extend(line if line.endswith('\n') else line + '\n' for line in f)
+    block = ''.join(lines)
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        for _ in range(max(1, size_mb * (1 << 20) // len(block))):
+            f.write(block)
+
+    return path
+
+
+def read_whole(path, chunksize):
+    """
+    - Reads the file whole and filters the NextSong events, as the loaders did before the
+      streaming reader, returning the NextSong row count and the peak RSS in kilobytes
+    """
+    df = pd.read_json(path, lines=True, orient='columns')
+    rows = len(df[df['page'] == 'NextSong'])
+    return rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def read_streamed(path, chunksize):
+    """
+    - Streams the file with read_json_chunks, returning the NextSong row count and the
+      peak RSS in kilobytes
+    """
+    rows = sum(len(df) for df in read_json_chunks([path], chunksize, page='NextSong'))
+    return rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def memory_benchmark(sizes_mb, chunksize=CHUNKSIZE):
+    """
+    - Arguments :
+        sizes_mb  - sizes of the generated log files in megabytes
+        chunksize - rows per batch of the streaming reader
+
+    - Reads generated log files of each size whole and streamed, each read in a fresh
+      process so its peak RSS is not hidden by an earlier, larger read
+
+    - Outputs the NextSong rows, seconds and peak RSS of each read
+    """
+    print('{:<10}{:<20}{:>12}{:>10}{:>14}'.format('size MB', 'reader', 'rows', 'seconds', 'peak RSS MB'))
+    for size_mb in sizes_mb:
+        path = make_log_file(size_mb)
+        try:
+            for name, func in [('whole file', read_whole), ('chunks of {}'.format(chunksize), read_streamed)]:
+                with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+                    start = time.perf_counter()
+                    rows, peak_kb = pool.apply(func, (path, chunksize))
+                    seconds = time.perf_counter() - start
+                print('{:<10}{:<20}{:>12}{:>10.2f}{:>14.0f}'.format(size_mb, name, rows, seconds, peak_kb / 1024))
+        finally:
+            os.remove(path)
+
+
+def time_query(cur, query, params=None, runs=5):
+    """
+    - Arguments :
+        cur    - Database Cursor
+        query  - the query to time
+        params - the query parameters
+        runs   - number of times to run the query
+
+    - Return :
+        the fastest run in milliseconds
+    """
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        cur.execute(query, params)
+        cur.fetchall()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def query_benchmark(batch_size=100, runs=5):
+    """
+    - Arguments :
+        batch_size - files per bulk load batch
+        runs       - number of times each query is run, the fastest run is reported
+
+    - Loads the data into the default schema and into the performance profile, with
+      songplays partitioned by month and the supporting indexes
+
+    - Outputs the time of the "plays per user per month" queries against each schema, for
+      the busiest user and month of the data
+    """
+    queries = [('plays per user per month', plays_per_user_per_month, False),
+               ('plays for a user in a month', plays_for_user_in_month, True),
+               ('songs for a user in a month', songs_for_user_in_month, True)]
+
+    timings = {}
+    for profile in ['default', 'performance']:
+        cur, conn = recreate_schema(profile)
+        kwargs = {'song_index': SongIndex()}
+        process_data(cur, conn, filepath='data/song_data', func=process_song_file_bulk, batch_size=batch_size, **kwargs)
+        process_data(cur, conn, filepath='data/log_data', func=process_log_file_bulk, batch_size=batch_size, **kwargs)
+
+        conn.autocommit = True
+        cur.execute("ANALYZE;")
+        cur.execute(busiest_user_month_select)
+        user_id, month = cur.fetchone()
+        params = (user_id, month, (month + timedelta(days=32)).replace(day=1))
+
+        for name, query, parameterized in queries:
+            timings[(name, profile)] = time_query(cur, query, params if parameterized else None, runs)
+        conn.close()
+
+    print('{:<30}{:>14}{:>14}{:>10}'.format('query', 'default ms', 'perf ms', 'speed up'))
+    for name, _, _ in queries:
+        default, performance = timings[(name, 'default')], timings[(name, 'performance')]
+        print('{:<30}{:>14.2f}{:>14.2f}{:>9.1f}x'.format(name, default, performance, default / performance))
+
+
+def transform_benchmark(max_ms=None, runs=5):
+    """
+    - Arguments :
+        max_ms - when given, the largest mean per file transform time in milliseconds
+        runs   - number of times every file is transformed, the fastest run is kept
+
+    - Times the columnar log transform of every log file, without a database: the typed
+      columns and start_time of transform_log_events, the time rows and the latest users
+
+    - Outputs the mean, 95th percentile and slowest per file transform time, and exits with
+      an error when the mean is over max_ms so the check can gate a CI job
+
+    - Return :
+        the mean per file transform time in milliseconds
+    """
+    timings = []
+    for filepath in get_files('data/log_data'):
+        batches = list(read_json_chunks([filepath], page='NextSong'))
+
+        best = None
+        for _ in range(runs):
+            start = time.perf_counter()
+            for df in batches:
+                df = transform_log_events(df)
+                build_time_df(df['start_time'])
+                latest_users(df)
+            elapsed = (time.perf_counter() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append(best)
+
+    timings = pd.Series(timings)
+    print('{} files, per file transform ms: mean {:.2f}, p95 {:.2f}, max {:.2f}'.format(
+        len(timings), timings.mean(), timings.quantile(0.95), timings.max()))
+
+    if max_ms is not None and timings.mean() > max_ms:
+        sys.exit('mean per file transform time {:.2f}ms is over {:.2f}ms'.format(timings.mean(), max_ms))
+
+    return timings.mean()
+
+
+def main(batch_size=100):
+    """
+    - Loads the data once with one insert per row, once more using the song index for the
+      song lookups and once with COPY and set based merges
+
+    - Outputs the rows/sec of each load path and the speed up of the bulk path
+    """
+    results = [
+        ('row by row', run_load(process_song_file, process_log_file)),
+        ('row by row, song index', run_load(process_song_file, process_log_file, use_index=True)),
+        ('bulk (COPY, batch of {})'.format(batch_size),
+         run_load(process_song_file_bulk, process_log_file_bulk, batch_size=batch_size, use_index=True))
+    ]
+
+    print('{:<30}{:>10}{:>10}{:>12}'.format('load path', 'rows', 'seconds', 'rows/sec'))
+    for name, (rows, seconds) in results:
+        print('{:<30}{:>10}{:>10.2f}{:>12.0f}'.format(name, rows, seconds, rows / seconds))
+
+    (_, row_seconds), (_, bulk_seconds) = results[0][1], results[-1][1]
+    print('bulk load speed up: {:.1f}x'.format(row_seconds / bulk_seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the sparkifydb load paths')
+    parser.add_argument('batch_size', type=int, nargs='?', default=100, help='files per bulk load batch')
+    parser.add_argument('--memory', type=int, nargs='+', metavar='SIZE_MB',
+                        help='compare the peak memory of whole file and streamed reads of generated log files')
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help='rows per batch of the streaming reader')
+    parser.add_argument('--queries', action='store_true',
+                        help='compare the analytic queries against the default and performance schema profiles')
+    parser.add_argument('--transform', action='store_true',
+                        help='time the columnar log transform of every log file, without a database')
+    parser.add_argument('--max-ms', type=float, help='fail --transform when the mean per file time is over this')
+    args = parser.parse_args()
+
+    if args.transform:
+        transform_benchmark(args.max_ms)
+    elif args.memory:
+        memory_benchmark(args.memory, args.chunksize)
+    elif args.queries:
+        query_benchmark(args.batch_size)
+    else:
+        main(args.batch_size)
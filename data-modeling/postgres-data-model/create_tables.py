@@ -1,10 +1,14 @@
+import argparse
+from datetime import date
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, performance_create_table_queries, \
+    songplay_partition_create, songplay_default_partition_create, performance_indexes, index_drop, index_exists_select
 
 
-def create_database():
+def create_database(reset=True):
     """
-    - Creates and connects to the sparkifydb
+    - Creates and connects to the sparkifydb, when reset is False an existing
+      sparkifydb is kept rather than dropped and recreated
     - Returns the connection and cursor to sparkifydb
     """
     
@@ -14,8 +18,11 @@ def create_database():
     cur = conn.cursor()
     
     # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = 'sparkifydb'")
+    exists = cur.fetchone() is not None
+    if reset or not exists:
+        cur.execute("DROP DATABASE IF EXISTS sparkifydb")
+        cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
 
     # close connection to default database
     conn.close()    
@@ -40,11 +47,13 @@ def drop_tables(cur, conn):
             print(e)
         conn.commit()
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, profile='default'):
     """
-    Creates each table using the queries in `create_table_queries` list. 
+    Creates each table using the queries in `create_table_queries` list, or the
+    `performance_create_table_queries` list for the performance profile.
     """
-    for query in create_table_queries:
+    queries = performance_create_table_queries if profile == 'performance' else create_table_queries
+    for query in queries:
         print(query)
         try:
             cur.execute(query)
@@ -54,9 +63,91 @@ def create_tables(cur, conn):
         conn.commit()
 
 
-def main():
+def create_partitions(cur, conn, start, end):
     """
-    - Drops (if exists) and Creates the sparkify database. 
+    - Arguments :
+        cur   - Database Cursor
+        conn  - database connection
+        start - first month to partition, as YYYY-MM
+        end   - last month to partition, as YYYY-MM
+    
+    - Creates a songplays partition for every month from start to end, and the default
+      partition for events outside them
+    
+    - A month has to be partitioned before its events are loaded, once they are in the
+      default partition the month's partition can no longer be created
+    """
+    year, month = [int(part) for part in start.split('-')]
+    end_year, end_month = [int(part) for part in end.split('-')]
+
+    while (year, month) <= (end_year, end_month):
+        next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+        cur.execute(songplay_partition_create.format(start=date(year, month, 1), end=date(next_year, next_month, 1)))
+        year, month = next_year, next_month
+
+    cur.execute(songplay_default_partition_create)
+    conn.commit()
+
+
+def create_indexes(cur, conn, names=None):
+    """
+    - Arguments :
+        cur   - Database Cursor
+        conn  - database connection
+        names - the performance indexes to create, all of them by default
+    
+    - Creates the supporting indexes of the performance profile
+    """
+    for name in names if names is not None else performance_indexes:
+        cur.execute(performance_indexes[name])
+    conn.commit()
+
+
+def drop_indexes(cur, conn):
+    """
+    - Arguments :
+        cur  - Database Cursor
+        conn - database connection
+    
+    - Drops the performance indexes that exist, so a bulk load does not maintain them row
+      by row
+    
+    - Return :
+        names of the dropped indexes, to rebuild with create_indexes once the load completes
+    """
+    cur.execute(index_exists_select, (list(performance_indexes),))
+    names = [name for name, in cur.fetchall()]
+    for name in names:
+        cur.execute(index_drop.format(name))
+    conn.commit()
+    return names
+
+
+def create_schema(cur, conn, profile='default', months=('2018-01', '2019-12')):
+    """
+    - Arguments :
+        cur     - Database Cursor
+        conn    - database connection
+        profile - 'default', or 'performance' to partition songplays by month and add the
+                  supporting indexes
+        months  - first and last month to create songplays partitions for
+    
+    - Creates all tables needed, and for the performance profile the partitions and indexes
+    """
+    create_tables(cur, conn, profile)
+    if profile == 'performance':
+        create_partitions(cur, conn, *months)
+        create_indexes(cur, conn)
+
+
+def main(reset=True, profile='default', months=('2018-01', '2019-12')):
+    """
+    - Drops (if exists) and Creates the sparkify database. When reset is False the
+      database, its tables and the load manifest are kept so etl.py can load incrementally,
+      only missing tables are created.
+    
+    - With the performance profile songplays is range partitioned by month on start_time,
+      over the given months, and the supporting indexes are created.
     
     - Establishes connection with the sparkify database and gets
     cursor to it.  
@@ -67,13 +158,22 @@ def main():
     
     - Finally, closes the connection. 
     """
-    cur, conn = create_database()
+    cur, conn = create_database(reset)
     
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    if reset:
+        drop_tables(cur, conn)
+    create_schema(cur, conn, profile, months)
 
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Create the sparkifydb schema')
+    parser.add_argument('--keep', action='store_true', help='keep the existing database, tables and load manifest')
+    parser.add_argument('--profile', choices=['default', 'performance'], default='default',
+                        help='performance partitions songplays by month and adds supporting indexes')
+    parser.add_argument('--months', nargs=2, metavar=('START', 'END'), default=('2018-01', '2019-12'),
+                        help='first and last month (YYYY-MM) to partition songplays for')
+    args = parser.parse_args()
+
+    main(reset=not args.keep, profile=args.profile, months=args.months)
\ No newline at end of file
@@ -1,15 +1,42 @@
 import os
+import io
 import glob
+import time
+import argparse
+import multiprocessing
+from functools import partial
 import psycopg2
+import psycopg2.pool
 import pandas as pd
 from sql_queries import *
+from song_index import SongIndex
+from manifest import pending_files, record_files
+from time_dimension import TimeCache, build_time_df, calendar_rows
+from reader import CHUNKSIZE, read_json_chunks
+from user_cache import UserCache, latest_users
+from create_tables import create_indexes, drop_indexes
+from metrics import metrics, MetricsCursor
 
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
 
-def process_song_file(cur, filepath):
+# attempts at a file when concurrent workers deadlock on the same users or time rows
+DEADLOCK_RETRIES = 3
+
+# types of the log event columns used by the loaders, low cardinality text is categorical
+LOG_COLUMN_TYPES = {'ts': 'int64', 'userId': 'int64', 'sessionId': 'int64', 'length': 'float64',
+                    'level': 'category', 'gender': 'category'}
+
+# connection pool and keyword arguments of a parallel ingestion worker process
+worker_pool = None
+worker_kwargs = {}
+
+
+def process_song_file(cur, filepath, song_index=None):
     """
     - Arguments :
-        cur      - Database Cursor
-        filepath - location of JSON Files
+        cur        - Database Cursor
+        filepath   - location of JSON Files
+        song_index - optional SongIndex kept up to date with the loaded songs
     
     - Opens JSON song files and reads in the data
     
@@ -17,105 +44,310 @@ def process_song_file(cur, filepath):
     
     - Inserts the artist data
     
+    - Adds the song to the song index
+    
     - Closes the connection. 
     
     - Return :
-        none
+        number of songs loaded
     """
-    # open song file
-    df = pd.read_json(filepath, lines=True, orient='columns')
+    # open song file, only its first record is loaded
+    df = next(read_json_chunks([filepath], chunksize=1))
 
     # insert song record
     song_data = df[['song_id','title','artist_id','year','duration']].values[0]
     cur.execute(song_table_insert, song_data)
-     
+    metrics.rows('songs', 1, cur.rowcount)
+
     # insert artist record
     artist_data = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]].values[0]
     cur.execute(artist_table_insert, artist_data)
+    metrics.rows('artists', 1, cur.rowcount)
+
+    if song_index is not None:
+        song_index.add(df.iloc[:1])
+
+    return 1
 
-def process_log_file(cur, filepath):
+def process_log_file(cur, filepath, song_index=None, time_cache=None, user_cache=None, chunksize=CHUNKSIZE):
     """
     - Arguments :
-        cur      - Database Cursor
-        filepath - location of JSON Files
+        cur        - Database Cursor
+        filepath   - location of JSON Files
+        song_index - optional SongIndex used in place of one song_select query per event
+        time_cache - optional TimeCache of the timestamps already sent to the time table
+        user_cache - optional UserCache snapshot of the level of every user in the users table
+        chunksize  - number of NextSong events read and loaded at a time
+    
+    - Deletes the song plays loaded from an earlier version of the file, so a file that
+      changed since it was loaded is not counted twice
+    
+    - Streams the JSON log file chunksize NextSong events at a time and loads each batch
+      with insert_log_events
     
-    - Opens JSON log files and reads in the data
+    - Return :
+        number of song plays loaded
+    """
+    cur.execute(songplay_source_delete, ([filepath],))
+
+    rows = 0
+    for df in read_json_chunks([filepath], chunksize, page='NextSong', source=True):
+        rows += insert_log_events(cur, df, song_index, time_cache, user_cache)
+
+    return rows
+
+
+def transform_log_events(df):
+    """
+    - Arguments :
+        df - batch of NextSong events as read from the log files
+    
+    - Converts the columns to their types, a column at a time rather than a value at a time
+    
+    - Converts the ts column to a start_time timestamp column once for the whole batch
+    
+    - Return :
+        the typed events with the added start_time column
+    """
+    df = df.astype(LOG_COLUMN_TYPES)
+    df['start_time'] = pd.to_datetime(df['ts'], unit='ms')
+    return df
+
+
+def insert_log_events(cur, df, song_index=None, time_cache=None, user_cache=None):
+    """
+    - Arguments :
+        cur        - Database Cursor
+        df         - batch of NextSong events from a log file, with their source_file
+        song_index - optional SongIndex used in place of one song_select query per event
+        time_cache - optional TimeCache of the timestamps already sent to the time table
+        user_cache - optional UserCache snapshot of the level of every user in the users table
     
-    - Transforms the ts field into a timestamp and extracts the hour, day, week, month, year, weekday info from it
+    - Transforms the batch with transform_log_events and extracts the hour, day, week, month, year, weekday info
+      from the timestamps
     
-    - Inserts the timestamp and time extracts into the time table
+    - Inserts the timestamps not yet in the time cache and their time extracts into the time table, in one batch
     
-    - Inserts users into the user table
+    - Inserts the latest state of each user in the batch into the user table, only the users that are
+      new or whose level changed when a user cache is given
     
-    - Uses the song title, artist name and song duration to lookup the already loaded artist_id and song_id from artists and songs
+    - Uses the song title, artist name and song duration to lookup the already loaded artist_id and song_id from artists and songs,
+      with one merge against the song index for the whole batch when one is given
     
     - Adds the song_id and artist_id into the remaining log file data columns for insert into songplay
     
     - Return :
-        none
+        number of song plays loaded
     """
-    
-    # open log file
-    #print (filepath)
-    df = pd.read_json(filepath, lines=True, orient='columns')
+    with metrics.timer('transform'):
+        # convert the columns to their types and the timestamp column to datetime
+        df = transform_log_events(df)
 
-    # filter by NextSong action
-    df = df[df['page'].str.match('NextSong')]
+        # time data records
+        time_df = build_time_df(df['start_time'])
+        if time_cache is not None:
+            time_df = time_cache.unseen(time_df)
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'], unit='ms')
-    
-    # insert time data records
-    time_data = pd.concat([t,t.dt.hour, t.dt.day, t.dt.weekofyear, t.dt.month, t.dt.year, t.dt.weekday],sort=True,axis=1)
-    column_labels = ['start_time','hour','day','week','month','year','weekday'] 
-    time_df = pd.DataFrame(time_data.values,columns=column_labels)
+        # user table, one row per user as of the user's last event
+        user_df = latest_users(df)
+        if user_cache is not None:
+            user_df = user_cache.changed(user_df)
+
+        # get songid and artistid for every event from the song index
+        if song_index is not None:
+            found = song_index.resolve(df)
+            metrics.lookups(int(found['song_id'].notna().sum()), len(df))
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+        # the timestamps of the songplay records converted for the whole column at once
+        start_times = df['start_time'].astype(object)
 
-    # load user table
-    user_df = df[['userId','firstName','lastName','gender','level']]
+    # insert time data records
+    bulk_load(cur, 'time', time_df)
 
     # insert user records
     for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+        cur.execute(user_table_insert, list(row))
+        metrics.rows('users', 1, cur.rowcount)
 
     # insert songplay records
     for index, row in df.iterrows():
         
         # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            print (results)
-            songid, artistid = results
+        if song_index is not None:
+            songid, artistid = found.at[index, 'song_id'], found.at[index, 'artist_id']
         else:
-            songid, artistid = None, None
+            cur.execute(song_select, (row.song, row.artist, row.length))
+            results = cur.fetchone()
+        
+            if results:
+                songid, artistid = results
+            else:
+                songid, artistid = None, None
+            metrics.lookups(1 if results else 0, 1)
 
         # insert songplay record
-        songplay_data = songplay_data = (pd.to_datetime(row.ts, unit='ms').to_pydatetime(), row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
+        songplay_data = (start_times[index], row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent,
+                         row.source_file)
         cur.execute(songplay_table_insert, songplay_data)
+        metrics.rows('songplays', 1, cur.rowcount)
 
+    return len(df)
 
-def process_data(cur, conn, filepath, func):
+
+def bulk_load(cur, table, df):
     """
     - Arguments :
-        cur      - Database Cursor
-        conn     - database connection
-        filepath - location of JSON Files
-        func     - the funciton to be called based on the filepath
+        cur   - Database Cursor
+        table - star schema table to load, a key of bulk_load_queries
+        df    - batch of rows, columns in the order of the staging table
     
-    - walks the given filepath and returns a list of .json files on that path
+    - Creates the session's staging table for the given table if needed and empties it
     
-    - Outputs the number of .json files on the path
+    - Streams the batch into the staging table with COPY FROM STDIN
     
-    - Iterates through the .json files on the filepath passing the filename to the passed in function name
+    - Merges the staging table into the star schema table with a single INSERT ... SELECT
+      using the same ON CONFLICT rule as the single row insert
     
-    - Commits the transaction after each file has been processed
-       
     - Return :
-        none
+        number of rows streamed into the staging table
+    """
+    staging_table, staging_create, merge = bulk_load_queries[table]
+    cur.execute(staging_create)
+    cur.execute("TRUNCATE {};".format(staging_table))
+
+    # psycopg2 sends a float NaN as 'NaN', keep that rather than letting to_csv write NULL
+    df = df.copy()
+    for column in df.select_dtypes(include='float').columns:
+        df[column] = df[column].astype(object).where(df[column].notna(), 'NaN')
+
+    buffer = io.StringIO()
+    df.to_csv(buffer, header=False, index=False, na_rep='\\N')
+    buffer.seek(0)
+    cur.copy_expert(staging_copy.format(staging_table), buffer)
+
+    cur.execute(merge)
+    metrics.rows(table, len(df), cur.rowcount)
+    return len(df)
+
+
+def process_song_file_bulk(cur, filepaths, song_index=None, chunksize=CHUNKSIZE):
+    """
+    - Arguments :
+        cur        - Database Cursor
+        filepaths  - list of JSON song file locations loaded as one batch
+        song_index - optional SongIndex kept up to date with the loaded songs
+        chunksize  - number of songs read and loaded at a time
+    
+    - Streams the JSON song files of the batch chunksize songs at a time
+    
+    - Bulk loads the songs and then the artists of each chunk, adding the songs to the song index
+    
+    - Return :
+        number of songs loaded
+    """
+    rows = 0
+    for df in read_json_chunks(filepaths, chunksize):
+        song_df = df[['song_id','title','artist_id','year','duration']].drop_duplicates('song_id')
+        rows += bulk_load(cur, 'songs', song_df)
+
+        artist_df = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]]
+        bulk_load(cur, 'artists', artist_df.drop_duplicates('artist_id'))
+
+        if song_index is not None:
+            song_index.add(df)
+
+    return rows
+
+
+def process_log_file_bulk(cur, filepaths, song_index=None, time_cache=None, user_cache=None, chunksize=CHUNKSIZE):
+    """
+    - Arguments :
+        cur        - Database Cursor
+        filepaths  - list of JSON log file locations loaded as one batch
+        song_index - SongIndex used to look up the song and artist of every event,
+                     built from the songs and artists tables when not given
+        time_cache - optional TimeCache of the timestamps already sent to the time table
+        user_cache - optional UserCache snapshot of the level of every user in the users table
+        chunksize  - number of NextSong events read and loaded at a time
+    
+    - Deletes the song plays loaded from earlier versions of the files, as process_log_file
+    
+    - Streams the JSON log files of the batch chunksize NextSong events at a time and bulk
+      loads each chunk with load_log_events
+    
+    - Return :
+        number of song plays loaded
+    """
+    if song_index is None:
+        song_index = SongIndex.from_tables(cur)
+
+    cur.execute(songplay_source_delete, (list(filepaths),))
+
+    rows = 0
+    for df in read_json_chunks(filepaths, chunksize, page='NextSong', source=True):
+        rows += load_log_events(cur, df, song_index, time_cache, user_cache)
+
+    return rows
+
+
+def load_log_events(cur, df, song_index, time_cache=None, user_cache=None):
+    """
+    - Arguments :
+        cur        - Database Cursor
+        df         - batch of NextSong events from the log files, with their source_file
+        song_index - SongIndex used to look up the song and artist of every event
+        time_cache - optional TimeCache of the timestamps already sent to the time table
+        user_cache - optional UserCache snapshot of the level of every user in the users table
+    
+    - Same transform as insert_log_events
+    
+    - Bulk loads the time, users and songplays data
+    
+    - Return :
+        number of song plays loaded
+    """
+    with metrics.timer('transform'):
+        # convert the columns to their types and the timestamp column to datetime
+        df = transform_log_events(df)
+
+        time_df = build_time_df(df['start_time'])
+        if time_cache is not None:
+            time_df = time_cache.unseen(time_df)
+
+        # one row per user as of the user's last event, only new users and level changes
+        user_df = latest_users(df)
+        if user_cache is not None:
+            user_df = user_cache.changed(user_df)
+
+        found = song_index.resolve(df)
+        metrics.lookups(int(found['song_id'].notna().sum()), len(df))
+
+        songplay_df = pd.DataFrame({
+            'start_time': df['start_time'],
+            'user_id': df['userId'],
+            'level': df['level'],
+            'song_id': found['song_id'],
+            'artist_id': found['artist_id'],
+            'session_id': df['sessionId'],
+            'location': df['location'],
+            'user_agent': df['userAgent'],
+            'source_file': df['source_file']
+        })
+
+    bulk_load(cur, 'time', time_df)
+    bulk_load(cur, 'users', user_df)
+    return bulk_load(cur, 'songplays', songplay_df)
+
+
+def get_files(filepath):
+    """
+    - Arguments :
+        filepath - location of JSON Files
+    
+    - walks the given filepath and returns a list of .json files on that path
+    
+    - Return :
+        list of absolute file paths
     """
     # get all files matching extension from directory
     all_files = []
@@ -124,35 +356,370 @@ def process_data(cur, conn, filepath, func):
         for f in files :
             all_files.append(os.path.abspath(f))
 
-    # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    return all_files
+
+
+def get_tasks(cur, conn, filepath, batch_size=None, incremental=False):
+    """
+    - Arguments :
+        cur         - Database Cursor
+        conn        - database connection
+        filepath    - location of JSON Files
+        batch_size  - when set, files are grouped into lists of up to batch_size files
+        incremental - skip the files already recorded in load_manifest with the same content
+    
+    - Finds the .json files on the filepath and outputs how many there are (and how many are
+      still to load when incremental)
+    
+    - Return :
+        tuple of the number of files and a list of (file or batch of files, manifest entries),
+        the manifest entries are None when not incremental
+    """
+    all_files = get_files(filepath)
+    print('{} files found in {}'.format(len(all_files), filepath))
+
+    if incremental:
+        entries = pending_files(cur, filepath, all_files)
+        conn.commit()
+        print('{} new or changed files to load'.format(len(entries)))
+    else:
+        entries = [(f, None) for f in all_files]
+
+    if not batch_size:
+        return len(entries), [(f, [(f, entry)] if entry else None) for f, entry in entries]
+
+    tasks = []
+    for i in range(0, len(entries), batch_size):
+        batch = entries[i:i + batch_size]
+        tasks.append(([f for f, _ in batch], batch if incremental else None))
+
+    return len(entries), tasks
+
+
+def process_data(cur, conn, filepath, func, batch_size=None, incremental=False, **kwargs):
+    """
+    - Arguments :
+        cur         - Database Cursor
+        conn        - database connection
+        filepath    - location of JSON Files
+        func        - the funciton to be called based on the filepath
+        batch_size  - when set, func is passed lists of up to batch_size files (bulk load mode)
+        incremental - only load new or changed files, recording each loaded file in load_manifest
+        kwargs      - passed on to func, such as the song_index
+    
+    - walks the given filepath and returns a list of .json files on that path
+    
+    - Outputs the number of .json files on the path
+    
+    - Iterates through the .json files on the filepath passing the filename to the passed in function name
+    
+    - Commits the transaction after each file (or batch of files) has been processed, together
+      with its load_manifest entry so a crashed run resumes from the last committed file
+       
+    - Return :
+        tuple of the number of files and the number of rows loaded
+    """
+    num_files, tasks = get_tasks(cur, conn, filepath, batch_size, incremental)
 
     # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    rows = 0
+    processed = 0
+    for datafile, entries in tasks:
+        with metrics.timer(func.__name__):
+            rows += func(cur, datafile, **kwargs)
+        if entries:
+            record_files(cur, entries)
         conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+        processed += len(datafile) if batch_size else 1
+        print('{}/{} files processed.'.format(processed, num_files))
+
+    return num_files, rows
+
 
+def init_worker(dsn, options):
+    """
+    - Arguments :
+        dsn     - connection string of the sparkify database
+        options - keyword arguments for the worker's calls to func, except for
+                    tolerance       - when given, the worker builds its own song index from the
+                                      songs and artists tables using this duration tolerance
+                    time_cache_size - when given, the worker keeps its own time cache of this size
+                    metrics         - when true, the worker records metrics sent back with each file
+    
+    - Runs once in each parallel ingestion worker process, creating the worker's connection pool
+    
+    - Workers keep no snapshot of the users table as the other workers change it, the users
+      upsert only keeps the level of each user's latest event whatever order files finish in
+    
+    - Return :
+        none
+    """
+    global worker_pool, worker_kwargs
+
+    # a forked worker starts with a copy of the parent's metrics, which the parent already has
+    metrics.clear()
+
+    worker_kwargs = dict(options)
+    tolerance = worker_kwargs.pop('tolerance', None)
+    time_cache_size = worker_kwargs.pop('time_cache_size', None)
+    if worker_kwargs.pop('metrics', False):
+        metrics.enable()
+
+    cursor_factory = MetricsCursor if metrics.enabled else None
+    worker_pool = psycopg2.pool.SimpleConnectionPool(1, 1, dsn, cursor_factory=cursor_factory)
+
+    conn = worker_pool.getconn()
+    if tolerance is not None:
+        worker_kwargs['song_index'] = SongIndex.from_tables(conn.cursor(), tolerance)
+    conn.commit()
+    worker_pool.putconn(conn)
+
+    if time_cache_size is not None:
+        worker_kwargs['time_cache'] = TimeCache(time_cache_size)
 
-def main():
+
+def process_in_worker(func, task):
+    """
+    - Arguments :
+        func - the function to be called with the worker's cursor
+        task - tuple of the file, or batch of files, passed on to func and its manifest
+               entries (None when not incremental)
+    
+    - Takes a connection from the worker's pool, processes the file and commits it together
+      with its load_manifest entries
+    
+    - Rolls back and retries the file when it deadlocks with another worker, clearing the time
+      cache as the rows it recorded were rolled back with the file, and discarding
+      the metrics of the rolled back attempt
+    
+    - Return :
+        tuple of the number of rows loaded and the metrics recorded since the last file,
+        None when metrics are disabled
+    """
+    datafile, entries = task
+    # metrics recorded before this file, such as building the worker's song index
+    carried = metrics.drain()
+    conn = worker_pool.getconn()
+    try:
+        for attempt in range(1, DEADLOCK_RETRIES + 1):
+            try:
+                cur = conn.cursor()
+                with metrics.timer(func.__name__):
+                    rows = func(cur, datafile, **worker_kwargs)
+                if entries:
+                    record_files(cur, entries)
+                conn.commit()
+                metrics.merge(carried)
+                return rows, metrics.drain() if metrics.enabled else None
+            except psycopg2.extensions.TransactionRollbackError:
+                conn.rollback()
+                metrics.clear()
+                if 'time_cache' in worker_kwargs:
+                    worker_kwargs['time_cache'].clear()
+                if attempt == DEADLOCK_RETRIES:
+                    raise
+    finally:
+        worker_pool.putconn(conn)
+
+
+def process_data_parallel(dsn, filepath, func, workers, batch_size=None, incremental=False, **options):
     """
-    - Connects to the database
+    - Arguments :
+        dsn         - connection string of the sparkify database
+        filepath    - location of JSON Files
+        func        - the funciton to be called based on the filepath
+        workers     - number of worker processes
+        batch_size  - when set, func is passed lists of up to batch_size files (bulk load mode)
+        incremental - only load new or changed files, recording each loaded file in load_manifest
+        options     - worker options, such as the song index tolerance, see init_worker
+    
+    - Same as process_data, but the files are spread across a pool of worker processes
+      that each parse with pandas and load over their own pooled connection
+    
+    - Every file (or batch) is committed on its own, so the order files complete in is not
+      the order they were found in
+    
+    - Return :
+        tuple of the number of files and the number of rows loaded
+    """
+    conn = psycopg2.connect(dsn)
+    num_files, tasks = get_tasks(conn.cursor(), conn, filepath, batch_size, incremental)
+    conn.close()
+
+    rows = 0
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(dsn, options)) as pool:
+        for i, (task_rows, task_metrics) in enumerate(pool.imap_unordered(partial(process_in_worker, func), tasks), 1):
+            rows += task_rows
+            if task_metrics is not None:
+                metrics.merge(task_metrics)
+            print('{}/{} {} processed.'.format(i, len(tasks), 'batches' if batch_size else 'files'))
+
+    return num_files, rows
+
+
+def load_calendar(cur, conn, start, end, freq='h'):
+    """
+    - Arguments :
+        cur   - Database Cursor
+        conn  - database connection
+        start - first timestamp of the range
+        end   - last timestamp of the range
+        freq  - pandas frequency of the generated timestamps
+    
+    - Pre-generates the time table rows of a date range in one vectorized pass and loads them
+    
+    - Return :
+        number of rows generated
+    """
+    rows = bulk_load(cur, 'time', calendar_rows(start, end, freq))
+    conn.commit()
+    return rows
+
+
+def print_summary(stages):
+    """
+    - Arguments :
+        stages - list of (stage name, files, rows, seconds)
+    
+    - Outputs the files, rows and seconds taken by each stage of the load
+    
+    - Return :
+        none
+    """
+    print('{:<10}{:>10}{:>10}{:>10}'.format('stage', 'files', 'rows', 'seconds'))
+    for name, files, rows, seconds in stages:
+        print('{:<10}{:>10}{:>10}{:>10.2f}'.format(name, files, rows, seconds))
+
+
+def load_stages(cur, conn, song_func, log_func, batch_size, incremental, song_options, tolerance, time_cache_size,
+                chunksize):
+    """
+    - Loads the song and then the log files in this process, as described in main
+    
+    - Return :
+        list of (stage name, files, rows, seconds)
+    """
+    stages = []
+    song_index = SongIndex.from_tables(cur, tolerance)
+    time_cache = TimeCache(time_cache_size)
+    user_cache = UserCache.from_tables(cur)
+    log_options = {'song_index': song_index, 'time_cache': time_cache, 'user_cache': user_cache, 'chunksize': chunksize}
+
+    for name, filepath, func, kwargs in [
+            ('songs', 'data/song_data', song_func, dict(song_options, song_index=song_index)),
+            ('logs', 'data/log_data', log_func, log_options)]:
+        start = time.perf_counter()
+        files, rows = process_data(cur, conn, filepath=filepath, func=func, batch_size=batch_size,
+                                   incremental=incremental, **kwargs)
+        stages.append((name, files, rows, time.perf_counter() - start))
+
+    print('song index: {} songs, {} bytes'.format(len(song_index), song_index.memory_usage()))
+    return stages
+
+
+def main(bulk=False, batch_size=100, tolerance=0.0, workers=None, incremental=False, time_cache_size=100000,
+         chunksize=CHUNKSIZE, rebuild_indexes=False, metrics_path=None):
+    """
+    - Arguments :
+        bulk            - load with COPY and set based merges rather than one insert per row
+        batch_size      - number of files per bulk load batch
+        tolerance       - seconds the song duration may differ from the event length and still match
+        workers         - number of worker processes to load the files with, None to load in this process
+        incremental     - only load the files that are new or changed since they were last loaded
+        time_cache_size - number of timestamps kept in the time cache
+        chunksize       - number of records read from the files and loaded at a time
+        rebuild_indexes - drop the performance profile indexes before the load and rebuild them after it
+        metrics_path    - when given, parse, transform and per statement DB times, rows written and skipped
+                          by ON CONFLICT and the song lookup hit rate are recorded and written to this file,
+                          in the Prometheus text format when it ends with .prom and as a JSON line otherwise
+    
+    - Connects to the database, closing the connection while parallel workers are forked
+    
+    - Builds the song index from the songs already loaded, an empty time cache and a snapshot of the users
     
     - Extracts, transforms and loads the song file data
     
-    - Extracts, transforms and loads the log file data
+    - Extracts, transforms and loads the log file data, only once every song file has been
+      loaded as the song plays look up the songs
+    
+    - Outputs the files, rows and seconds of each stage, including rebuilding the indexes
     
     - Finally, closes the connection. 
     """
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    song_func, log_func = (process_song_file_bulk, process_log_file_bulk) if bulk else (process_song_file, process_log_file)
+    song_options = {'chunksize': chunksize} if bulk else {}
+    if not bulk:
+        batch_size = None
+
+    if metrics_path:
+        metrics.enable()
+
+    cursor_factory = MetricsCursor if metrics_path else None
+    conn = psycopg2.connect(DSN, cursor_factory=cursor_factory)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    if rebuild_indexes:
+        dropped = drop_indexes(cur, conn)
+        print('dropped indexes: {}'.format(', '.join(dropped) or 'none'))
+
+    stages = []
+    if workers:
+        # the forked workers would inherit the connection's socket, it is only opened again
+        # once the worker pools have finished
+        conn.close()
+
+        # the log stage's workers build their song index once the song stage has finished
+        for name, filepath, func, options in [
+                ('songs', 'data/song_data', song_func, song_options),
+                ('logs', 'data/log_data', log_func, {'tolerance': tolerance, 'time_cache_size': time_cache_size,
+                                                     'chunksize': chunksize})]:
+            start = time.perf_counter()
+            files, rows = process_data_parallel(DSN, filepath, func, workers, batch_size, incremental,
+                                                metrics=bool(metrics_path), **options)
+            stages.append((name, files, rows, time.perf_counter() - start))
+
+        conn = psycopg2.connect(DSN, cursor_factory=cursor_factory)
+        cur = conn.cursor()
+    else:
+        stages.extend(load_stages(cur, conn, song_func, log_func, batch_size, incremental, song_options, tolerance,
+                                  time_cache_size, chunksize))
+
+    if rebuild_indexes:
+        start = time.perf_counter()
+        create_indexes(cur, conn, dropped)
+        stages.append(('indexes', 0, 0, time.perf_counter() - start))
+
+    print_summary(stages)
+
+    if metrics_path:
+        metrics.write(metrics_path)
+        print('metrics written to {}'.format(metrics_path))
 
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Load the song and log files into sparkifydb')
+    parser.add_argument('--bulk', action='store_true', help='load with COPY and set based merges')
+    parser.add_argument('--batch-size', type=int, default=100, help='files per bulk load batch')
+    parser.add_argument('--tolerance', type=float, default=0.0, help='song duration match tolerance in seconds')
+    parser.add_argument('--workers', type=int, help='number of worker processes to load the files with')
+    parser.add_argument('--incremental', action='store_true', help='only load new or changed files')
+    parser.add_argument('--time-cache-size', type=int, default=100000, help='timestamps kept in the time cache')
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help='records read and loaded at a time')
+    parser.add_argument('--rebuild-indexes', action='store_true',
+                        help='drop the performance profile indexes during the load and rebuild them after it')
+    parser.add_argument('--calendar', nargs=2, metavar=('START', 'END'),
+                        help='pre-generate hourly time rows for a date range before loading')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='record per stage metrics to a JSON lines file, or a Prometheus text file ending in .prom')
+    args = parser.parse_args()
+
+    if args.calendar:
+        conn = psycopg2.connect(DSN)
+        print('{} calendar rows generated'.format(load_calendar(conn.cursor(), conn, *args.calendar)))
+        conn.close()
+
+    main(bulk=args.bulk, batch_size=args.batch_size, tolerance=args.tolerance, workers=args.workers,
+         incremental=args.incremental, time_cache_size=args.time_cache_size, chunksize=args.chunksize,
+         rebuild_indexes=args.rebuild_indexes, metrics_path=args.metrics)
\ No newline at end of file
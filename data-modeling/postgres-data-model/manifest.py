@@ -0,0 +1,81 @@
+import os
+import hashlib
+from sql_queries import load_manifest_select, load_manifest_insert
+
+
+def fingerprint(filepath):
+    """
+    - Arguments :
+        filepath - location of a JSON File
+
+    - Reads the file once to hash its content and count its JSON lines
+
+    - Return :
+        tuple of size in bytes, modification time, sha1 content hash and number of rows
+    """
+    stat = os.stat(filepath)
+    content_hash = hashlib.sha1()
+    rows = 0
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            content_hash.update(block)
+            rows += block.count(b'\n')
+
+    # the last line of a file is not always terminated
+    if stat.st_size and not block.endswith(b'\n'):
+        rows += 1
+
+    return stat.st_size, stat.st_mtime, content_hash.hexdigest(), rows
+
+
+def pending_files(cur, filepath, all_files):
+    """
+    - Arguments :
+        cur       - Database Cursor
+        filepath  - location of JSON Files, the manifest entries under it are compared
+        all_files - absolute paths of the .json files found under filepath
+
+    - Compares every file with its load_manifest entry, a file whose size and modification
+      time are unchanged is skipped without being read, one that was touched but has the
+      same content hash is skipped as well, its new size and modification time are recorded
+
+    - Return :
+        list of (path, fingerprint) for the new and changed files, in the order of all_files
+    """
+    prefix = os.path.join(os.path.abspath(filepath), '')
+    prefix = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    cur.execute(load_manifest_select, (prefix + '%',))
+    loaded = {path: (size, mtime, content_hash) for path, size, mtime, content_hash in cur.fetchall()}
+
+    pending = []
+    for path in all_files:
+        entry = loaded.get(path)
+        if entry is not None:
+            stat = os.stat(path)
+            if (stat.st_size, stat.st_mtime) == entry[:2]:
+                continue
+
+        file_fingerprint = fingerprint(path)
+        if entry is not None and file_fingerprint[2] == entry[2]:
+            record_files(cur, [(path, file_fingerprint)])
+            continue
+
+        pending.append((path, file_fingerprint))
+
+    return pending
+
+
+def record_files(cur, entries):
+    """
+    - Arguments :
+        cur     - Database Cursor
+        entries - list of (path, fingerprint) as returned by pending_files
+
+    - Records the files in load_manifest, on the same transaction as their data so that a
+      file is only ever marked as loaded once its rows are committed
+
+    - Return :
+        none
+    """
+    for path, (size, mtime, content_hash, rows) in entries:
+        cur.execute(load_manifest_insert, (path, size, mtime, content_hash, rows))
@@ -0,0 +1,219 @@
+import re
+import json
+import time
+from collections import defaultdict
+from functools import lru_cache
+import psycopg2.extensions
+
+
+class Timer:
+    """
+    Context manager adding the seconds spent in its block to a Metrics timing.
+    """
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timings[self.name] += time.perf_counter() - self.start
+
+
+class NullTimer:
+    """
+    Context manager that does nothing, handed out while metrics are disabled.
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """
+    Timings and counters of an ETL run.
+
+    - Timings are seconds by name: 'parse' for reading the files, 'transform' for the
+      pandas transforms, 'db:<statement>' for each SQL statement and the name of the
+      function processing each file
+
+    - Counters are totals by name: 'rows:<table>:written' and 'rows:<table>:skipped' for
+      the rows sent to each table that were written or ignored by ON CONFLICT (an update on
+      conflict counts as written), 'lookup:hit' and 'lookup:miss' for the song lookups
+
+    - While disabled, `timer` hands out a shared no-op context manager and `count` returns
+      straight away, so the instrumentation costs a method call and an attribute check
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.timings = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def enable(self):
+        self.enabled = True
+
+    def timer(self, name):
+        """
+        - Arguments :
+            name - timing the block's seconds are added to
+
+        - Return :
+            context manager timing its block
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self.timings, name)
+
+    def count(self, name, n=1):
+        """
+        - Arguments :
+            name - counter to add to
+            n    - amount to add
+        """
+        if self.enabled:
+            self.counts[name] += n
+
+    def rows(self, table, sent, written):
+        """
+        - Arguments :
+            table   - table the rows were sent to
+            sent    - number of rows sent
+            written - number of rows the statement wrote, the cursor's rowcount
+        """
+        if self.enabled:
+            self.counts['rows:{}:written'.format(table)] += written
+            self.counts['rows:{}:skipped'.format(table)] += sent - written
+
+    def lookups(self, hits, total):
+        """
+        - Arguments :
+            hits  - number of events whose song was found
+            total - number of events looked up
+        """
+        if self.enabled:
+            self.counts['lookup:hit'] += hits
+            self.counts['lookup:miss'] += total - hits
+
+    def clear(self):
+        """
+        - Discards the timings and counts recorded so far
+        """
+        self.timings.clear()
+        self.counts.clear()
+
+    def drain(self):
+        """
+        - Return :
+            tuple of the timings and counts recorded since the last drain, which are reset,
+            used to send a worker process's metrics back to the parent
+        """
+        drained = (dict(self.timings), dict(self.counts))
+        self.clear()
+        return drained
+
+    def merge(self, drained):
+        """
+        - Arguments :
+            drained - timings and counts returned by another process's drain
+        """
+        timings, counts = drained
+        for name, seconds in timings.items():
+            self.timings[name] += seconds
+        for name, n in counts.items():
+            self.counts[name] += n
+
+    def summary(self):
+        """
+        - Return :
+            dict of the timings, counts, total DB seconds and song lookup hit rate
+        """
+        hits, misses = self.counts.get('lookup:hit', 0), self.counts.get('lookup:miss', 0)
+        return {
+            'timings': dict(self.timings),
+            'counts': dict(self.counts),
+            'db_seconds': sum(seconds for name, seconds in self.timings.items() if name.startswith('db:')),
+            'lookup_hit_rate': hits / (hits + misses) if hits + misses else None
+        }
+
+    def write(self, path):
+        """
+        - Arguments :
+            path - file to write to, a Prometheus text file when it ends with .prom, otherwise
+                   a JSON lines file the run is appended to
+        """
+        if path.endswith('.prom'):
+            with open(path, 'w') as f:
+                f.write(self.prometheus())
+            return
+
+        with open(path, 'a') as f:
+            f.write(json.dumps(dict(self.summary(), time=time.time())) + '\n')
+
+    def prometheus(self):
+        """
+        - Return :
+            the metrics in the Prometheus text exposition format
+        """
+        lines = ['# TYPE sparkify_etl_seconds_total counter']
+        for name, seconds in sorted(self.timings.items()):
+            lines.append('sparkify_etl_seconds_total{{stage="{}"}} {}'.format(name, seconds))
+
+        counts = [(name.split(':'), n) for name, n in sorted(self.counts.items())]
+
+        lines.append('# TYPE sparkify_etl_rows_total counter')
+        for (kind, *labels), n in counts:
+            if kind == 'rows':
+                lines.append('sparkify_etl_rows_total{{table="{}",result="{}"}} {}'.format(*labels, n))
+
+        lines.append('# TYPE sparkify_etl_lookups_total counter')
+        for (kind, *labels), n in counts:
+            if kind == 'lookup':
+                lines.append('sparkify_etl_lookups_total{{result="{}"}} {}'.format(*labels, n))
+
+        return '\n'.join(lines) + '\n'
+
+
+# metrics of this process, disabled until enabled by etl.py
+metrics = Metrics()
+
+
+@lru_cache(maxsize=256)
+def statement_label(query):
+    """
+    - Arguments :
+        query - SQL statement
+
+    - Return :
+        short label of the statement, its verb and table, such as 'insert users'
+    """
+    words = query.split()
+    verb = words[0].lower()
+    if verb in ('copy', 'truncate'):
+        return '{} {}'.format(verb, words[1].strip(';'))
+
+    match = re.search(r'\b(?:into|from|exists)\s+(\w+)', query, re.IGNORECASE)
+    return '{} {}'.format(verb, match.group(1)) if match else verb
+
+
+class MetricsCursor(psycopg2.extensions.cursor):
+    """
+    Cursor timing every statement it runs into the 'db:<statement>' timings, only used
+    when metrics are enabled so a run without metrics uses the plain cursor.
+    """
+
+    def execute(self, query, vars=None):
+        with metrics.timer('db:' + statement_label(query)):
+            return super().execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        with metrics.timer('db:' + statement_label(sql)):
+            return super().copy_expert(sql, file, size)
@@ -0,0 +1,60 @@
+import pandas as pd
+from metrics import metrics
+
+# rows per batch handed to the loaders
+CHUNKSIZE = 10000
+
+
+def read_json_chunks(filepaths, chunksize=CHUNKSIZE, page=None, source=False):
+    """
+    - Arguments :
+        filepaths - list of JSON lines file locations, read in order
+        chunksize - number of rows in each batch
+        page      - when given, only the events of this page are kept, for example 'NextSong'
+        source    - when true, a source_file column holds the location each row was read from
+
+    - Streams the files chunksize lines at a time rather than loading each file whole, filters
+      each chunk as it is read and re-batches what is left into batches of chunksize rows, so
+      peak memory depends on chunksize rather than on the size of the files
+
+    - Return :
+        generator of DataFrames of up to chunksize rows, only the last batch may be smaller,
+        numbered from 0 across all the files
+    """
+    pending = []
+    pending_rows = 0
+    offset = 0
+
+    for filepath in filepaths:
+        with pd.read_json(filepath, lines=True, orient='columns', chunksize=chunksize) as reader:
+            chunks = iter(reader)
+            while True:
+                # parse time is recorded here as the generator is advanced by the loaders
+                with metrics.timer('parse'):
+                    chunk = next(chunks, None)
+                    if chunk is not None and page is not None:
+                        chunk = chunk[chunk['page'] == page]
+                if chunk is None:
+                    break
+                if chunk.empty:
+                    continue
+                if source:
+                    chunk = chunk.assign(source_file=filepath)
+
+                pending.append(chunk)
+                pending_rows += len(chunk)
+
+                while pending_rows >= chunksize:
+                    batch = pd.concat(pending, ignore_index=True)
+                    pending = [batch.iloc[chunksize:].copy()]
+                    pending_rows -= chunksize
+
+                    batch = batch.iloc[:chunksize]
+                    batch.index += offset
+                    offset += chunksize
+                    yield batch
+
+    if pending_rows:
+        batch = pd.concat(pending, ignore_index=True)
+        batch.index += offset
+        yield batch
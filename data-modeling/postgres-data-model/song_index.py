@@ -0,0 +1,132 @@
+import pandas as pd
+from sql_queries import song_index_select
+
+
+class SongIndex:
+    """
+    In memory replacement for the `song_select` query, mapping (title, artist_name, duration)
+    to the song_id and artist_id loaded into the songs and artists tables.
+
+    - Built once from the songs and artists tables (`from_tables`) or from the song files
+      (`from_files`), then kept up to date with `add` as process_song_file loads new songs
+
+    - `resolve` looks up a whole DataFrame of log events with a single merge, matching
+      the duration exactly or, when a tolerance is given, to the nearest duration within it
+
+    - Memory use : the index is one DataFrame of five object columns, roughly 350-450 bytes
+      per song with typical title and name lengths (about 40MB for 100,000 songs), plus a
+      copy of each added batch until the next resolve consolidates them.
+      `memory_usage` reports the exact figure.
+    """
+
+    columns = ['title', 'artist_name', 'duration', 'song_id', 'artist_id']
+
+    def __init__(self, tolerance=0.0):
+        """
+        - Arguments :
+            tolerance - largest difference in seconds between the event length and the song
+                        duration that still counts as a match, 0 for an exact match
+        """
+        self.tolerance = tolerance
+        self.songs = pd.DataFrame(columns=self.columns).astype({'duration': float})
+        self.pending = []
+
+    @classmethod
+    def from_tables(cls, cur, tolerance=0.0):
+        """
+        - Arguments :
+            cur       - Database Cursor
+            tolerance - see __init__
+
+        - Return :
+            index of every song already loaded into the songs and artists tables
+        """
+        index = cls(tolerance)
+        cur.execute(song_index_select)
+        index.add(pd.DataFrame(cur.fetchall(), columns=cls.columns))
+        return index
+
+    @classmethod
+    def from_files(cls, filepaths, tolerance=0.0):
+        """
+        - Arguments :
+            filepaths - list of JSON song file locations
+            tolerance - see __init__
+
+        - Return :
+            index of every song in the song files
+        """
+        index = cls(tolerance)
+        for filepath in filepaths:
+            index.add(pd.read_json(filepath, lines=True, orient='columns'))
+        return index
+
+    def add(self, df):
+        """
+        - Arguments :
+            df - song data with title, artist_name, duration, song_id and artist_id columns
+
+        - Queues the songs to be merged into the index at the next lookup, so adding one
+          song file at a time does not copy the whole index for every file
+
+        - Return :
+            none
+        """
+        self.pending.append(df[self.columns])
+
+    def _consolidate(self):
+        """
+        - Merges the queued songs into the index, the first song seen for a key wins
+        """
+        if not self.pending:
+            return
+
+        songs = pd.concat([self.songs] + self.pending, ignore_index=True)
+        songs = songs.astype({'title': object, 'artist_name': object, 'duration': float})
+        self.songs = songs.drop_duplicates(['title', 'artist_name', 'duration']).reset_index(drop=True)
+        self.pending = []
+
+    def __len__(self):
+        self._consolidate()
+        return len(self.songs)
+
+    def memory_usage(self):
+        """
+        - Return :
+            bytes held by the index, including the strings it references
+        """
+        self._consolidate()
+        return int(self.songs.memory_usage(deep=True).sum())
+
+    def resolve(self, events, title='song', artist_name='artist', duration='length'):
+        """
+        - Arguments :
+            events      - DataFrame of log events
+            title       - events column holding the song title
+            artist_name - events column holding the artist name
+            duration    - events column holding the song length
+
+        - Return :
+            DataFrame with the song_id and artist_id of each event, on the same index as
+            events, None where no song matches
+        """
+        self._consolidate()
+
+        keys = events[[title, artist_name, duration]].dropna()
+        keys.columns = ['title', 'artist_name', 'duration']
+        # merge_asof needs the same key types on both sides, pandas 3 reads text as str
+        keys = keys.astype({'title': object, 'artist_name': object, 'duration': float}).reset_index()
+
+        if self.tolerance:
+            found = pd.merge_asof(keys.sort_values('duration'),
+                                  self.songs.sort_values('duration'),
+                                  on='duration',
+                                  by=['title', 'artist_name'],
+                                  tolerance=self.tolerance,
+                                  direction='nearest')
+        else:
+            found = keys.merge(self.songs, on=['title', 'artist_name', 'duration'], how='left')
+
+        found = found.set_index(keys.columns[0])[['song_id', 'artist_id']]
+        found = found.reindex(events.index)
+        return found.astype(object).where(found.notna(), None)
@@ -5,6 +5,7 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+load_manifest_table_drop = "DROP TABLE IF EXISTS load_manifest;"
 
 # CREATE TABLES
 
@@ -17,7 +18,8 @@ songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (
                             artist_id text, 
                             session_id int NOT NULL, 
                             location text NOT NULL, 
-                            user_agent text NOT NULL
+                            user_agent text NOT NULL,
+                            source_file text
                             ); 
                         """)
 
@@ -26,10 +28,15 @@ user_table_create = ("""CREATE TABLE IF NOT EXISTS users (
                         first_name text NOT NULL, 
                         last_name text NOT NULL, 
                         gender text NOT NULL, 
-                        level text NOT NULL
+                        level text NOT NULL,
+                        last_seen timestamp
                         ); 
                     """)
 
+# the start_time of the event the user's level was taken from, added to a users table
+# created before it was
+user_last_seen_add = ("""ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen timestamp;""")
+
 song_table_create = ("""CREATE TABLE IF NOT EXISTS songs ( 
                         song_id text PRIMARY KEY NOT NULL,  
                         title text, 
@@ -59,6 +66,82 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS time (
                         ); 
                     """)
 
+# the song plays of a log file are found by their source file when the file is loaded again,
+# the column is added to a songplays table created before it was
+songplay_source_file_add = ("""ALTER TABLE songplays ADD COLUMN IF NOT EXISTS source_file text;""")
+
+songplay_source_file_index_create = ("""CREATE INDEX IF NOT EXISTS songplays_source_file_idx
+                                        ON songplays (source_file);
+                                    """)
+
+load_manifest_table_create = ("""CREATE TABLE IF NOT EXISTS load_manifest (
+                                path text PRIMARY KEY NOT NULL,
+                                size bigint NOT NULL,
+                                mtime float NOT NULL,
+                                content_hash text NOT NULL,
+                                rows int NOT NULL,
+                                loaded_at timestamp NOT NULL DEFAULT now()
+                                );
+                            """)
+
+# PERFORMANCE PROFILE
+# songplays range partitioned by month on start_time, the primary key of a partitioned
+# table has to include the partition key. Events outside the created months land in the
+# default partition.
+
+songplay_table_create_partitioned = ("""CREATE TABLE IF NOT EXISTS songplays (
+                                        songplay_id SERIAL NOT NULL,
+                                        start_time timestamp NOT NULL,
+                                        user_id int NOT NULL,
+                                        level text NOT NULL,
+                                        song_id text,
+                                        artist_id text,
+                                        session_id int NOT NULL,
+                                        location text NOT NULL,
+                                        user_agent text NOT NULL,
+                                        source_file text,
+                                        PRIMARY KEY (songplay_id, start_time)
+                                        ) PARTITION BY RANGE (start_time);
+                                    """)
+
+songplay_partition_create = ("""CREATE TABLE IF NOT EXISTS songplays_{start:%Y_%m}
+                                PARTITION OF songplays
+                                FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}');
+                            """)
+
+songplay_default_partition_create = ("""CREATE TABLE IF NOT EXISTS songplays_default
+                                        PARTITION OF songplays DEFAULT;
+                                    """)
+
+# supporting indexes of the song lookup and the analytic queries, on songplays they are
+# created on every partition
+performance_indexes = {
+    'songs_title_idx': "CREATE INDEX IF NOT EXISTS songs_title_idx ON songs (title);",
+    'artists_name_idx': "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name);",
+    'songplays_start_time_idx': "CREATE INDEX IF NOT EXISTS songplays_start_time_idx ON songplays (start_time);",
+    'songplays_user_id_idx': "CREATE INDEX IF NOT EXISTS songplays_user_id_idx ON songplays (user_id, start_time);"
+}
+
+index_drop = "DROP INDEX IF EXISTS {};"
+
+index_exists_select = ("""SELECT indexname FROM pg_indexes WHERE indexname = ANY(%s);""")
+
+# CONFLICT RULES
+
+# files are loaded in any order, a user's level is only replaced by a later event's
+user_table_conflict = """ON CONFLICT (user_id)
+                        DO UPDATE SET level = EXCLUDED.level, last_seen = EXCLUDED.last_seen
+                        WHERE users.last_seen IS NULL OR EXCLUDED.last_seen > users.last_seen"""
+
+song_table_conflict = """ON CONFLICT (song_id)
+                        DO NOTHING"""
+
+artist_table_conflict = """ON CONFLICT (artist_id)
+                        DO NOTHING"""
+
+time_table_conflict = """ON CONFLICT (start_time)
+                        DO NOTHING"""
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""INSERT INTO songplays ( 
@@ -69,8 +152,9 @@ songplay_table_insert = ("""INSERT INTO songplays (
                             artist_id, 
                             session_id, 
                             location, 
-                            user_agent)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+                            user_agent,
+                            source_file)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
                         """)
 
 user_table_insert = ("""INSERT INTO users ( 
@@ -78,11 +162,11 @@ user_table_insert = ("""INSERT INTO users (
                         first_name, 
                         last_name, 
                         gender, 
-                        level)
-                        VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (user_id)
-                        DO UPDATE SET level = EXCLUDED.level;
-                    """)
+                        level,
+                        last_seen)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                        {};
+                    """).format(user_table_conflict)
 
 song_table_insert = ("""INSERT INTO songs ( 
                         song_id,
@@ -91,9 +175,8 @@ song_table_insert = ("""INSERT INTO songs (
                         year,
                         duration)
                         VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (song_id)
-                        DO NOTHING;
-                        """)
+                        {};
+                        """).format(song_table_conflict)
 
 artist_table_insert = ("""INSERT INTO artists ( 
                             artist_id, 
@@ -102,9 +185,8 @@ artist_table_insert = ("""INSERT INTO artists (
                             latitude, 
                             longitude)
                             VALUES (%s, %s, %s, %s, %s)
-                            ON CONFLICT (artist_id)
-                            DO NOTHING;
-                    """)
+                            {};
+                    """).format(artist_table_conflict)
 
 
 time_table_insert = ("""INSERT INTO time (
@@ -116,9 +198,27 @@ time_table_insert = ("""INSERT INTO time (
                         year, 
                         weekday)
                         VALUES (%s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (start_time)
-                        DO NOTHING;
-                    """)
+                        {};
+                    """).format(time_table_conflict)
+
+load_manifest_insert = ("""INSERT INTO load_manifest (
+                            path,
+                            size,
+                            mtime,
+                            content_hash,
+                            rows)
+                            VALUES (%s, %s, %s, %s, %s)
+                            ON CONFLICT (path)
+                            DO UPDATE SET size = EXCLUDED.size,
+                            mtime = EXCLUDED.mtime,
+                            content_hash = EXCLUDED.content_hash,
+                            rows = EXCLUDED.rows,
+                            loaded_at = now();
+                        """)
+
+# DELETE RECORDS
+
+songplay_source_delete = ("""DELETE FROM songplays WHERE source_file = ANY(%s);""")
 
 # FIND SONGS
 
@@ -131,7 +231,185 @@ song_select = ("""SELECT songs.song_id song_id, artists.artist_id artist_id
                     AND songs.duration = (%s);
 """)
 
+user_level_select = ("""SELECT user_id, level, last_seen FROM users;""")
+
+song_index_select = ("""SELECT songs.title, artists.name, songs.duration, songs.song_id, artists.artist_id
+                        FROM artists
+                        INNER JOIN songs
+                        ON artists.artist_id = songs.artist_id;
+""")
+
+load_manifest_select = ("""SELECT path, size, mtime, content_hash
+                            FROM load_manifest
+                            WHERE path LIKE (%s);
+""")
+
+# ANALYTIC QUERIES
+
+plays_per_user_per_month = ("""SELECT user_id, date_trunc('month', start_time) AS month, count(*)
+                                FROM songplays
+                                GROUP BY user_id, date_trunc('month', start_time)
+                                ORDER BY 3 DESC;
+""")
+
+plays_for_user_in_month = ("""SELECT count(*)
+                                FROM songplays
+                                WHERE user_id = (%s)
+                                AND start_time >= (%s)
+                                AND start_time < (%s);
+""")
+
+songs_for_user_in_month = ("""SELECT songs.title, count(*)
+                                FROM songplays
+                                JOIN songs ON songplays.song_id = songs.song_id
+                                WHERE songplays.user_id = (%s)
+                                AND songplays.start_time >= (%s)
+                                AND songplays.start_time < (%s)
+                                GROUP BY songs.title ORDER BY 2 DESC;
+""")
+
+busiest_user_month_select = ("""SELECT user_id, date_trunc('month', start_time)
+                                FROM songplays
+                                GROUP BY 1, 2 ORDER BY count(*) DESC LIMIT 1;
+""")
+
+# BULK LOAD
+# Each batch is streamed into a session-local staging table with COPY and then
+# merged into the star schema with one set based insert per table, re-using the
+# conflict rules of the single row inserts above. Rows are merged in key order so
+# that parallel loads lock the dimension rows in the same order.
+
+songplay_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS songplays_staging (
+                                start_time timestamp,
+                                user_id int,
+                                level text,
+                                song_id text,
+                                artist_id text,
+                                session_id int,
+                                location text,
+                                user_agent text,
+                                source_file text
+                                ) ON COMMIT DELETE ROWS;
+                            """)
+
+user_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS users_staging (
+                            user_id int,
+                            first_name text,
+                            last_name text,
+                            gender text,
+                            level text,
+                            last_seen timestamp
+                            ) ON COMMIT DELETE ROWS;
+                        """)
+
+song_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS songs_staging (
+                            song_id text,
+                            title text,
+                            artist_id text,
+                            year int,
+                            duration float
+                            ) ON COMMIT DELETE ROWS;
+                        """)
+
+artist_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS artists_staging (
+                            artist_id text,
+                            name text,
+                            location text,
+                            latitude float,
+                            longitude float
+                            ) ON COMMIT DELETE ROWS;
+                        """)
+
+time_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS time_staging (
+                            start_time timestamp,
+                            hour int,
+                            day int,
+                            week int,
+                            month int,
+                            year int,
+                            weekday int
+                            ) ON COMMIT DELETE ROWS;
+                        """)
+
+staging_copy = "COPY {} FROM STDIN WITH (FORMAT csv, NULL '\\N');"
+
+songplay_table_merge = ("""INSERT INTO songplays (
+                            start_time,
+                            user_id,
+                            level,
+                            song_id,
+                            artist_id,
+                            session_id,
+                            location,
+                            user_agent,
+                            source_file)
+                            SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent,
+                            source_file
+                            FROM songplays_staging;
+                        """)
+
+user_table_merge = ("""INSERT INTO users (
+                        user_id,
+                        first_name,
+                        last_name,
+                        gender,
+                        level,
+                        last_seen)
+                        SELECT user_id, first_name, last_name, gender, level, last_seen
+                        FROM users_staging
+                        ORDER BY user_id
+                        {};
+                    """).format(user_table_conflict)
+
+song_table_merge = ("""INSERT INTO songs (
+                        song_id,
+                        title,
+                        artist_id,
+                        year,
+                        duration)
+                        SELECT song_id, title, artist_id, year, duration
+                        FROM songs_staging
+                        ORDER BY song_id
+                        {};
+                    """).format(song_table_conflict)
+
+artist_table_merge = ("""INSERT INTO artists (
+                            artist_id,
+                            name,
+                            location,
+                            latitude,
+                            longitude)
+                            SELECT artist_id, name, location, latitude, longitude
+                            FROM artists_staging
+                            ORDER BY artist_id
+                            {};
+                    """).format(artist_table_conflict)
+
+time_table_merge = ("""INSERT INTO time (
+                        start_time,
+                        hour,
+                        day,
+                        week,
+                        month,
+                        year,
+                        weekday)
+                        SELECT start_time, hour, day, week, month, year, weekday
+                        FROM time_staging
+                        ORDER BY start_time
+                        {};
+                    """).format(time_table_conflict)
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_table_create, songplay_source_file_add, songplay_source_file_index_create, user_table_create, user_last_seen_add, song_table_create, artist_table_create, time_table_create, load_manifest_table_create]
+performance_create_table_queries = [songplay_table_create_partitioned, songplay_source_file_add, songplay_source_file_index_create, user_table_create, user_last_seen_add, song_table_create, artist_table_create, time_table_create, load_manifest_table_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, load_manifest_table_drop]
+
+# staging table, create statement and merge statement for each bulk loaded table
+bulk_load_queries = {
+    'songplays': ('songplays_staging', songplay_staging_create, songplay_table_merge),
+    'users': ('users_staging', user_staging_create, user_table_merge),
+    'songs': ('songs_staging', song_staging_create, song_table_merge),
+    'artists': ('artists_staging', artist_staging_create, artist_table_merge),
+    'time': ('time_staging', time_staging_create, time_table_merge)
+}
\ No newline at end of file
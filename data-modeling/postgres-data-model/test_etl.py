@@ -0,0 +1,166 @@
+import os
+import re
+import json
+import pytest
+
+pytest.importorskip('pandas')
+psycopg2 = pytest.importorskip('psycopg2')
+
+import etl
+from create_tables import create_database, drop_tables, create_schema
+
+SONG_FILES = 6
+LOG_FILES = 4
+EVENTS_PER_FILE = 25
+
+
+def write_data(root):
+    """
+    - Arguments :
+        root - directory the data/song_data and data/log_data files are written under
+
+    - Writes a few song files and log files whose events play those songs, the users
+      change level between files so the users table is updated as well
+    """
+    songs = []
+    for i in range(SONG_FILES):
+        song = {'num_songs': 1, 'artist_id': 'AR{:04d}'.format(i % 3), 'artist_latitude': None,
+                'artist_longitude': None, 'artist_location': '', 'artist_name': 'Artist {}'.format(i % 3),
+                'song_id': 'SO{:04d}'.format(i), 'title': 'Song {}'.format(i), 'duration': 200.0 + i, 'year': 2000}
+        songs.append(song)
+        directory = os.path.join(root, 'data', 'song_data', 'A', 'A', str(i % 2))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'TR{:04d}.json'.format(i)), 'w') as f:
+            json.dump(song, f)
+
+    directory = os.path.join(root, 'data', 'log_data', '2018', '11')
+    os.makedirs(directory)
+    for day in range(LOG_FILES):
+        with open(os.path.join(directory, '2018-11-{:02d}-events.json'.format(day + 1)), 'w') as f:
+            for n in range(EVENTS_PER_FILE):
+                song = songs[n % len(songs)]
+                event = {'artist': song['artist_name'], 'auth': 'Logged In', 'firstName': 'First',
+                         'gender': 'F', 'itemInSession': n, 'lastName': 'Last',
+                         'length': song['duration'] if n % 4 else 1.0, 'level': ['free', 'paid'][day % 2],
+                         'location': 'Somewhere', 'method': 'PUT', 'page': 'NextSong' if n % 5 else 'Home',
+                         'registration': 1540000000000.0, 'sessionId': day * 10 + n % 3,
+                         'song': song['title'], 'status': 200,
+                         'ts': 1541030400000 + day * 86400000 + n * 60000,
+                         'userAgent': 'Mozilla/5.0', 'userId': 1 + n % 4}
+                f.write(json.dumps(event) + '\n')
+
+
+@pytest.fixture
+def data(tmp_path, monkeypatch):
+    """
+    - Writes the test files under tmp_path and runs the test from there, as etl.main reads
+      data/song_data and data/log_data, with an empty sparkifydb
+    """
+    try:
+        cur, conn = create_database()
+    except psycopg2.OperationalError:
+        pytest.skip('sparkifydb is not reachable')
+    drop_tables(cur, conn)
+    create_schema(cur, conn)
+    conn.close()
+
+    write_data(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+
+    etl.metrics.enabled = False
+    etl.metrics.clear()
+
+
+def pending_counts(output):
+    """
+    - Return :
+        the number of new or changed files of each stage printed by an incremental run
+    """
+    return [int(count) for count in re.findall(r'^(\d+) new or changed files to load', output, re.MULTILINE)]
+
+
+def table_counts():
+    """
+    - Return :
+        dict of table name to its number of rows
+    """
+    conn = psycopg2.connect(etl.DSN)
+    cur = conn.cursor()
+    counts = {}
+    for table in ['songplays', 'users', 'songs', 'artists', 'time', 'load_manifest']:
+        cur.execute('SELECT COUNT(*) FROM {}'.format(table))
+        counts[table] = cur.fetchone()[0]
+    conn.close()
+    return counts
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_incremental_rerun_loads_nothing(data, capsys, workers):
+    etl.main(incremental=True, workers=workers)
+    assert pending_counts(capsys.readouterr().out) == [SONG_FILES, LOG_FILES]
+    loaded = table_counts()
+    assert loaded['load_manifest'] == SONG_FILES + LOG_FILES
+    assert loaded['songplays'] == LOG_FILES * EVENTS_PER_FILE * 4 // 5
+
+    etl.main(incremental=True, workers=workers)
+    assert pending_counts(capsys.readouterr().out) == [0, 0]
+    assert table_counts() == loaded
+
+
+@pytest.mark.parametrize('workers,bulk', [(None, False), (2, False), (None, True), (2, True)])
+def test_incremental_reloads_appended_file_once(data, capsys, workers, bulk):
+    etl.main(bulk=bulk, incremental=True, workers=workers)
+    loaded = table_counts()
+
+    # append the events of a later hour of the same day to one of the loaded log files
+    path = os.path.join('data', 'log_data', '2018', '11', '2018-11-01-events.json')
+    with open(path) as f:
+        events = [json.loads(line) for line in f][:10]
+    with open(path, 'a') as f:
+        for event in events:
+            f.write(json.dumps(dict(event, ts=event['ts'] + 3600000)) + '\n')
+    appended = sum(1 for event in events if event['page'] == 'NextSong')
+
+    capsys.readouterr()
+    etl.main(bulk=bulk, incremental=True, workers=workers)
+    assert pending_counts(capsys.readouterr().out) == [0, 1]
+    assert table_counts()['songplays'] == loaded['songplays'] + appended
+
+
+@pytest.mark.parametrize('workers', [None, 4])
+def test_users_keep_level_of_latest_event(data, workers):
+    etl.main(workers=workers)
+
+    conn = psycopg2.connect(etl.DSN)
+    cur = conn.cursor()
+    cur.execute('SELECT DISTINCT level, last_seen::date FROM users')
+    levels = cur.fetchall()
+    conn.close()
+
+    # every user plays on every day, the last day's level wins whichever file finished last
+    assert [(level, str(day)) for level, day in levels] == [(['free', 'paid'][(LOG_FILES - 1) % 2],
+                                                             '2018-11-{:02d}'.format(LOG_FILES))]
+
+
+def test_parallel_metrics_match_serial(data, tmp_path):
+    totals = {}
+    for workers in [None, 3]:
+        cur, conn = create_database()
+        drop_tables(cur, conn)
+        create_schema(cur, conn)
+        conn.close()
+
+        path = str(tmp_path / 'metrics-{}.json'.format(workers))
+        etl.main(workers=workers, metrics_path=path)
+        etl.metrics.clear()
+        with open(path) as f:
+            counts = json.load(f)['counts']
+        # the users written depend on the order the workers finish the files in, so only the other
+        # tables are compared
+        totals[workers] = {name: count for name, count in counts.items()
+                           if name.startswith('lookup:') or (name.startswith('rows:') and ':users:' not in name
+                                                            and name.endswith(':written'))}
+
+    assert totals[None]
+    assert totals[3] == totals[None]
@@ -0,0 +1,61 @@
+import json
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('psycopg2')
+
+from reader import read_json_chunks
+
+
+def write_events(path, pages):
+    """
+    - Arguments :
+        path  - location of the JSON lines file written
+        pages - page of each event, the events are numbered in ts
+    """
+    with open(path, 'w') as f:
+        for ts, page in enumerate(pages):
+            f.write(json.dumps({'ts': ts, 'page': page}) + '\n')
+
+
+def test_rebatches_across_files(tmp_path):
+    first, second = str(tmp_path / 'first.json'), str(tmp_path / 'second.json')
+    write_events(first, ['NextSong'] * 4)
+    write_events(second, ['NextSong'] * 3)
+
+    batches = list(read_json_chunks([first, second], chunksize=3))
+
+    assert [len(df) for df in batches] == [3, 3, 1]
+    assert [list(df.index) for df in batches] == [[0, 1, 2], [3, 4, 5], [6]]
+    assert [list(df['ts']) for df in batches] == [[0, 1, 2], [3, 0, 1], [2]]
+
+
+def test_keeps_only_the_page(tmp_path):
+    path = str(tmp_path / 'events.json')
+    write_events(path, ['NextSong', 'Home', 'NextSong', 'Logout', 'Home', 'NextSong'])
+
+    batches = list(read_json_chunks([path], chunksize=2, page='NextSong'))
+
+    assert [list(df['ts']) for df in batches] == [[0, 2], [5]]
+    assert all((df['page'] == 'NextSong').all() for df in batches)
+
+
+def test_skips_files_without_the_page(tmp_path):
+    first, second = str(tmp_path / 'first.json'), str(tmp_path / 'second.json')
+    write_events(first, ['Home', 'Home'])
+    write_events(second, ['NextSong'])
+
+    batches = list(read_json_chunks([first, second], chunksize=10, page='NextSong'))
+
+    assert [len(df) for df in batches] == [1]
+
+
+def test_source_file(tmp_path):
+    first, second = str(tmp_path / 'first.json'), str(tmp_path / 'second.json')
+    write_events(first, ['NextSong'] * 2)
+    write_events(second, ['NextSong'] * 2)
+
+    df, = read_json_chunks([first, second], chunksize=4, source=True)
+
+    assert list(df['source_file']) == [first, first, second, second]
+    assert 'source_file' not in next(read_json_chunks([first], chunksize=4))
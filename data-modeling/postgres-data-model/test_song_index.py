@@ -0,0 +1,83 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from sql_queries import song_index_select
+from song_index import SongIndex
+
+SONGS = [('Song A', 'Artist 1', 200.0, 'SO1', 'AR1'),
+         ('Song B', 'Artist 1', 180.5, 'SO2', 'AR1'),
+         ('Song A', 'Artist 2', 200.0, 'SO3', 'AR2')]
+
+
+class FakeCursor:
+    """
+    Cursor returning the given rows from any query, recording the queries run
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def execute(self, query, vars=None):
+        self.queries.append(query)
+
+    def fetchall(self):
+        return self.rows
+
+
+def events(*rows, index=None):
+    """
+    - Arguments :
+        rows  - (song, artist, length) of each event
+        index - index of the events, 0 to n by default
+
+    - Return :
+        log events with the columns resolve reads
+    """
+    return pd.DataFrame(rows, columns=['song', 'artist', 'length'], index=index)
+
+
+def test_from_tables():
+    cur = FakeCursor(SONGS)
+
+    index = SongIndex.from_tables(cur)
+
+    assert cur.queries == [song_index_select]
+    assert len(index) == 3
+
+
+def test_resolve_exact_match():
+    index = SongIndex.from_tables(FakeCursor(SONGS))
+
+    found = index.resolve(events(('Song A', 'Artist 2', 200.0), ('Song B', 'Artist 1', 180.5),
+                                 ('Song B', 'Artist 1', 180.6), index=[10, 11, 12]))
+
+    assert list(found.index) == [10, 11, 12]
+    assert found.values.tolist() == [['SO3', 'AR2'], ['SO2', 'AR1'], [None, None]]
+
+
+def test_resolve_missing_values():
+    index = SongIndex.from_tables(FakeCursor(SONGS))
+
+    found = index.resolve(events(('Song A', None, 200.0), ('Song A', 'Artist 1', 200.0)))
+
+    assert found.values.tolist() == [[None, None], ['SO1', 'AR1']]
+
+
+def test_resolve_with_tolerance_picks_nearest():
+    index = SongIndex.from_tables(FakeCursor(SONGS + [('Song A', 'Artist 1', 201.0, 'SO4', 'AR1')]), tolerance=0.5)
+
+    found = index.resolve(events(('Song A', 'Artist 1', 200.4), ('Song A', 'Artist 1', 200.6),
+                                 ('Song A', 'Artist 1', 202.0)))
+
+    assert found['song_id'].tolist() == ['SO1', 'SO4', None]
+
+
+def test_add_first_song_wins():
+    index = SongIndex()
+    index.add(pd.DataFrame([SONGS[0]], columns=SongIndex.columns))
+    index.add(pd.DataFrame([('Song A', 'Artist 1', 200.0, 'SO9', 'AR9')], columns=SongIndex.columns))
+
+    assert len(index) == 1
+    assert index.resolve(events(('Song A', 'Artist 1', 200.0)))['song_id'].tolist() == ['SO1']
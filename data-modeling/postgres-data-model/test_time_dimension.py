@@ -0,0 +1,63 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from time_dimension import TimeCache, build_time_df, calendar_rows
+
+
+def time_rows(*timestamps):
+    """
+    - Return :
+        time table rows of the given timestamps
+    """
+    return build_time_df(pd.Series(pd.to_datetime(list(timestamps))))
+
+
+def test_build_time_df():
+    df = time_rows('2018-11-04 23:30:00', '2018-11-05 01:00:00', '2018-11-04 23:30:00')
+
+    assert list(df.columns) == ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
+    assert len(df) == 2
+    # 2018-11-04 is the Sunday ending ISO week 44, the Monday after starts week 45
+    assert df[['hour', 'day', 'week', 'month', 'year', 'weekday']].values.tolist() == [
+        [23, 4, 44, 11, 2018, 6], [1, 5, 45, 11, 2018, 0]]
+
+
+def test_calendar_rows():
+    df = calendar_rows('2018-11-01', '2018-11-02')
+
+    assert len(df) == 25
+    assert list(df['hour'][:3]) == [0, 1, 2]
+
+
+def test_unseen_only_returns_new_timestamps():
+    cache = TimeCache()
+
+    first = cache.unseen(time_rows('2018-11-01 00:00:00', '2018-11-01 01:00:00'))
+    second = cache.unseen(time_rows('2018-11-01 01:00:00', '2018-11-01 02:00:00'))
+
+    assert len(first) == 2
+    assert list(second['hour']) == [2]
+    assert len(cache) == 3
+
+
+def test_evicts_least_recently_seen():
+    cache = TimeCache(maxsize=2)
+
+    cache.unseen(time_rows('2018-11-01 00:00:00', '2018-11-01 01:00:00'))
+    # seeing midnight again makes 1am the least recently seen
+    cache.unseen(time_rows('2018-11-01 00:00:00'))
+    cache.unseen(time_rows('2018-11-01 02:00:00'))
+
+    assert len(cache) == 2
+    assert list(cache.unseen(time_rows('2018-11-01 00:00:00', '2018-11-01 01:00:00'))['hour']) == [1]
+
+
+def test_clear():
+    cache = TimeCache()
+    cache.unseen(time_rows('2018-11-01 00:00:00'))
+
+    cache.clear()
+
+    assert len(cache) == 0
+    assert len(cache.unseen(time_rows('2018-11-01 00:00:00'))) == 1
@@ -0,0 +1,94 @@
+from datetime import datetime
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from sql_queries import user_level_select
+from user_cache import UserCache, latest_users
+
+
+class FakeCursor:
+    """
+    Cursor returning the given rows from any query, recording the queries run
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def execute(self, query, vars=None):
+        self.queries.append(query)
+
+    def fetchall(self):
+        return self.rows
+
+
+def events(*rows):
+    """
+    - Arguments :
+        rows - (userId, level, ts) of each event
+
+    - Return :
+        NextSong events with the columns latest_users reads
+    """
+    df = pd.DataFrame(rows, columns=['userId', 'level', 'ts'])
+    df['firstName'], df['lastName'], df['gender'] = 'First', 'Last', 'F'
+    df['start_time'] = pd.to_datetime(df['ts'], unit='ms')
+    return df
+
+
+def test_latest_users_keeps_last_event_by_ts():
+    users = latest_users(events((1, 'paid', 3000), (1, 'free', 1000), (2, 'free', 2000)))
+
+    assert list(users.columns) == ['user_id', 'first_name', 'last_name', 'gender', 'level', 'last_seen']
+    assert users.set_index('user_id')['level'].to_dict() == {1: 'paid', 2: 'free'}
+    assert users.set_index('user_id')['last_seen'].to_dict()[1] == pd.Timestamp(3000, unit='ms')
+
+
+def test_from_tables():
+    cur = FakeCursor([(1, 'free', datetime(2018, 11, 1)), (2, 'paid', None)])
+
+    cache = UserCache.from_tables(cur)
+
+    assert cur.queries == [user_level_select]
+    assert len(cache) == 2
+    assert cache.levels == {1: 'free', 2: 'paid'}
+
+
+def test_changed_writes_new_users_and_level_changes():
+    cache = UserCache([(1, 'free', datetime(1970, 1, 1))])
+
+    changed = cache.changed(latest_users(events((1, 'free', 1000), (2, 'free', 1000))))
+    assert list(changed['user_id']) == [2]
+
+    changed = cache.changed(latest_users(events((1, 'paid', 2000), (2, 'free', 2000))))
+    assert list(changed['user_id']) == [1]
+    assert cache.levels == {1: 'paid', 2: 'free'}
+
+
+def test_changed_ignores_older_events():
+    cache = UserCache([(1, 'paid', datetime(1970, 1, 1, 0, 0, 5))])
+
+    # an earlier file loaded late must not bring back the user's old level
+    assert cache.changed(latest_users(events((1, 'free', 1000)))).empty
+    assert cache.levels == {1: 'paid'}
+
+    # a later event at the level the snapshot was taken from does not write either
+    assert cache.changed(latest_users(events((1, 'paid', 9000)))).empty
+    assert list(cache.changed(latest_users(events((1, 'free', 10000))))['level']) == ['free']
+
+
+def test_changed_without_last_seen():
+    # a user loaded before last_seen was recorded takes the level of any later event
+    cache = UserCache([(1, 'paid', None)])
+
+    assert list(cache.changed(latest_users(events((1, 'free', 1000))))['level']) == ['free']
+
+
+def test_clear():
+    cache = UserCache([(1, 'free', datetime(2018, 11, 1))])
+
+    cache.clear()
+
+    assert len(cache) == 0
+    assert list(cache.changed(latest_users(events((1, 'free', 1000))))['user_id']) == [1]
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import pandas as pd
+
+
+def build_time_df(t):
+    """
+    - Arguments :
+        t - Series of timestamps
+
+    - Breaks each timestamp down into the hour, day, week, month, year and weekday columns of
+      the time table with column wise accessors, the week is the ISO calendar week
+
+    - Return :
+        DataFrame with one row per distinct timestamp, in the column order of the time table
+    """
+    t = pd.Series(t.unique())
+    iso = t.dt.isocalendar()
+
+    return pd.DataFrame({
+        'start_time': t,
+        'hour': t.dt.hour,
+        'day': t.dt.day,
+        'week': iso['week'].astype(int),
+        'month': t.dt.month,
+        'year': t.dt.year,
+        'weekday': t.dt.weekday
+    })
+
+
+def calendar_rows(start, end, freq='h'):
+    """
+    - Arguments :
+        start - first timestamp of the range
+        end   - last timestamp of the range
+        freq  - pandas frequency of the generated timestamps, hourly by default
+
+    - Generates the time table rows of a whole date range at once, for example to pre-load
+      the calendar of a month before its logs arrive
+
+    - Return :
+        DataFrame in the column order of the time table
+    """
+    return build_time_df(pd.Series(pd.date_range(start, end, freq=freq)))
+
+
+class TimeCache:
+    """
+    Process local record of the start_time values already sent to the time table, so each
+    file only sends the timestamps this process has not seen before.
+
+    - The least recently seen timestamps are evicted once maxsize is reached, an evicted
+      timestamp that turns up again is sent again and ignored by ON CONFLICT (start_time)
+
+    - Memory use is roughly 100 bytes per timestamp, about 10MB at the default maxsize
+    """
+
+    def __init__(self, maxsize=100000):
+        """
+        - Arguments :
+            maxsize - largest number of timestamps kept
+        """
+        self.maxsize = maxsize
+        self.seen = OrderedDict()
+
+    def __len__(self):
+        return len(self.seen)
+
+    def clear(self):
+        """
+        - Forgets every timestamp, used when the transaction that sent them is rolled back
+        """
+        self.seen.clear()
+
+    def unseen(self, time_df):
+        """
+        - Arguments :
+            time_df - DataFrame of time table rows
+
+        - Marks every start_time of time_df as seen, evicting the least recently seen
+          timestamps over maxsize
+
+        - Return :
+            the rows of time_df whose start_time had not been seen
+        """
+        keys = time_df['start_time'].values.astype('int64')
+
+        mask = []
+        for key in keys:
+            if key in self.seen:
+                self.seen.move_to_end(key)
+                mask.append(False)
+            else:
+                self.seen[key] = None
+                mask.append(True)
+
+        while len(self.seen) > self.maxsize:
+            self.seen.popitem(last=False)
+
+        return time_df[mask]
@@ -0,0 +1,88 @@
+import pandas as pd
+from sql_queries import user_level_select
+
+
+def latest_users(df):
+    """
+    - Arguments :
+        df - batch of NextSong events
+
+    - Reduces the batch to the latest state of each user, the user columns of the user's
+      last event by ts, with the start_time of that event as last_seen
+
+    - Return :
+        DataFrame of user_id, first_name, last_name, gender, level and last_seen, one row per user
+    """
+    users = df.sort_values('ts', kind='stable').drop_duplicates('userId', keep='last')
+    users = users[['userId','firstName','lastName','gender','level','start_time']]
+    users.columns = ['user_id', 'first_name', 'last_name', 'gender', 'level', 'last_seen']
+    return users.astype({'user_id': int, 'level': object})
+
+
+class UserCache:
+    """
+    Process local snapshot of the level of every user in the users table and the time of
+    the event it was taken from, so a batch only writes the users that are new or whose
+    level changed in a later event rather than updating every user on every event.
+
+    - The snapshot is only kept up to date by the process's own writes, so it is used by
+      serial loads only, parallel workers leave the ordering to the users upsert
+
+    - Memory use is roughly 250 bytes per user
+    """
+
+    def __init__(self, users=None):
+        """
+        - Arguments :
+            users - iterable of (user_id, level, last_seen) to start the snapshot from
+        """
+        self.levels = {}
+        self.seen = {}
+        for user_id, level, last_seen in users or []:
+            self.levels[user_id] = level
+            self.seen[user_id] = last_seen
+
+    @classmethod
+    def from_tables(cls, cur):
+        """
+        - Arguments :
+            cur - Database Cursor
+
+        - Return :
+            snapshot of the level of every user already in the users table
+        """
+        cur.execute(user_level_select)
+        return cls(cur.fetchall())
+
+    def __len__(self):
+        return len(self.levels)
+
+    def clear(self):
+        """
+        - Forgets every user, used when the transaction that wrote them is rolled back, every
+          user of the next batch is then written again
+        """
+        self.levels.clear()
+        self.seen.clear()
+
+    def changed(self, users):
+        """
+        - Arguments :
+            users - DataFrame of user rows as returned by latest_users
+
+        - Records the level and last_seen of the users seen later than in the snapshot, a
+          row older than the snapshot is from a file loaded out of order and is ignored
+
+        - Return :
+            the rows of users that are new or whose level differs from the snapshot in a
+            later event
+        """
+        known = users['user_id'].map(self.levels)
+        seen = pd.to_datetime(users['user_id'].map(self.seen))
+        later = seen.isna() | (users['last_seen'] > seen)
+        changed = users[known.isna() | (later & (known != users['level']))]
+
+        latest = users[later]
+        self.levels.update(zip(latest['user_id'], latest['level']))
+        self.seen.update(zip(latest['user_id'], latest['last_seen']))
+        return changed
@@ -0,0 +1,549 @@
+import argparse
+import json
+import os
+import re
+import time
+from collections import defaultdict
+import psycopg2
+from sql_queries import create_table_queries, table_names
+from staging_loader import postgres_ddl
+
+# largest table, in rows, distributed to every node, the largest table of the workload is never
+ALL_ROWS = 5000000
+
+# fewest distinct values of a distribution key, fewer leave some slices with far more rows
+MIN_DISTINCT = 10000
+
+# share of a table's rows a range filter on its leading sort key is assumed to read
+RANGE_SELECTIVITY = 0.1
+
+# cost of a row sent to another slice for a join, in rows scanned
+MOVE_COST = 4
+
+# weight of each use of a column in its sort key score
+SORT_WEIGHTS = {'filter': 4, 'join': 2, 'group': 1}
+
+# column types AZ64 encodes, text is encoded with BYTEDICT when it has few values and ZSTD otherwise
+AZ64_TYPES = {'smallint', 'int', 'int2', 'int4', 'int8', 'integer', 'bigint', 'numeric', 'decimal', 'date',
+              'timestamp', 'timestamptz'}
+BYTEDICT_DISTINCT = 256
+
+SQL_KEYWORDS = {'on', 'where', 'join', 'inner', 'left', 'right', 'full', 'cross', 'group', 'order', 'limit',
+                'using', 'natural', 'having', 'union'}
+
+TABLE_REFERENCE = re.compile(r'\b(?:from|join)\s+(\w+)(?:\s+(?:as\s+)?(?!(?:{})\b)(\w+))?'.format('|'.join(SQL_KEYWORDS)),
+                             re.IGNORECASE)
+COLUMN_REFERENCE = re.compile(r'(?<![\w.])(?:(\w+)\.)?(\w+)\b(?!\s*\()')
+JOIN_PREDICATE = re.compile(r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)')
+FILTER_PREDICATE = re.compile(r'(?<![\w.])(?:(\w+)\.)?(\w+)\s*(=|<>|!=|<=|>=|<|>|\bbetween\b|\bin\b|\blike\b)\s*(\w+\.\w+)?',
+                              re.IGNORECASE)
+CLAUSES = re.compile(r'\b(where|group\s+by|order\s+by|having|limit)\b', re.IGNORECASE)
+
+# an IDENTITY or DEFAULT right after a column's type, Redshift only accepts ENCODE after them
+COLUMN_DEFAULT = re.compile(r'^(?:(?:generated\s+by\s+default\s+as\s+)?identity\s*\([^)]*\)|default\s+(?:\([^)]*\)|\S+))',
+                            re.IGNORECASE)
+
+
+def read_workload(path):
+    """Read a file of queries separated by semicolons, a query preceded by a -- weight: n
+    comment counts n times, the others once
+
+    Keyword arguments:
+    path -- location of the workload file
+
+    Returns a list of (weight, query)
+    """
+    with open(path) as f:
+        text = f.read()
+
+    workload = []
+    for statement in text.split(';'):
+        weight = re.search(r'--\s*weight:\s*([\d.]+)', statement)
+        query = re.sub(r'--[^\n]*', '', statement).strip()
+        if query:
+            workload.append((float(weight.group(1)) if weight else 1.0, query))
+    return workload
+
+
+def split_columns(ddl):
+    """Split a CREATE TABLE statement into its table name, the column definitions between its
+    parentheses and the table attributes after them
+
+    Keyword arguments:
+    ddl -- CREATE TABLE statement
+    """
+    table = re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', ddl, re.IGNORECASE).group(1)
+    start = ddl.index('(')
+
+    depth, columns, column = 0, [], ''
+    for position in range(start + 1, len(ddl)):
+        character = ddl[position]
+        depth += {'(': 1, ')': -1}.get(character, 0)
+        if depth < 0:
+            break
+        if character == ',' and depth == 0:
+            columns.append(' '.join(column.split()))
+            column = ''
+        else:
+            column += character
+    columns.append(' '.join(column.split()))
+
+    return table, [column for column in columns if column], ddl[position + 1:].strip().rstrip(';')
+
+
+def current_layout(ddl):
+    """Read the distribution style and key and the sort key of a Redshift CREATE TABLE
+
+    Keyword arguments:
+    ddl -- CREATE TABLE statement
+
+    Returns the layout dict of the table, encodings are not read
+    """
+    table, columns, attributes = split_columns(ddl)
+    distkey = [column.split()[0] for column in columns if re.search(r'\bDISTKEY\b', column, re.IGNORECASE)]
+    sortkey = [column.split()[0] for column in columns if re.search(r'\bSORTKEY\b', column, re.IGNORECASE)]
+
+    match = re.search(r'\bDISTKEY\s*\((\w+)\)', attributes, re.IGNORECASE)
+    distkey += [match.group(1)] if match else []
+    match = re.search(r'\bSORTKEY\s*\(([^)]*)\)', attributes, re.IGNORECASE)
+    sortkey += [name.strip() for name in match.group(1).split(',')] if match else []
+
+    match = re.search(r'\bDISTSTYLE\s+(\w+)', attributes, re.IGNORECASE)
+    if distkey:
+        dist = ('KEY', distkey[0])
+    else:
+        dist = (match.group(1).upper() if match else 'AUTO', None)
+
+    return {'dist': dist, 'sort': sortkey, 'encodings': {}}
+
+
+def analyse_query(query, columns):
+    """Find the tables a query reads, its equality joins, the columns it filters on and the
+    columns it groups or orders by. Columns are resolved through the table aliases, an
+    unqualified column is resolved when only one of the query's tables has it
+
+    Keyword arguments:
+    query -- SQL query
+    columns -- dict of table name to its column names
+
+    Returns a dict of tables, joins as ((table, column), (table, column)), filters as
+    (table, column, 'eq' or 'range') and groups as (table, column)
+    """
+    query = re.sub(r"'[^']*'", "''", query)
+
+    aliases = {}
+    for table, alias in TABLE_REFERENCE.findall(query):
+        if table in columns:
+            aliases[table] = table
+            if alias:
+                aliases[alias] = table
+    tables = set(aliases.values())
+
+    def resolve(qualifier, name):
+        if qualifier:
+            table = aliases.get(qualifier)
+            return (table, name) if table and name in columns[table] else None
+        owners = [table for table in tables if name in columns[table]]
+        return (owners[0], name) if len(owners) == 1 else None
+
+    joins = []
+    for left_table, left, right_table, right in JOIN_PREDICATE.findall(query):
+        left, right = resolve(left_table, left), resolve(right_table, right)
+        if left and right and left[0] != right[0]:
+            joins.append((left, right))
+
+    parts = CLAUSES.split(query)
+    clauses = defaultdict(str)
+    for keyword, text in zip(parts[1::2], parts[2::2]):
+        clauses[re.sub(r'\s+', ' ', keyword.lower())] += ' ' + text
+
+    filters = []
+    for qualifier, name, operator, other in FILTER_PREDICATE.findall(clauses['where']):
+        column = resolve(qualifier, name)
+        if column and not other:
+            filters.append(column + ('eq' if operator.lower() in ('=', 'in') else 'range',))
+
+    groups = []
+    for qualifier, name in COLUMN_REFERENCE.findall(clauses['group by'] + ' ' + clauses['order by']):
+        column = resolve(qualifier, name)
+        if column and column not in groups:
+            groups.append(column)
+
+    return {'tables': tables, 'joins': joins, 'filters': filters, 'groups': groups}
+
+
+def rows(stats, table):
+    """Number of rows of a table in the stats, 0 when it is not listed
+
+    Keyword arguments:
+    stats -- dict of table to its rows and distinct values by column
+    table -- table name
+    """
+    return stats.get(table, {}).get('rows', 0)
+
+
+def distinct(stats, table, column):
+    """Number of distinct values of a column in the stats, every row when it is not listed
+
+    Keyword arguments:
+    stats -- dict of table to its rows and distinct values by column
+    table -- table name
+    column -- column name
+    """
+    return stats.get(table, {}).get('distinct', {}).get(column, rows(stats, table))
+
+
+def column_encoding(definition, distinct_values, first_sort):
+    """Choose the compression encoding of a column, the leading sort key column is left RAW
+    so the zone maps of its blocks are not read through a decompression
+
+    Keyword arguments:
+    definition -- column definition of the CREATE TABLE
+    distinct_values -- number of distinct values of the column
+    first_sort -- whether the column is the first column of the sort key
+    """
+    data_type = definition.split()[1].lower().split('(')[0]
+    if first_sort or data_type in ('boolean', 'bool'):
+        return 'RAW'
+    if data_type in AZ64_TYPES:
+        return 'AZ64'
+    if data_type in ('text', 'varchar', 'char', 'character') and distinct_values <= BYTEDICT_DISTINCT:
+        return 'BYTEDICT'
+    return 'ZSTD'
+
+
+def recommend(analysed, stats, definitions, all_rows=ALL_ROWS):
+    """Recommend the distribution, sort key and encodings of every table the workload reads.
+
+    - A table of at most all_rows rows, other than the workload's largest table, is copied to
+      every node with DISTSTYLE ALL so its joins never move rows
+
+    - The other tables are decided largest first: each is distributed on the join column with
+      the most weighted rows saved, a join to a table already distributed on the other column
+      saving twice as much as one to a table not decided yet, and EVEN when no join column
+      saves anything or has fewer than MIN_DISTINCT values
+
+    - The sort key is the two columns with the highest weighted use in filters, joins and
+      group or order by, in SORT_WEIGHTS
+
+    Keyword arguments:
+    analysed -- list of (weight, analysed query) of the workload
+    stats -- dict of table to its rows and distinct values by column
+    definitions -- dict of table name to its column definitions
+    all_rows -- largest table distributed to every node
+
+    Returns the dict of table to its layout and the dict of table to its ranked distribution
+    and sort key candidates
+    """
+    tables = sorted({table for weight, usage in analysed for table in usage['tables']},
+                    key=lambda table: rows(stats, table), reverse=True)
+
+    edges = defaultdict(list)
+    sort_scores = defaultdict(lambda: defaultdict(float))
+    for weight, usage in analysed:
+        for left, right in usage['joins']:
+            edges[left[0]].append((left[1], right, weight))
+            edges[right[0]].append((right[1], left, weight))
+            sort_scores[left[0]][left[1]] += weight * SORT_WEIGHTS['join']
+            sort_scores[right[0]][right[1]] += weight * SORT_WEIGHTS['join']
+        for table, column, kind in usage['filters']:
+            sort_scores[table][column] += weight * SORT_WEIGHTS['filter']
+        for table, column in usage['groups']:
+            sort_scores[table][column] += weight * SORT_WEIGHTS['group']
+
+    layouts, candidates = {}, {}
+    for table in tables:
+        if table != tables[0] and rows(stats, table) <= all_rows:
+            layouts[table] = {'dist': ('ALL', None)}
+
+    for table in tables:
+        scores = defaultdict(float)
+        for column, (other, other_column), weight in edges[table]:
+            if distinct(stats, table, column) < MIN_DISTINCT:
+                continue
+            saved = weight * min(rows(stats, table), rows(stats, other))
+            other_dist = layouts.get(other, {}).get('dist')
+            if other_dist is None:
+                scores[column] += saved
+            elif other_dist == ('KEY', other_column):
+                scores[column] += 2 * saved
+        ranked = [('KEY', column) for column in sorted(scores, key=scores.get, reverse=True) if scores[column] > 0]
+
+        if table in layouts:
+            candidates[table] = {'dist': [('ALL', None)] + ranked + [('EVEN', None)]}
+        else:
+            candidates[table] = {'dist': ranked + [('EVEN', None)]}
+            layouts[table] = {'dist': candidates[table]['dist'][0]}
+
+        ranked_sort = sorted(sort_scores[table], key=sort_scores[table].get, reverse=True)
+        candidates[table]['sort'] = ranked_sort
+        layouts[table]['sort'] = ranked_sort[:2]
+
+    for table in tables:
+        layouts[table]['encodings'] = encodings(table, definitions[table], layouts[table]['sort'], stats)
+
+    return layouts, candidates
+
+
+def encodings(table, definitions, sort, stats):
+    """Choose the encoding of each column of a table with column_encoding
+
+    Keyword arguments:
+    table -- table name
+    definitions -- column definitions of the table
+    sort -- sort key columns of the table
+    stats -- dict of table to its rows and distinct values by column
+    """
+    return {definition.split()[0]: column_encoding(definition, distinct(stats, table, definition.split()[0]),
+                                                   definition.split()[0] == (sort[:1] or [None])[0])
+            for definition in definitions}
+
+
+def table_ddl(table, definitions, layout):
+    """Build the Redshift CREATE TABLE of a table with a layout
+
+    Keyword arguments:
+    table -- table name
+    definitions -- column definitions without distribution, sort key or encoding attributes
+    layout -- dict of the dist style and key, the sort key columns and the encoding of each column
+    """
+    lines = []
+    for definition in definitions:
+        name, data_type, rest = (definition.split(' ', 2) + [''])[:3]
+        default = COLUMN_DEFAULT.match(rest)
+        default, rest = (default.group(0), rest[default.end():].strip()) if default else ('', rest)
+        encoding = layout['encodings'].get(name)
+        parts = [name, data_type, default] + (['ENCODE', encoding] if encoding else []) + [rest]
+        lines.append('    ' + ' '.join(part for part in parts if part))
+
+    style, key = layout['dist']
+    attributes = ['DISTSTYLE {}'.format(style)] + (['DISTKEY({})'.format(key)] if key else [])
+    if layout['sort']:
+        attributes.append('COMPOUND SORTKEY({})'.format(', '.join(layout['sort'])))
+
+    return 'CREATE TABLE IF NOT EXISTS {} (\n{}\n)\n{};'.format(table, ',\n'.join(lines), '\n'.join(attributes))
+
+
+def layout_name(dist):
+    """Name of a distribution in a variant name, its key column or its style
+
+    Keyword arguments:
+    dist -- tuple of the dist style and key
+    """
+    style, key = dist
+    return key if key else style.lower()
+
+
+def build_variants(current, advised, candidates):
+    """Build the layouts compared: the current DDL, the advised layout and, for each advised
+    table, the advised layout with the table's next best distribution and next best sort key
+
+    Keyword arguments:
+    current -- dict of table to its current layout
+    advised -- dict of table to its advised layout
+    candidates -- dict of table to its ranked distribution and sort key candidates
+
+    Returns a dict of variant name to its dict of table to layout, None for the current DDL
+    """
+    variants = {'current': None, 'advised': advised}
+    for table in advised:
+        for dist in [dist for dist in candidates[table]['dist'] if dist != advised[table]['dist']][:1]:
+            variants['{}_dist_{}'.format(table, layout_name(dist))] = dict(advised, **{table: dict(advised[table], dist=dist)})
+        for column in [column for column in candidates[table]['sort'] if column not in advised[table]['sort']][:1]:
+            variants['{}_sort_{}'.format(table, column)] = dict(advised, **{table: dict(advised[table], sort=[column])})
+    return variants
+
+
+def variant_ddl(layouts, definitions):
+    """The CREATE TABLE of every table in table_names order for a variant, the tables the
+    workload does not read keep their current DDL
+
+    Keyword arguments:
+    layouts -- dict of table to layout of the variant, None for the current DDL
+    definitions -- dict of table name to its column definitions
+    """
+    return [table_ddl(table, definitions[table], layouts[table]) if layouts and table in layouts else ddl
+            for table, ddl in zip(table_names, create_table_queries)]
+
+
+def estimate_cost(analysed, layouts, stats):
+    """Estimate the weighted cost of the workload with a layout, in rows: each table is scanned
+    whole unless a filter is on its leading sort key, and a join that is not collocated, where
+    neither side is DISTSTYLE ALL nor both are distributed on the joined columns, moves the rows
+    of the smaller side at MOVE_COST per row
+
+    Keyword arguments:
+    analysed -- list of (weight, analysed query) of the workload
+    layouts -- dict of table to layout
+    stats -- dict of table to its rows and distinct values by column
+    """
+    total = 0
+    for weight, usage in analysed:
+        cost = 0
+        for table in usage['tables']:
+            scanned = rows(stats, table)
+            for filtered, column, kind in usage['filters']:
+                if filtered == table and layouts[table]['sort'][:1] == [column]:
+                    selected = 1 / distinct(stats, table, column) if kind == 'eq' else RANGE_SELECTIVITY
+                    scanned = min(scanned, rows(stats, table) * selected)
+            cost += scanned
+
+        for (left, left_column), (right, right_column) in usage['joins']:
+            left_dist, right_dist = layouts[left]['dist'], layouts[right]['dist']
+            if 'ALL' in (left_dist[0], right_dist[0]):
+                continue
+            if left_dist == ('KEY', left_column) and right_dist == ('KEY', right_column):
+                continue
+            cost += MOVE_COST * min(rows(stats, left), rows(stats, right))
+
+        total += weight * cost
+    return total
+
+
+def benchmark_ddl(ddl):
+    """Turn a variant's CREATE TABLE into Postgres DDL without keys or constraints, so the only
+    index on a table is the one emulating its sort key
+
+    Keyword arguments:
+    ddl -- Redshift CREATE TABLE statement
+    """
+    ddl = postgres_ddl(ddl)
+    ddl = re.sub(r'\bidentity\s*\(\s*\d+\s*,\s*\d+\s*\)', '', ddl, flags=re.IGNORECASE)
+    ddl = re.sub(r'\bCOMPOUND\b|\bINTERLEAVED\b|\bPRIMARY\s+KEY\b|\bNOT\s+NULL\b', '', ddl, flags=re.IGNORECASE)
+    return ddl
+
+
+def benchmark(dsn, variants, definitions, current, workload, tables, source_schema='public', runs=3):
+    """Run the workload against every variant on a local Postgres stand-in. Each variant's
+    tables are created in a schema of their own and filled from the star schema tables of the
+    source schema, such as the sparkifydb loaded by the postgres data model ETL. A sort key
+    is emulated with an index on its columns that the table is clustered on, distribution
+    cannot be emulated on one node so variants that only differ by it time the same
+
+    Keyword arguments:
+    dsn -- connection string of the local Postgres database
+    variants -- dict of variant name to its dict of table to layout
+    definitions -- dict of table name to its column definitions
+    current -- dict of table to its current layout
+    workload -- list of (weight, query)
+    tables -- the tables the workload reads
+    source_schema -- schema of the tables the variants are filled from
+    runs -- times each query is run, the fastest is counted
+
+    Returns a list of (variant name, weighted seconds) fastest first
+    """
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    results = []
+    for name, layouts in variants.items():
+        schema = 'advisor_' + re.sub(r'\W', '_', name)
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0};'.format(schema))
+
+        for table, ddl in zip(table_names, variant_ddl(layouts, definitions)):
+            if table not in tables:
+                continue
+            cur.execute(benchmark_ddl(ddl))
+            names = ', '.join(definition.split()[0] for definition in definitions[table])
+            cur.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2}.{0};'.format(table, names, source_schema))
+
+            sort = (layouts or current)[table]['sort']
+            if sort:
+                cur.execute('CREATE INDEX {0}_sortkey ON {0} ({1});'.format(table, ', '.join(sort)))
+                cur.execute('CLUSTER {0} USING {0}_sortkey;'.format(table))
+            cur.execute('ANALYZE {};'.format(table))
+
+        seconds = 0
+        for weight, query in workload:
+            timings = []
+            for run in range(runs):
+                start = time.perf_counter()
+                cur.execute(query)
+                cur.fetchall()
+                timings.append(time.perf_counter() - start)
+            seconds += weight * min(timings)
+        results.append((name, seconds))
+
+        cur.execute('DROP SCHEMA {} CASCADE;'.format(schema))
+
+    conn.close()
+    return sorted(results, key=lambda result: result[1])
+
+
+def print_layouts(current, advised):
+    """Print the current and advised distribution and sort key of each table the workload reads
+
+    Keyword arguments:
+    current -- dict of table to its current layout
+    advised -- dict of table to its advised layout
+    """
+    print('{:<12}{:<22}{:<28}{:<22}{:<28}'.format('table', 'current dist', 'current sort', 'advised dist',
+                                                  'advised sort'))
+    for table, layout in advised.items():
+        print('{:<12}{:<22}{:<28}{:<22}{:<28}'.format(
+            table, ' '.join(filter(None, current[table]['dist'])), ','.join(current[table]['sort']),
+            ' '.join(filter(None, layout['dist'])), ','.join(layout['sort'])))
+        print('{:<12}encodings: {}'.format('', ', '.join('{} {}'.format(*item) for item in layout['encodings'].items())))
+
+
+def main(workload_path, stats_path, output=None, all_rows=ALL_ROWS, dsn=None, source_schema='public', runs=3):
+    """Recommend distribution, sort keys and encodings for the workload, rank the DDL variants
+    by estimated cost, write each to a file for create_tables.py and, with a local Postgres
+    connection string, rank them by running the workload against each
+
+    Keyword arguments:
+    workload_path -- file of the workload's queries
+    stats_path -- JSON file of each table's rows and distinct values by column
+    output -- directory the variants' DDL files are written to
+    all_rows -- largest table distributed to every node
+    dsn -- connection string of a local Postgres database to benchmark the variants on
+    source_schema -- schema of the local tables the variants are filled from
+    runs -- times each query is run by the benchmark
+    """
+    workload = read_workload(workload_path)
+    with open(stats_path) as f:
+        stats = json.load(f)
+
+    definitions, current = {}, {}
+    for table, ddl in zip(table_names, create_table_queries):
+        definitions[table] = split_columns(postgres_ddl(ddl))[1]
+        current[table] = current_layout(ddl)
+    columns = {table: [definition.split()[0] for definition in definitions[table]] for table in definitions}
+
+    analysed = [(weight, analyse_query(query, columns)) for weight, query in workload]
+    advised, candidates = recommend(analysed, stats, definitions, all_rows)
+    variants = build_variants(current, advised, candidates)
+
+    print_layouts(current, advised)
+    print()
+    print('{:<32}{:>20}'.format('variant', 'estimated cost'))
+    for name, layouts in sorted(variants.items(), key=lambda item: estimate_cost(analysed, item[1] or current, stats)):
+        print('{:<32}{:>20.3g}'.format(name, estimate_cost(analysed, layouts or current, stats)))
+
+    if output:
+        os.makedirs(output, exist_ok=True)
+        for name, layouts in variants.items():
+            with open(os.path.join(output, name + '.sql'), 'w') as f:
+                f.write('\n\n'.join(variant_ddl(layouts, definitions)) + '\n')
+        print('\nwrote the DDL of {} variants to {}'.format(len(variants), output))
+
+    if dsn:
+        print('\n{:<32}{:>20}'.format('variant', 'weighted seconds'))
+        for name, seconds in benchmark(dsn, variants, definitions, current, workload, set(advised), source_schema, runs):
+            print('{:<32}{:>20.3f}'.format(name, seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recommend distribution and sort keys for a workload of queries")
+    parser.add_argument("--workload", default="workload.sql", help="file of the workload's queries")
+    parser.add_argument("--stats", default="table_stats.json", help="JSON file of the tables' rows and distinct values")
+    parser.add_argument("--output", help="directory the DDL of each variant is written to, for create_tables.py --ddl")
+    parser.add_argument("--all-rows", type=int, default=ALL_ROWS, help="largest table distributed to every node")
+    parser.add_argument("--benchmark", metavar="DSN",
+                        help="run the workload against each variant on the local Postgres database of this connection string")
+    parser.add_argument("--source-schema", default="public", help="schema of the local tables the variants are filled from")
+    parser.add_argument("--runs", type=int, default=3, help="times each query is run by the benchmark")
+    args = parser.parse_args()
+
+    main(args.workload, args.stats, args.output, args.all_rows, args.benchmark, args.source_schema, args.runs)
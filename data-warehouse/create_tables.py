@@ -1,49 +1,63 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries, insert_table_queries
+import re
+from scheduler import run_graph, print_timing_report
+from sql_queries import create_table_queries, drop_table_queries, table_names
 
 
-def drop_tables(cur, conn):
-    """Drop all tables in the schema as imported with drop_table_queries
+def read_ddl(path):
+    """Read the CREATE TABLE statements of a file, such as a variant written by advisor.py
 
     Keyword arguments:
-    cur -- cursor for executing a sql command in the given database session
-    conn -- the database connection
+    path -- location of the file of statements separated by semicolons
+
+    Returns a dict of table name to its CREATE TABLE statement
     """
-    for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+    with open(path) as f:
+        statements = [statement.strip() + ';' for statement in f.read().split(';') if statement.strip()]
+    return {re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', statement, re.IGNORECASE).group(1): statement
+            for statement in statements}
 
 
-def create_tables(cur, conn):
-    """Create all tables in the schema as imported with create_table_queries
+def table_tasks(ddl=None):
+    """Build the graph of the drop and create statements, each table is created once it
+    has been dropped and the tables do not wait for each other
 
     Keyword arguments:
-    cur -- cursor for executing a sql command in the given database session
-    conn -- the database connection
+    ddl -- dict of table name to a CREATE TABLE used instead of create_table_queries
     """
-    for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+    ddl = ddl or {}
+    tasks = {}
+    for name, drop, create in zip(table_names, drop_table_queries, create_table_queries):
+        tasks['drop ' + name] = (drop, [])
+        tasks['create ' + name] = (ddl.get(name, create), ['drop ' + name])
+    return tasks
 
 
-def main():
+def main(workers=4, retries=3, ddl_path=None):
     """Read the database configuration file
-    Use the configuration to create a database connection and cursor for the database session
-    Then ensure the schema is clean by dropping the tables and recreating them
-    Close the cursor to clean up idle connections
+    Then ensure the schema is clean by dropping the tables and recreating them, as a graph of
+    tasks run on a pool of connections, and print the timing of each task
+    Keyword arguments:
+    workers -- number of statements run at the same time
+    retries -- times a transient failure of a task is retried
+    ddl_path -- file of CREATE TABLE statements used instead of create_table_queries
     """
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
+    dsn = "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
-
-    conn.close()
+    tasks = table_tasks(read_ddl(ddl_path) if ddl_path else None)
+    timings = run_graph(dsn, tasks, workers, retries)
+    print_timing_report(tasks, timings)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Drop and create the staging and star schema tables")
+    parser.add_argument("--workers", type=int, default=4, help="statements run at the same time")
+    parser.add_argument("--retries", type=int, default=3, help="times a transient failure is retried")
+    parser.add_argument("--ddl", help="file of CREATE TABLE statements to use, such as a variant written by advisor.py")
+    args = parser.parse_args()
+
+    main(args.workers, args.retries, args.ddl)
@@ -1,52 +1,40 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from scheduler import run_graph, subgraph, print_timing_report
+from sql_queries import copy_table_tasks, insert_table_tasks
 
 
-def load_staging_tables(cur, conn):
-    """Excute the staging table load queries as imported with copy_table_queries
-    These queries perform a direct copy from json files in S3 to staging tables within RedShift
-
-    Keyword arguments:
-    cur -- cursor for executing a sql command in the given database session
-    conn -- the database connection
-    """
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
-
-
-def insert_tables(cur, conn):
-    """Execute the star schema insert queries as imported from insert_table_queries
-    These copy data from the staging tables, transform the data so it is suitable for fact and dimension
-    tables and then insert it
+def main(workers=4, retries=3, skip_staging=False):
+    """Read the database configuration file
+    Run the staging loads and the star schema merges as a graph of tasks on a pool of connections,
+    each task starting once the tasks it depends on have committed: the staging tables are loaded,
+    then the dimensions are merged from them at the same time and then the songplays fact table
+    Print the timing of each task and the critical path of the run
 
     Keyword arguments:
-    cur -- cursor for executing a sql command in the given database session
-    conn -- the database connection
-    """
-    for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
-
-
-def main():
-    """Read the database configuration file
-    Use the configuration to create a database connection and cursor for the database session
-    Load the data into the dtaging tables, then insert the staging data once tranformed into the star schema
-    Close the cursor to clean up idle connections
+    workers -- number of statements run at the same time
+    retries -- times a transient failure of a task is retried
+    skip_staging -- only merge the staging tables, when they were loaded by staging_loader.py
     """
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    dsn = "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
+
+    tasks = dict(copy_table_tasks, **insert_table_tasks)
+    if skip_staging:
+        tasks = subgraph(tasks, insert_table_tasks)
 
-    conn.close()
+    timings = run_graph(dsn, tasks, workers, retries)
+    print_timing_report(tasks, timings)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Load the staging tables and merge them into the star schema")
+    parser.add_argument("--workers", type=int, default=4, help="statements run at the same time")
+    parser.add_argument("--retries", type=int, default=3, help="times a transient failure is retried")
+    parser.add_argument("--skip-staging", action="store_true",
+                        help="only merge the staging tables, loaded beforehand by staging_loader.py")
+    args = parser.parse_args()
+
+    main(args.workers, args.retries, args.skip_staging)
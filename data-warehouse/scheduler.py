@@ -0,0 +1,175 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import psycopg2
+import psycopg2.errorcodes
+from psycopg2.pool import ThreadedConnectionPool
+
+# SQLSTATEs of failures that can succeed when run again, besides the connection exception class
+TRANSIENT_CODES = {
+    psycopg2.errorcodes.SERIALIZATION_FAILURE,
+    psycopg2.errorcodes.DEADLOCK_DETECTED,
+    psycopg2.errorcodes.ADMIN_SHUTDOWN,
+    psycopg2.errorcodes.CRASH_SHUTDOWN,
+    psycopg2.errorcodes.CANNOT_CONNECT_NOW
+}
+
+# SQLSTATE class of the connection exceptions
+CONNECTION_EXCEPTION_CLASS = psycopg2.errorcodes.CLASS_CONNECTION_EXCEPTION
+
+
+def is_transient(error):
+    """Whether a failed statement can be retried: a lost connection, a serialization failure
+    or deadlock, a server shutting down, or Redshift's serializable isolation violation which it
+    reports as XX000. Other operational errors, such as a statement timeout or a full disk, are not
+
+    Keyword arguments:
+    error -- exception raised by the statement
+    """
+    pgcode = getattr(error, 'pgcode', None)
+    if pgcode is None:
+        # the connection was lost or never made, the server sent no error
+        return isinstance(error, psycopg2.OperationalError)
+    return pgcode in TRANSIENT_CODES or pgcode.startswith(CONNECTION_EXCEPTION_CLASS) \
+        or 'serializable isolation violation' in str(error).lower()
+
+
+def subgraph(tasks, names):
+    """Keep some of the tasks of a graph, dropping the dependencies on the tasks left out,
+    such as the staging loads when the staging tables were loaded by staging_loader.py
+
+    Keyword arguments:
+    tasks -- dict of task name to (statement, names of the tasks it depends on)
+    names -- names of the tasks kept
+    """
+    return {name: (query, [dependency for dependency in depends if dependency in names])
+            for name, (query, depends) in tasks.items() if name in names}
+
+
+def run_task(pool, name, query, retries, backoff):
+    """Run a task's statement on a connection from the pool and commit it, retrying a
+    transient failure after a delay that doubles each attempt. A connection that failed
+    is closed rather than returned to the pool
+
+    Keyword arguments:
+    pool -- pool of database connections
+    name -- name of the task
+    query -- the task's sql statement
+    retries -- times a transient failure is retried
+    backoff -- seconds before the first retry
+
+    Returns the start time of the first attempt, the end time of the successful one and the number of attempts
+    """
+    attempt = 0
+    start = time.perf_counter()
+    while True:
+        attempt += 1
+        conn = None
+        try:
+            conn = pool.getconn()
+            with conn.cursor() as cur:
+                cur.execute(query)
+            conn.commit()
+            pool.putconn(conn)
+            return start, time.perf_counter(), attempt
+        except psycopg2.Error as e:
+            if conn is not None:
+                if not conn.closed:
+                    conn.rollback()
+                pool.putconn(conn, close=True)
+            if attempt > retries or not is_transient(e):
+                raise
+            print('{} failed on attempt {}, retrying: {}'.format(name, attempt, str(e).strip()))
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+
+def run_graph(dsn, tasks, workers=4, retries=3, backoff=2):
+    """Run a graph of sql statements, each as soon as the tasks it depends on have committed,
+    at most workers at the same time on a pool of connections. When a task fails the tasks
+    already running are finished and no more are started before the error is raised
+
+    Keyword arguments:
+    dsn -- connection string of the database
+    tasks -- dict of task name to (statement, names of the tasks it depends on)
+    workers -- number of statements run at the same time
+    retries -- times a transient failure of a task is retried
+    backoff -- seconds before the first retry
+
+    Returns a dict of task name to (start, end, attempts), the times in seconds since the run started
+    """
+    for name, (query, depends) in tasks.items():
+        missing = [dependency for dependency in depends if dependency not in tasks]
+        if missing:
+            raise ValueError('{} depends on unknown tasks {}'.format(name, missing))
+
+    pool = ThreadedConnectionPool(1, workers, dsn)
+    run_start = time.perf_counter()
+    timings = {}
+    running = {}
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            if failure is None:
+                for name, (query, depends) in tasks.items():
+                    if name not in timings and name not in running.values() \
+                            and all(dependency in timings for dependency in depends):
+                        running[executor.submit(run_task, pool, name, query, retries, backoff)] = name
+
+            # nothing running and nothing ready, every task ran or the rest depend on each other
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    start, end, attempts = future.result()
+                    timings[name] = (start - run_start, end - run_start, attempts)
+                except Exception as e:
+                    failure = failure or e
+
+    pool.closeall()
+
+    if failure is not None:
+        raise failure
+    if len(timings) < len(tasks):
+        raise ValueError('the tasks {} depend on each other'.format(sorted(set(tasks) - set(timings))))
+
+    return timings
+
+
+def critical_path(tasks, timings):
+    """Follow the chain of tasks that held up the end of the run, from the task that finished
+    last back through the dependency of each that finished last
+
+    Keyword arguments:
+    tasks -- dict of task name to (statement, names of the tasks it depends on)
+    timings -- task timings returned by run_graph
+
+    Returns the task names of the path in the order they ran
+    """
+    path = []
+    name = max(timings, key=lambda task: timings[task][1]) if timings else None
+    while name is not None:
+        path.append(name)
+        depends = tasks[name][1]
+        name = max(depends, key=lambda task: timings[task][1]) if depends else None
+    return path[::-1]
+
+
+def print_timing_report(tasks, timings):
+    """Print when each task started and how long it ran, then the critical path
+
+    Keyword arguments:
+    tasks -- dict of task name to (statement, names of the tasks it depends on)
+    timings -- task timings returned by run_graph
+    """
+    print('{:<22}{:>10}{:>10}{:>10}'.format('task', 'start', 'seconds', 'attempts'))
+    for name, (start, end, attempts) in sorted(timings.items(), key=lambda item: item[1][0]):
+        print('{:<22}{:>10.2f}{:>10.2f}{:>10}'.format(name, start, end - start, attempts))
+
+    path = critical_path(tasks, timings)
+    if path:
+        busy = sum(timings[name][1] - timings[name][0] for name in path)
+        print('critical path: {} ({:.2f} seconds running of {:.2f} seconds)'.format(
+            ' -> '.join(path), busy, timings[path[-1]][1]))
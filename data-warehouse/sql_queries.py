@@ -17,6 +17,8 @@ time_table_drop = "DROP TABLE IF EXISTS time;"
 
 # CREATE TABLES
 
+# the COPY loads ts into start_time, the jsonpaths map by position, as a timestamp with timeformat 'epochmillisecs'
+# so it is converted once, distributed and sorted like time, rather than by every statement reading staging_events
 staging_events_table_create= ("""CREATE TABLE IF NOT EXISTS staging_events (
                                 artist TEXT,
                                 auth TEXT,
@@ -33,7 +35,7 @@ staging_events_table_create= ("""CREATE TABLE IF NOT EXISTS staging_events (
                                 session_id INTEGER,
                                 song TEXT,
                                 status INTEGER,
-                                ts BIGINT,
+                                start_time TIMESTAMP DISTKEY SORTKEY,
                                 user_agent TEXT,
                                 user_id INTEGER
                                 );
@@ -98,7 +100,7 @@ artist_table_create = ("""CREATE TABLE IF NOT EXISTS artists (
                     """)
 
 time_table_create = ("""CREATE TABLE IF NOT EXISTS time (
-                        start_time timestamp PRIMARY KEY SORTKEY,
+                        start_time timestamp PRIMARY KEY DISTKEY SORTKEY,
                         hour INTEGER NOT NULL,
                         day INTEGER NOT NULL,
                         week INTEGER NOT NULL,
@@ -112,7 +114,7 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS time (
 
 staging_events_copy = ("""copy staging_events from 's3://udacity-dend/log_data'
     credentials 'aws_iam_role={}'
-    json 's3://udacity-dend/log_json_path.json' compupdate off statupdate off region 'us-west-2';
+    json 's3://udacity-dend/log_json_path.json' timeformat 'epochmillisecs' compupdate off statupdate off region 'us-west-2';
 """).format(config.get("IAM_ROLE", "ARN"))
 
 staging_songs_copy = ("""copy staging_songs from 's3://udacity-dend/song_data'
@@ -120,23 +122,83 @@ staging_songs_copy = ("""copy staging_songs from 's3://udacity-dend/song_data'
     json 'auto' compupdate off statupdate off region 'us-west-2';
 """).format(config.get("IAM_ROLE", "ARN"))
 
+# MANIFEST COPIES, the manifest location and the gzip and maxerror options are formatted in by staging_loader.py
+
+staging_events_manifest_copy = ("""copy staging_events from '{{}}'
+    credentials 'aws_iam_role={}'
+    json 's3://udacity-dend/log_json_path.json' timeformat 'epochmillisecs' {{}} manifest compupdate off statupdate off region 'us-west-2';
+""").format(config.get("IAM_ROLE", "ARN"))
+
+staging_songs_manifest_copy = ("""copy staging_songs from '{{}}'
+    credentials 'aws_iam_role={}'
+    json 'auto' {{}} manifest compupdate off statupdate off region 'us-west-2';
+""").format(config.get("IAM_ROLE", "ARN"))
+
+staging_truncate = "TRUNCATE {};"
+
+slices_select = "SELECT COUNT(*) FROM stv_slices;"
+
+# errors of the COPY run on this connection, the loader uses one connection per COPY
+load_errors_select = ("""SELECT TRIM(filename), line_number, TRIM(colname), TRIM(err_reason)
+                        FROM stl_load_errors
+                        WHERE session = pg_backend_pid()
+                        ORDER BY filename, line_number;
+""")
+
+# LOCAL POSTGRES STAND-IN
+
+staging_columns_select = ("""SELECT column_name, data_type
+                            FROM information_schema.columns
+                            WHERE table_name = %s
+                            ORDER BY ordinal_position;
+""")
+
+staging_local_copy = "COPY {} FROM STDIN WITH (FORMAT csv, NULL '\\N');"
+
 # FINAL TABLES
+# staging holds one batch, truncated and loaded by each run, every table is merged by deleting
+# the rows with the batch's keys then inserting the batch, in one transaction, so a rerun of a
+# batch replaces its rows rather than adding them again and costs the size of the batch
 
-songplay_table_insert = ("""INSERT INTO songplays(start_time,user_id,level,song_id,artist_id,session_id,location,user_agent)
-                            SELECT timestamp 'epoch' + ts/1000 * interval '1 second' AS start_time,
-                            staging_events.user_id,
-                            staging_events.level,
-                            staging_songs.song_id,
-                            staging_songs.artist_id,
-                            staging_events.session_id,
-                            staging_events.location,
-                            staging_events.user_agent
-                            FROM staging_events
-                            JOIN staging_songs ON (staging_events.song = staging_songs.title AND staging_events.artist = staging_songs.artist_name)
-                            WHERE page = 'NextSong'
+songplay_table_insert = ("""DELETE FROM songplays
+                            USING staging_events
+                            WHERE staging_events.page = 'NextSong'
+                            AND songplays.start_time = staging_events.start_time
+                            AND songplays.user_id = staging_events.user_id
+                            AND songplays.session_id = staging_events.session_id
+                            AND songplays.start_time BETWEEN (SELECT MIN(start_time) FROM staging_events)
+                                                         AND (SELECT MAX(start_time) FROM staging_events);
+                            INSERT INTO songplays(start_time,user_id,level,song_id,artist_id,session_id,location,user_agent)
+                            SELECT start_time,
+                            user_id,
+                            level,
+                            song_id,
+                            artist_id,
+                            session_id,
+                            location,
+                            user_agent
+                            FROM
+                                (SELECT staging_events.start_time,
+                                staging_events.user_id,
+                                staging_events.level,
+                                songs.song_id,
+                                songs.artist_id,
+                                staging_events.session_id,
+                                staging_events.location,
+                                staging_events.user_agent,
+                                ROW_NUMBER() OVER (PARTITION BY staging_events.start_time, staging_events.user_id, staging_events.session_id
+                                                   ORDER BY songs.song_id) AS event_order
+                                FROM staging_events
+                                JOIN songs ON staging_events.song = songs.title
+                                JOIN artists ON songs.artist_id = artists.artist_id AND staging_events.artist = artists.name
+                                WHERE staging_events.page = 'NextSong')
+                            WHERE event_order = 1;
 """)
 
-user_table_insert = ("""INSERT INTO users (user_id,first_name,last_name,gender,level)
+user_table_insert = ("""DELETE FROM users
+                        USING staging_events
+                        WHERE users.user_id = staging_events.user_id;
+                        INSERT INTO users (user_id,first_name,last_name,gender,level)
                         SELECT user_id,
                         first_name,
                         last_name,
@@ -148,46 +210,68 @@ user_table_insert = ("""INSERT INTO users (user_id,first_name,last_name,gender,l
                             staging_events.last_name,
                             staging_events.gender,
                             staging_events.level,
-                            ROW_NUMBER() OVER (PARTITION BY staging_events.user_id ORDER BY ts desc) AS user_id_order
+                            ROW_NUMBER() OVER (PARTITION BY staging_events.user_id ORDER BY start_time desc) AS user_id_order
                             FROM staging_events
-                            LEFT JOIN users ON users.user_id = staging_events.user_id
-                            WHERE users.user_id IS NULL
-                            AND staging_events.user_id IS NOT NULL)
-                        WHERE user_id_order = 1
+                            WHERE staging_events.user_id IS NOT NULL)
+                        WHERE user_id_order = 1;
 """)
 
-song_table_insert = ("""INSERT INTO songs (song_id,title,artist_id,year,duration)
-                        SELECT DISTINCT staging_songs.song_id,
-                        staging_songs.title,
-                        staging_songs.artist_id,
-                        staging_songs.year,
-                        staging_songs.duration
-                        FROM staging_songs
-                        LEFT JOIN songs ON songs.song_id = staging_songs.song_id
-                        WHERE songs.song_id IS NULL
+song_table_insert = ("""DELETE FROM songs
+                        USING staging_songs
+                        WHERE songs.song_id = staging_songs.song_id;
+                        INSERT INTO songs (song_id,title,artist_id,year,duration)
+                        SELECT song_id,
+                        title,
+                        artist_id,
+                        year,
+                        duration
+                        FROM
+                            (SELECT staging_songs.song_id,
+                            staging_songs.title,
+                            staging_songs.artist_id,
+                            staging_songs.year,
+                            staging_songs.duration,
+                            ROW_NUMBER() OVER (PARTITION BY staging_songs.song_id ORDER BY staging_songs.year desc) AS song_id_order
+                            FROM staging_songs
+                            WHERE staging_songs.song_id IS NOT NULL)
+                        WHERE song_id_order = 1;
 """)
 
-artist_table_insert = ("""INSERT INTO artists (artist_id,name,location,latitude,longitude)
-                            SELECT DISTINCT staging_songs.artist_id,
-                            staging_songs.artist_name,
-                            staging_songs.artist_location,
-                            staging_songs.artist_latitude,
-                            staging_songs.artist_longitude
-                            FROM staging_songs
-                            LEFT JOIN artists ON artists.artist_id = staging_songs.artist_id
-                            WHERE artists.artist_id IS NULL
+artist_table_insert = ("""DELETE FROM artists
+                            USING staging_songs
+                            WHERE artists.artist_id = staging_songs.artist_id;
+                            INSERT INTO artists (artist_id,name,location,latitude,longitude)
+                            SELECT artist_id,
+                            name,
+                            location,
+                            latitude,
+                            longitude
+                            FROM
+                                (SELECT staging_songs.artist_id,
+                                staging_songs.artist_name AS name,
+                                staging_songs.artist_location AS location,
+                                staging_songs.artist_latitude AS latitude,
+                                staging_songs.artist_longitude AS longitude,
+                                ROW_NUMBER() OVER (PARTITION BY staging_songs.artist_id ORDER BY staging_songs.year desc, staging_songs.song_id) AS artist_id_order
+                                FROM staging_songs
+                                WHERE staging_songs.artist_id IS NOT NULL)
+                            WHERE artist_id_order = 1;
 """)
 
-time_table_insert = ("""INSERT INTO time (start_time,hour,day,week,month,year,weekday)
-                        SELECT DISTINCT timestamp 'epoch' + ts/1000 * interval '1 second' AS start_time,
-                        EXTRACT(HOUR FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS hour,
-                        EXTRACT(DAY FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS day,
-                        EXTRACT(WEEK FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS week,
-                        EXTRACT(MONTH FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS month,
-                        EXTRACT(YEAR FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS year,
-                        EXTRACT(DAY FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS weekday
-                        FROM staging_events LEFT JOIN time on time.start_time = (timestamp 'epoch' + staging_events.ts/1000 * interval '1 second')
-                        WHERE time.start_time IS NULL
+time_table_insert = ("""DELETE FROM time
+                        USING staging_events
+                        WHERE time.start_time = staging_events.start_time
+                        AND time.start_time BETWEEN (SELECT MIN(start_time) FROM staging_events)
+                                                AND (SELECT MAX(start_time) FROM staging_events);
+                        INSERT INTO time (start_time,hour,day,week,month,year,weekday)
+                        SELECT start_time,
+                        EXTRACT(HOUR FROM start_time) AS hour,
+                        EXTRACT(DAY FROM start_time) AS day,
+                        EXTRACT(WEEK FROM start_time) AS week,
+                        EXTRACT(MONTH FROM start_time) AS month,
+                        EXTRACT(YEAR FROM start_time) AS year,
+                        EXTRACT(DOW FROM start_time) AS weekday
+                        FROM (SELECT DISTINCT start_time FROM staging_events WHERE start_time IS NOT NULL);
 """)
 
 # QUERY LISTS
@@ -195,8 +279,22 @@ time_table_insert = ("""INSERT INTO time (start_time,hour,day,week,month,year,we
 create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
 drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
 copy_table_queries = [staging_events_copy,staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+insert_table_queries = [user_table_insert, song_table_insert, artist_table_insert, time_table_insert, songplay_table_insert]
 
+# TASK GRAPHS, each task's statement and the tasks it waits for, run by scheduler.py
+# the staging tables are truncated and loaded, the dimensions merged from them and then the fact table
 
+table_names = ['staging_events', 'staging_songs', 'songplays', 'users', 'songs', 'artists', 'time']
 
+copy_table_tasks = {
+    'staging_events': (staging_truncate.format('staging_events') + staging_events_copy, []),
+    'staging_songs': (staging_truncate.format('staging_songs') + staging_songs_copy, [])
+}
 
+insert_table_tasks = {
+    'users': (user_table_insert, ['staging_events']),
+    'songs': (song_table_insert, ['staging_songs']),
+    'artists': (artist_table_insert, ['staging_songs']),
+    'time': (time_table_insert, ['staging_events']),
+    'songplays': (songplay_table_insert, ['users', 'songs', 'artists', 'time'])
+}
@@ -0,0 +1,498 @@
+import argparse
+import configparser
+import csv
+import gzip
+import heapq
+import io
+import json
+import os
+import re
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import urlparse
+import boto3
+import psycopg2
+from sql_queries import staging_events_table_create, staging_songs_table_create, \
+    staging_events_manifest_copy, staging_songs_manifest_copy, staging_truncate, slices_select, \
+    load_errors_select, staging_columns_select, staging_local_copy
+
+REGION = 'us-west-2'
+
+# staging table, prefix of its source files under the source root and the COPY of a manifest of them
+STAGING_LOADS = {
+    'staging_events': ('log_data', staging_events_manifest_copy),
+    'staging_songs': ('song_data', staging_songs_manifest_copy)
+}
+
+# staging tables the local stand-in creates, create_tables.py uses Redshift only DDL
+STAGING_CREATES = {
+    'staging_events': staging_events_table_create,
+    'staging_songs': staging_songs_table_create
+}
+
+# the keys of s3://udacity-dend/log_json_path.json in staging_events column order, ts loaded into start_time, used
+# by the local stand-in, tables not listed are matched by column name like json 'auto'
+LOCAL_JSON_PATHS = {
+    'staging_events': ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+                       'level', 'location', 'method', 'page', 'registration', 'sessionId', 'song',
+                       'status', 'ts', 'userAgent', 'userId']
+}
+
+JSON_SUFFIXES = ('.json', '.json.gz')
+
+# Redshift table attributes Postgres does not have, removed from the DDL the local stand-in runs
+REDSHIFT_ATTRIBUTES = re.compile(r'\b(?:(?:DISTKEY|SORTKEY)\b(?:\s*\([^)]*\))?|DISTSTYLE\s+\w+|ENCODE\s+\w+)', re.IGNORECASE)
+
+
+@lru_cache()
+def s3_client(path='amzn-keys.cfg'):
+    """Create the S3 client, with the key and secret of the secrets file when there is one
+    otherwise with the default AWS credentials. boto3 clients are thread safe so one is shared
+
+    Keyword arguments:
+    path -- location of the secrets file
+    """
+    secret_config = configparser.ConfigParser()
+    if not secret_config.read(path):
+        return boto3.client('s3', region_name=REGION)
+
+    return boto3.client('s3',
+                        region_name=REGION,
+                        aws_access_key_id=secret_config.get('SECRETS', 'AMZN_KEY'),
+                        aws_secret_access_key=secret_config.get('SECRETS', 'AMZN_SECRET'))
+
+
+def postgres_ddl(query):
+    """Remove the Redshift distribution, sort key and encoding attributes from a CREATE TABLE
+    so it runs on Postgres
+
+    Keyword arguments:
+    query -- Redshift CREATE TABLE statement
+    """
+    return REDSHIFT_ATTRIBUTES.sub('', query)
+
+
+def split_url(url):
+    """Split an s3:// url into its bucket and key
+
+    Keyword arguments:
+    url -- s3:// location
+    """
+    parsed = urlparse(url)
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+def join_url(prefix, *parts):
+    """Join the parts onto an s3:// prefix or a local directory
+
+    Keyword arguments:
+    prefix -- s3:// location or local directory
+    parts -- names added under the prefix
+    """
+    return '/'.join([prefix.rstrip('/')] + list(parts))
+
+
+def list_files(prefix):
+    """List the JSON files under an s3:// prefix or a local directory
+
+    Keyword arguments:
+    prefix -- s3:// location or local directory
+
+    Returns a sorted list of (url, size in bytes)
+    """
+    files = []
+    if prefix.startswith('s3://'):
+        bucket, key = split_url(prefix)
+        for page in s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key):
+            files += [('s3://{}/{}'.format(bucket, item['Key']), item['Size'])
+                      for item in page.get('Contents', []) if item['Key'].endswith(JSON_SUFFIXES)]
+    else:
+        for root, dirs, names in os.walk(prefix):
+            files += [(os.path.abspath(os.path.join(root, name)), os.path.getsize(os.path.join(root, name)))
+                      for name in names if name.endswith(JSON_SUFFIXES)]
+    return sorted(files)
+
+
+def read_file(url):
+    """Read an S3 object or a local file, gzip files are decompressed
+
+    Keyword arguments:
+    url -- s3:// location or local path
+    """
+    if url.startswith('s3://'):
+        bucket, key = split_url(url)
+        data = s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+    else:
+        with open(url, 'rb') as f:
+            data = f.read()
+    return gzip.decompress(data) if url.endswith('.gz') else data
+
+
+def read_files(files, workers):
+    """Read files concurrently, keeping at most two reads per worker submitted or waiting to
+    be consumed, so the memory held does not grow with the number of files
+
+    Keyword arguments:
+    files -- list of urls read
+    workers -- number of files read at the same time
+
+    Yields (url, data) in the order of files
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reading = deque()
+        for url in files:
+            reading.append((url, executor.submit(read_file, url)))
+            if len(reading) >= workers * 2:
+                url, future = reading.popleft()
+                yield url, future.result()
+        while reading:
+            url, future = reading.popleft()
+            yield url, future.result()
+
+
+def write_file(url, path):
+    """Upload a local file to S3, or move it to another local path
+
+    Keyword arguments:
+    url -- s3:// location or local path written
+    path -- local file written out
+    """
+    if url.startswith('s3://'):
+        bucket, key = split_url(url)
+        s3_client().upload_file(path, bucket, key)
+    else:
+        os.makedirs(os.path.dirname(url), exist_ok=True)
+        os.replace(path, url)
+
+
+def write_manifest(files, url):
+    """Write the COPY manifest of a list of files, every entry is mandatory so a missing
+    file fails the COPY rather than silently loading less data
+
+    Keyword arguments:
+    files -- list of (url, size in bytes) to load
+    url -- s3:// location or local path of the manifest
+    """
+    manifest = {'entries': [{'url': file, 'mandatory': True, 'meta': {'content_length': size}}
+                            for file, size in files]}
+
+    with tempfile.NamedTemporaryFile('w', suffix='.manifest', delete=False) as f:
+        json.dump(manifest, f, indent=2)
+    write_file(url, f.name)
+
+
+def compact_files(files, prefix, outputs, workers=32):
+    """Concatenate many small JSON files into gzip compressed JSON lines files of about the
+    same size, so each slice of the cluster loads an even share of a few large files rather
+    than millions of tiny ones. Files are handed to the output with the fewest bytes so far,
+    largest first, and read concurrently as reading objects one at a time is latency bound,
+    each file is written to its output as soon as it has been read
+
+    Keyword arguments:
+    files -- list of (url, size in bytes) to compact
+    prefix -- s3:// location or local directory the compacted files are written under
+    outputs -- number of compacted files, a multiple of the number of slices
+    workers -- number of files read at the same time
+
+    Returns the list of (url, size in bytes) of the compacted files
+    """
+    outputs = max(1, min(outputs, len(files)))
+    sizes = [(0, number) for number in range(outputs)]
+    assigned = {}
+    for file, size in sorted(files, key=lambda file: file[1], reverse=True):
+        total, number = heapq.heappop(sizes)
+        assigned[file] = number
+        heapq.heappush(sizes, (total + size, number))
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, 'part-{:05d}.json.gz'.format(number)) for number in range(outputs)]
+        writers = [gzip.open(path, 'wb') for path in paths]
+
+        for file, data in read_files([file for file, size in files], workers):
+            writer = writers[assigned[file]]
+            writer.write(data)
+            if not data.endswith(b'\n'):
+                writer.write(b'\n')
+
+        compacted = []
+        for path, writer in zip(paths, writers):
+            writer.close()
+            url = join_url(prefix, os.path.basename(path))
+            compacted.append((url, os.path.getsize(path)))
+            write_file(url, path)
+
+    return compacted
+
+
+def copy_table(connect, table, manifest, compressed, max_errors):
+    """Truncate a staging table and load it with a manifest COPY on its own connection, the
+    errors are then read from stl_load_errors for this connection's session, whether the
+    COPY failed or loaded with up to max_errors rejected lines. The connection is closed
+    whatever happens, no errors are read back when the COPY failed because it was lost
+
+    Keyword arguments:
+    connect -- function returning a new database connection
+    table -- staging table loaded
+    manifest -- s3:// location of the manifest of the files
+    compressed -- whether the files are gzip compressed
+    max_errors -- number of rejected lines the COPY tolerates
+
+    Returns a dict of the table, seconds, errors and the exception of a failed load
+    """
+    prefix, copy = STAGING_LOADS[table]
+    options = ('gzip ' if compressed else '') + 'maxerror {}'.format(max_errors)
+
+    conn = connect()
+    cur = conn.cursor()
+    start = time.perf_counter()
+    errors = []
+    failure = None
+    try:
+        try:
+            cur.execute(staging_truncate.format(table))
+            cur.execute(copy.format(manifest, options))
+            conn.commit()
+        except psycopg2.Error as e:
+            if not conn.closed:
+                conn.rollback()
+            failure = e
+        seconds = time.perf_counter() - start
+
+        # the load errors are kept for the session, they are lost with a dead connection
+        if not conn.closed:
+            cur.execute(load_errors_select)
+            errors = cur.fetchall()
+    finally:
+        conn.close()
+
+    return {'table': table, 'seconds': seconds, 'errors': errors, 'failure': failure}
+
+
+def json_records(data):
+    """Split the content of a JSON file into its records, one per line
+
+    Keyword arguments:
+    data -- bytes of the file
+
+    Yields (line number, record or None when the line is not valid JSON)
+    """
+    for number, line in enumerate(data.decode('utf-8').splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+def copy_table_local(connect, table, manifest, compressed, max_errors):
+    """The local Postgres stand-in of copy_table. Postgres COPY cannot read JSON, so each
+    manifest entry is read, mapped onto the staging columns the way the Redshift json
+    option does and streamed with COPY FROM STDIN inside a savepoint. A file with a bad
+    line is rolled back on its own and its errors are reported like stl_load_errors, the
+    load fails once more than max_errors lines have been rejected or a statement fails
+
+    Keyword arguments:
+    connect -- function returning a new database connection
+    table -- staging table loaded
+    manifest -- local path of the manifest of the files
+    compressed -- unused, gzip files are recognised by their suffix
+    max_errors -- number of rejected lines the load tolerates
+
+    Returns a dict of the table, seconds, errors and the exception of a failed load
+    """
+    conn = connect()
+    cur = conn.cursor()
+    start = time.perf_counter()
+    errors = []
+    failure = None
+    try:
+        cur.execute(staging_truncate.format(table))
+        cur.execute(staging_columns_select, (table,))
+        columns = cur.fetchall()
+        keys = LOCAL_JSON_PATHS.get(table, [name for name, data_type in columns])
+
+        entries = json.loads(read_file(manifest))['entries']
+        for entry in entries:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            file_errors = []
+            for number, record in json_records(read_file(entry['url'])):
+                if record is None:
+                    file_errors.append((entry['url'], number, '', 'Invalid JSON'))
+                    continue
+                if table not in LOCAL_JSON_PATHS:
+                    record = {key.lower(): value for key, value in record.items()}
+
+                # Redshift loads an empty JSON string as NULL in a column that is not text, and
+                # epoch milliseconds into a timestamp column with timeformat 'epochmillisecs'
+                row = []
+                for key, (name, data_type) in zip(keys, columns):
+                    value = record.get(key)
+                    if value is None or (value == '' and data_type != 'text'):
+                        value = '\\N'
+                    elif data_type.startswith('timestamp') and isinstance(value, (int, float)):
+                        value = datetime.fromtimestamp(value / 1000, timezone.utc).isoformat()
+                    row.append(value)
+                writer.writerow(row)
+
+            if not file_errors:
+                buffer.seek(0)
+                cur.execute('SAVEPOINT staging_file;')
+                try:
+                    cur.copy_expert(staging_local_copy.format(table), buffer)
+                    cur.execute('RELEASE SAVEPOINT staging_file;')
+                except psycopg2.DataError as e:
+                    cur.execute('ROLLBACK TO SAVEPOINT staging_file;')
+                    match = re.search(r'line (\d+)(?:, column (\w+))?', e.diag.context or '')
+                    line, column = (int(match.group(1)), match.group(2) or '') if match else (0, '')
+                    file_errors.append((entry['url'], line, column, e.diag.message_primary))
+            errors += file_errors
+
+        if len(errors) > max_errors:
+            conn.rollback()
+            failure = RuntimeError('{} rejected lines loading {}, more than the {} allowed'.format(
+                len(errors), table, max_errors))
+        else:
+            conn.commit()
+    except psycopg2.Error as e:
+        if not conn.closed:
+            conn.rollback()
+        failure = e
+    finally:
+        conn.close()
+
+    return {'table': table, 'seconds': time.perf_counter() - start, 'errors': errors, 'failure': failure}
+
+
+def load_staging(connect, source, staging, tables, compact=False, files_per_slice=1, slices=None,
+                 max_errors=0, local=False):
+    """Build the manifests of the staging tables' source files, optionally compacting the
+    files first, then run every table's COPY at the same time on separate connections
+
+    Keyword arguments:
+    connect -- function returning a new database connection
+    source -- s3:// location or local directory the source prefixes are under
+    staging -- s3:// location or local directory the manifests and compacted files are written to
+    tables -- staging tables loaded
+    compact -- compact the source files into gzip files first
+    files_per_slice -- compacted files written for each slice of the cluster
+    slices -- number of slices, read from stv_slices when None
+    max_errors -- number of rejected lines each COPY tolerates
+    local -- load a local Postgres stand-in rather than Redshift
+
+    Returns the list of load results of copy_table with the number of files of each
+    """
+    if compact and slices is None:
+        if local:
+            slices = os.cpu_count()
+        else:
+            conn = connect()
+            cur = conn.cursor()
+            cur.execute(slices_select)
+            slices = cur.fetchone()[0]
+            conn.close()
+
+    manifests = {}
+    for table in tables:
+        files = list_files(join_url(source, STAGING_LOADS[table][0]))
+        if compact:
+            start = time.perf_counter()
+            compacted = compact_files(files, join_url(staging, 'compacted', table), slices * files_per_slice)
+            print('compacted {} {} files into {} in {:.2f} seconds'.format(
+                len(files), table, len(compacted), time.perf_counter() - start))
+            files = compacted
+
+        manifests[table] = join_url(staging, 'manifests', table + '.manifest'), len(files)
+        write_manifest(files, manifests[table][0])
+
+    copy = copy_table_local if local else copy_table
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        results = list(executor.map(lambda table: copy(connect, table, manifests[table][0], compact, max_errors),
+                                    tables))
+
+    for result in results:
+        result['files'] = manifests[result['table']][1]
+    return results
+
+
+def print_load_report(results):
+    """Print the files, seconds and number of errors of each load and then every rejected line
+
+    Keyword arguments:
+    results -- load results returned by load_staging
+    """
+    print('{:<16}{:>10}{:>10}{:>10}'.format('table', 'files', 'seconds', 'errors'))
+    for result in results:
+        print('{:<16}{:>10}{:>10.2f}{:>10}'.format(
+            result['table'], result['files'], result['seconds'], len(result['errors'])))
+
+    for result in results:
+        for filename, line, column, reason in result['errors']:
+            print('{} {}:{} {} {}'.format(result['table'], filename, line, column, reason))
+        if result['failure'] is not None:
+            print('{} failed: {}'.format(result['table'], result['failure']))
+
+
+def main(source, staging, tables, compact=False, files_per_slice=1, slices=None, max_errors=0, local=None):
+    """Read the database configuration file, or use the local Postgres connection string
+    Load the staging tables from manifests of their source files and report the load errors
+
+    Keyword arguments:
+    source -- s3:// location or local directory the source prefixes are under
+    staging -- s3:// location or local directory the manifests and compacted files are written to
+    tables -- staging tables loaded
+    compact -- compact the source files into gzip files first
+    files_per_slice -- compacted files written for each slice of the cluster
+    slices -- number of slices, read from the cluster when None
+    max_errors -- number of rejected lines each COPY tolerates
+    local -- connection string of a local Postgres stand-in, Redshift from dwh.cfg when None
+    """
+    if local:
+        connect = lambda: psycopg2.connect(local)
+
+        conn = connect()
+        cur = conn.cursor()
+        for table in tables:
+            cur.execute(postgres_ddl(STAGING_CREATES[table]))
+        conn.commit()
+        conn.close()
+    else:
+        config = configparser.ConfigParser()
+        config.read('dwh.cfg')
+        connect = lambda: psycopg2.connect("host={} dbname={} user={} password={} port={}".format(
+            *config['CLUSTER'].values()))
+
+    results = load_staging(connect, source, staging, tables, compact, files_per_slice, slices, max_errors,
+                           local is not None)
+    print_load_report(results)
+
+    failures = [result['failure'] for result in results if result['failure'] is not None]
+    if failures:
+        raise failures[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the staging tables with manifest COPYs run concurrently")
+    parser.add_argument("--source", default="s3://udacity-dend",
+                        help="s3:// location or local directory of the log_data and song_data prefixes")
+    parser.add_argument("--staging", required=True,
+                        help="s3:// location the manifests and compacted files are written to, a local "
+                             "directory with --local")
+    parser.add_argument("--tables", nargs="+", default=list(STAGING_LOADS), choices=list(STAGING_LOADS),
+                        help="staging tables loaded")
+    parser.add_argument("--compact", action="store_true",
+                        help="compact the source files into gzip JSON lines files, a multiple of the slices")
+    parser.add_argument("--files-per-slice", type=int, default=1, help="compacted files for each slice")
+    parser.add_argument("--slices", type=int, help="number of slices, read from stv_slices by default")
+    parser.add_argument("--max-errors", type=int, default=0, help="rejected lines each COPY tolerates")
+    parser.add_argument("--local", metavar="DSN",
+                        help="load a local Postgres stand-in with this connection string rather than Redshift")
+    args = parser.parse_args()
+
+    main(args.source, args.staging, args.tables, args.compact, args.files_per_slice, args.slices,
+         args.max_errors, args.local)
@@ -0,0 +1,43 @@
+-- Representative analytical queries of the star schema, each optionally preceded by
+-- a weight comment, the number of times it runs for each run of the others
+
+-- weight: 5
+select user_agent, count(user_agent) from songplays
+group by user_agent
+order by count(user_agent) desc
+limit 10;
+
+-- weight: 5
+select month, count(month) from time
+join songplays on time.start_time = songplays.start_time
+group by month
+order by count(month) desc;
+
+-- weight: 10
+select name, count(name) from artists
+join songplays on artists.artist_id = songplays.artist_id
+group by name
+order by count(name) desc
+limit 10;
+
+-- weight: 10
+select last_name || ',' || first_name as "User Name", count(last_name || ',' || first_name) from users
+join songplays on users.user_id = songplays.user_id
+group by last_name || ',' || first_name
+order by count(last_name || ',' || first_name) desc
+limit 10;
+
+-- weight: 20
+select time.day, time.hour, count(*) from songplays
+join time on time.start_time = songplays.start_time
+where songplays.start_time between '2018-11-01' and '2018-11-08'
+group by time.day, time.hour
+order by time.day, time.hour;
+
+-- weight: 2
+select songs.title, count(*) from songplays
+join songs on songs.song_id = songplays.song_id
+where songplays.level = 'paid'
+group by songs.title
+order by count(*) desc
+limit 10;